@@ -0,0 +1,248 @@
+"""
+Historical analytics per queue: throughput per hour, wait and service time
+distributions, skip rates and counter utilization.
+
+A report is built one day at a time. A day's tokens, live and archived, are
+streamed in chunks of ANALYTICS_CHUNK rows from the (queue, created_at)
+indexes into NumPy columns, the database turning timestamps into epoch
+seconds so no row is parsed in Python. Everything after that is vectorized:
+hour buckets with bincount, wait and service times into fixed one-minute
+histograms. A day's result is only those fixed-size arrays, so it is cached
+per (queue, day) and days add up by summing; memory is bounded by the largest
+single day, whatever the range. Percentiles come from the summed histograms,
+to the minute.
+
+Days before today are cached for QUEUE_ANALYTICS_CACHE_TIMEOUT, today for
+QUEUE_RESPONSE_CACHE_TIMEOUT. Hours are in the project's TIME_ZONE.
+"""
+from datetime import datetime, time, timedelta
+
+import numpy as np
+from django.conf import settings
+from django.db.models import Case, FloatField, Func, Value, When
+from django.utils import timezone
+from django.utils.dateparse import parse_date
+
+from . import caching
+from .batching import chunks
+from .models import ArchivedToken, Token
+
+
+ANALYTICS_CHUNK = 50000
+# wait and service times in one-minute bins; the last bin takes everything longer
+HISTOGRAM_MINUTES = 240
+PERCENTILES = (50, 90, 95, 99)
+MAX_DAYS = 366
+# bump when the cached day layout changes
+CACHE_VERSION = 1
+
+STATUS_CODES = {"WAITING": 0, "SERVING": 1, "COMPLETED": 2, "SKIPPED": 3}
+COMPLETED, SKIPPED = STATUS_CODES["COMPLETED"], STATUS_CODES["SKIPPED"]
+
+
+class Epoch(Func):
+    """A datetime column as float seconds since 1970, computed by the database instead of parsed row by row."""
+    output_field = FloatField()
+
+    def as_sql(self, compiler, connection, **extra_context):
+        # PostgreSQL; the others below
+        return super().as_sql(compiler, connection, template="EXTRACT(EPOCH FROM %(expressions)s)", **extra_context)
+
+    def as_sqlite(self, compiler, connection, **extra_context):
+        # stored as UTC text; rounded to the millisecond julianday() is precise to
+        return super().as_sql(
+            compiler, connection, template="ROUND((julianday(%(expressions)s) - 2440587.5) * 86400.0, 3)", **extra_context
+        )
+
+    def as_mysql(self, compiler, connection, **extra_context):
+        return super().as_sql(compiler, connection, template="UNIX_TIMESTAMP(%(expressions)s)", **extra_context)
+
+
+COLUMNS = {
+    "created": Epoch('created_at'),
+    "called": Epoch('called_at'),
+    "completed": Epoch('completed_at'),
+    "status_code": Case(*(When(status=status, then=Value(code)) for status, code in STATUS_CODES.items())),
+}
+
+
+def day_bounds(day):
+    start = timezone.make_aware(datetime.combine(day, time.min))
+    return start, timezone.make_aware(datetime.combine(day + timedelta(days=1), time.min))
+
+def day_columns(queue_id, day, chunk_size=ANALYTICS_CHUNK):
+    """The day's tokens of the queue as NumPy columns: epoch seconds (NaN when unset), status codes, counter ids (0 when none)."""
+    start, end = day_bounds(day)
+    parts = []
+    for model in (Token, ArchivedToken):
+        rows = (
+            model.objects.filter(queue_id=queue_id, created_at__gte=start, created_at__lt=end)
+            .annotate(**COLUMNS).values_list(*COLUMNS, 'counter_id')
+        )
+        for chunk in chunks(rows.iterator(chunk_size=chunk_size), chunk_size):
+            created, called, completed, status, counter = zip(*chunk)
+            parts.append((
+                np.array(created, float),
+                # None becomes NaN
+                np.array(called, float),
+                np.array(completed, float),
+                np.array(status, np.int8),
+                np.array([counter_id or 0 for counter_id in counter], np.int64),
+            ))
+    if not parts:
+        return tuple(np.empty(0, dtype) for dtype in (float, float, float, np.int8, np.int64))
+    return tuple(np.concatenate(column) for column in zip(*parts))
+
+
+def minutes_histogram(seconds):
+    minutes = np.clip(seconds // 60, 0, HISTOGRAM_MINUTES).astype(np.int64)
+    return np.bincount(minutes, minlength=HISTOGRAM_MINUTES + 1)
+
+def _hours(seconds, offset):
+    return ((seconds + offset) // 3600 % 24).astype(np.int64)
+
+def compute_day(queue_id, day):
+    """One day's totals, as fixed-size arrays and sums that add up across days."""
+    created, called, completed, status, counter = day_columns(queue_id, day)
+    offset = timezone.localtime(day_bounds(day)[0]).utcoffset().total_seconds()
+
+    was_called = ~np.isnan(called)
+    done = (status == COMPLETED) & was_called & ~np.isnan(completed)
+    waits = called[was_called] - created[was_called]
+    services = completed[done] - called[done]
+
+    served_by = counter[done]
+    counters = {}
+    if served_by.size:
+        ids, index = np.unique(served_by, return_inverse=True)
+        busy = np.bincount(index, weights=services)
+        served = np.bincount(index)
+        counters = {int(i): (int(n), float(b)) for i, n, b in zip(ids, served, busy) if i}
+
+    finished = completed[done]
+    return {
+        "joined": int(created.size),
+        "completed": int(np.count_nonzero(status == COMPLETED)),
+        "skipped": int(np.count_nonzero(status == SKIPPED)),
+        "joined_by_hour": np.bincount(_hours(created, offset), minlength=24),
+        "completed_by_hour": np.bincount(_hours(finished, offset), minlength=24),
+        "wait_histogram": minutes_histogram(waits),
+        "wait_seconds": float(waits.sum()),
+        "service_histogram": minutes_histogram(services),
+        "service_seconds": float(services.sum()),
+        "counters": counters,
+        # from the first call to the last completion, what utilization is measured against
+        "open_seconds": float(np.nanmax(completed) - np.nanmin(called)) if finished.size else 0.0,
+    }
+
+
+def day_key(queue_id, day):
+    return f"analytics:{CACHE_VERSION}:{queue_id}:{day.isoformat()}"
+
+def day_totals(queue_id, day, today=None):
+    today = today or timezone.localdate()
+    key = day_key(queue_id, day)
+    totals = caching._cache().get(key)
+    if totals is None:
+        totals = compute_day(queue_id, day)
+        timeout = (
+            getattr(settings, "QUEUE_ANALYTICS_CACHE_TIMEOUT", 86400) if day < today
+            else getattr(settings, "QUEUE_RESPONSE_CACHE_TIMEOUT", 300)
+        )
+        caching._cache().set(key, totals, timeout)
+    return totals
+
+
+def percentiles(histogram):
+    """Percentiles in minutes from a one-minute histogram, interpolated within the bin."""
+    total = histogram.sum()
+    if not total:
+        return {f"p{p}": None for p in PERCENTILES}
+    cumulative = np.cumsum(histogram)
+    ranks = np.array(PERCENTILES) / 100 * total
+    bins = np.searchsorted(cumulative, ranks)
+    before = np.where(bins > 0, cumulative[bins - 1], 0)
+    values = bins + (ranks - before) / histogram[bins]
+    return {f"p{p}": round(float(value), 1) for p, value in zip(PERCENTILES, values)}
+
+def distribution(histogram, seconds):
+    count = int(histogram.sum())
+    return {
+        "count": count,
+        "mean": round(seconds / count / 60, 1) if count else None,
+        **percentiles(histogram),
+        # counts per minute, the last one everything from HISTOGRAM_MINUTES on
+        "histogram": histogram.tolist(),
+    }
+
+
+def date_range(start=None, end=None, default_days=7):
+    """Parse the from / to dates of a report; to defaults to today, from to default_days before it."""
+    parsed = []
+    for name, value in (("to", end), ("from", start)):
+        day = parse_date(value) if value else None
+        if value and not day:
+            raise ValueError(f"{name} must be an ISO 8601 date")
+        parsed.append(day)
+    end, start = parsed
+    end = end or timezone.localdate()
+    start = start or end - timedelta(days=default_days - 1)
+    if start > end:
+        raise ValueError("from must not be after to")
+    if (end - start).days >= MAX_DAYS:
+        raise ValueError(f"at most {MAX_DAYS} days per report")
+    return start, end
+
+
+def report(queue_id, start, end):
+    """Analytics of the queue's tokens created from day start to day end, both included."""
+    today = timezone.localdate()
+    days = [start + timedelta(days=n) for n in range((end - start).days + 1)]
+    by_day = []
+    totals = None
+    counters = {}
+    for day in days:
+        day_total = day_totals(queue_id, day, today)
+        by_day.append({
+            "date": day.isoformat(),
+            "joined": day_total["joined"],
+            "completed": day_total["completed"],
+            "skipped": day_total["skipped"],
+        })
+        for counter_id, (served, busy) in day_total["counters"].items():
+            previous = counters.get(counter_id, (0, 0.0))
+            counters[counter_id] = (previous[0] + served, previous[1] + busy)
+        if totals is None:
+            totals = {name: value for name, value in day_total.items() if name != "counters"}
+        else:
+            for name, value in day_total.items():
+                if name != "counters":
+                    totals[name] = totals[name] + value
+
+    finished = totals["completed"] + totals["skipped"]
+    open_seconds = totals["open_seconds"]
+    return {
+        "queue": queue_id,
+        "from": start.isoformat(),
+        "to": end.isoformat(),
+        "joined": totals["joined"],
+        "completed": totals["completed"],
+        "skipped": totals["skipped"],
+        "skip_rate": round(totals["skipped"] / finished, 4) if finished else None,
+        "by_hour": [
+            {"hour": hour, "joined": int(joined), "completed": int(completed), "completed_per_day": round(completed / len(days), 2)}
+            for hour, (joined, completed) in enumerate(zip(totals["joined_by_hour"], totals["completed_by_hour"]))
+        ],
+        "by_day": by_day,
+        "wait_minutes": distribution(totals["wait_histogram"], totals["wait_seconds"]),
+        "service_minutes": distribution(totals["service_histogram"], totals["service_seconds"]),
+        "counters": [
+            {
+                "id": counter_id,
+                "served": served,
+                "busy_minutes": round(busy / 60, 1),
+                "utilization": round(busy / open_seconds, 4) if open_seconds else None,
+            }
+            for counter_id, (served, busy) in sorted(counters.items())
+        ],
+    }
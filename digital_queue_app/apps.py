@@ -3,3 +3,11 @@ from django.apps import AppConfig
 
 class DigitalQueueAppConfig(AppConfig):
     name = 'digital_queue_app'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import metrics
+
+        # every connection, in whichever thread, counts into the request's QueryTracker
+        connection_created.connect(metrics.connection_created)
@@ -0,0 +1,86 @@
+"""
+Archival of finished tokens.
+
+Completed and skipped tokens are only read by history and reporting, yet they
+make up almost all of the Token table and every hot-path index with it.
+archive_tokens() moves them, once they are older than a cutoff, into
+ArchivedToken in bounded batches and folds them into DailyQueueStats so
+per-day figures survive without scanning the archive. Token then only holds
+today's traffic plus whatever is still waiting or being served.
+
+Run it on a schedule with the archive_tokens management command.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import caching, sharding
+from .batching import FINISHED_STATUSES
+from .models import ArchivedToken, DailyQueueStats, Token
+
+
+ARCHIVE_FIELDS = (
+    'id', 'queue_id', 'token_number', 'priority', 'status', 'counter_id',
+    'created_at', 'called_at', 'completed_at', 'user_name', 'phone_number',
+)
+
+
+def daily_totals(rows):
+    """Sum archived rows into {(queue_id, date): {field: increment}}."""
+    totals = defaultdict(lambda: defaultdict(float))
+    for row in rows:
+        day = totals[row['queue_id'], timezone.localdate(row['created_at'])]
+        day["completed" if row['status'] == "COMPLETED" else "skipped"] += 1
+        if row['called_at']:
+            day["called"] += 1
+            day["total_wait_seconds"] += (row['called_at'] - row['created_at']).total_seconds()
+            if row['completed_at']:
+                day["served"] += 1
+                day["total_service_seconds"] += (row['completed_at'] - row['called_at']).total_seconds()
+    return totals
+
+def add_daily_totals(totals):
+    for (queue_id, date), increments in totals.items():
+        stats, _ = DailyQueueStats.objects.get_or_create(queue_id=queue_id, date=date)
+        DailyQueueStats.objects.filter(id=stats.id).update(
+            **{field: F(field) + value for field, value in increments.items()}
+        )
+
+
+def archive_batch(cutoff, batch_size):
+    """Archive up to batch_size finished tokens created before cutoff. Returns how many moved."""
+    with transaction.atomic(using=sharding.db()):
+        rows = list(
+            Token.objects.select_for_update(skip_locked=True)
+            .filter(status__in=FINISHED_STATUSES, created_at__lt=cutoff)
+            .order_by('created_at', 'id')
+            .values(*ARCHIVE_FIELDS)[:batch_size]
+        )
+        if not rows:
+            return 0
+
+        ArchivedToken.objects.bulk_create([
+            ArchivedToken(token_id=row['id'], **{field: row[field] for field in ARCHIVE_FIELDS[1:]})
+            for row in rows
+        ])
+        add_daily_totals(daily_totals(rows))
+        Token.objects.filter(id__in=[row['id'] for row in rows]).delete()
+
+        for queue_id in {row['queue_id'] for row in rows}:
+            caching.invalidate(queue_id)
+        caching.forget_tokens([row['id'] for row in rows])
+    return len(rows)
+
+def archive_tokens(cutoff, batch_size=5000):
+    """Archive every finished token created before cutoff, one batch per transaction."""
+    archived = 0
+    for alias in sharding.shards():
+        with sharding.using(alias):
+            while True:
+                moved = archive_batch(cutoff, batch_size)
+                archived += moved
+                if moved < batch_size:
+                    break
+    return archived
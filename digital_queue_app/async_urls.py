@@ -0,0 +1,12 @@
+from django.urls import path
+
+from . import async_views
+from .urls import urlpatterns as sync_urlpatterns
+
+# The ASGI deployment's routes: the async views first, everything else as in urls.py
+urlpatterns = [
+    path("join/", async_views.join_queue),
+    path("serving/<int:queue_id>/", async_views.current_serving),
+    path("my-token/<int:token_id>/", async_views.my_token_status),
+    path("queues/", async_views.list_queues),
+] + sync_urlpatterns
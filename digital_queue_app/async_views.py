@@ -0,0 +1,177 @@
+import json
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.exceptions import APIException
+from rest_framework.renderers import JSONRenderer
+
+from . import caching, eta, idempotency, positions, ratelimit, routers, sharding
+from .models import Queue, Token
+from .pagination import akeyset_page_data
+from .routers import read_only
+from .serializers import QueueSerializer, SERVING_ROW
+from .views import (
+    REPLAYED_HEADERS, ActiveTokenExists, join_conflict, join_token, joined_token_payload,
+    serving_rows, token_status_data, token_status_row, waiting_fields
+)
+
+
+# Async twins of the hot read views (plus join) for the ASGI deployment, where
+# asgi.py routes these paths here (see async_urls.py). An in-flight poll is a
+# parked coroutine instead of a worker thread. Responses are rendered with
+# DRF's JSONRenderer so they are byte-for-byte what the sync views return.
+
+def json_response(data, status=200, headers=None):
+    content = JSONRenderer().render(data) if data is not None else b""
+    response = HttpResponse(content, status=status, content_type="application/json", headers=headers)
+    response["Vary"] = "Accept"
+    return response
+
+def async_api_view(methods):
+    """csrf_exempt and method checking like DRF's @api_view, for async views."""
+    def decorator(view):
+        @csrf_exempt
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            if request.method not in methods:
+                response = json_response({"detail": f'Method "{request.method}" not allowed.'}, status=405)
+            else:
+                try:
+                    response = await view(request, *args, **kwargs)
+                except APIException as e:
+                    response = exception_response(e)
+            response["Allow"] = ", ".join(methods + ["OPTIONS"])
+            return response
+        return wrapped
+    return decorator
+
+def exception_response(exc):
+    """The response DRF's exception handler gives for exc (e.g. 429 with Retry-After)."""
+    headers = {}
+    if getattr(exc, "wait", None):
+        headers["Retry-After"] = "%d" % exc.wait
+    return json_response({"detail": exc.detail}, status=exc.status_code, headers=headers)
+
+def request_data(request):
+    if request.content_type == "application/json":
+        return json.loads(request.body or b"{}")
+    return request.POST
+
+
+async def awaiting_status(token):
+    people_ahead, people_behind = await positions.aposition(token)
+    return waiting_fields(people_ahead, people_behind, await eta.await_minutes(token.queue_id, people_ahead))
+
+async def cached_json(request, name, queue_id, build):
+    etag, not_modified, key, data = await caching.arun(caching.lookup, request, name, queue_id)
+    if not_modified:
+        return json_response(None, status=304, headers={"ETag": etag})
+    if data is None:
+        data = await caching.abuild_once(key, build)
+    return json_response(data, headers={"ETag": etag})
+
+
+@async_api_view(['GET'])
+@ratelimit.limited("queue", "ip")
+@sharding.routed
+@read_only
+async def current_serving(request, queue_id):
+    async def build():
+        return SERVING_ROW.data([row async for row in serving_rows(queue_id)])
+
+    return await cached_json(request, f"serving-{queue_id}", queue_id, build)
+
+
+@async_api_view(['GET'])
+@ratelimit.limited("token", "ip")
+@sharding.routed
+@read_only
+async def my_token_status(request, token_id):
+    queue_id = await caching.atoken_queue_id(token_id)
+    if queue_id is None:
+        return json_response({"error": "Token not found"}, status=404)
+
+    async def build():
+        try:
+            token = await token_status_row(token_id).aget()
+        except Token.DoesNotExist:
+            if not routers.using_replica():
+                raise
+            with routers.primary():
+                token = await token_status_row(token_id).aget()
+        return token_status_data(token, await awaiting_status(token) if token.status == "WAITING" else None)
+
+    try:
+        return await cached_json(request, f"my-token-{token_id}", queue_id, build)
+    except Token.DoesNotExist:
+        return json_response({"error": "Token not found"}, status=404)
+
+
+@async_api_view(['GET'])
+@sharding.routed
+@read_only
+async def list_queues(request):
+    try:
+        data = await akeyset_page_data(request, Queue.objects.all(), ('id',), lambda rows: QueueSerializer(rows, many=True).data)
+    except ValueError as e:
+        return json_response({"error": str(e)}, status=400)
+    return json_response(data)
+
+
+@async_api_view(['GET', 'POST'])
+async def join_queue(request):
+    if request.method == 'GET':
+        return json_response({
+            "message": "Send the following fields using POST to join the queue.",
+            "required_fields": {
+                "user_name": "string",
+                "phone_number": "string",
+                "queue": "integer (Queue ID)",
+                "priority": "optional (1=normal, 2=high, 3=emergency)"
+            }
+        })
+
+    try:
+        data = request_data(request)
+    except ValueError:
+        return json_response({"detail": "JSON parse error"}, status=400)
+    queue_id = data.get("queue")
+    user_name = data.get("user_name")
+    phone_number = data.get("phone_number")
+    priority = data.get("priority")
+
+    if not queue_id or not user_name or not phone_number:
+        return json_response({"error": "queue, user_name and phone_number are required"}, status=400)
+    try:
+        queue_id = int(queue_id)
+        priority = int(priority) if priority is not None else None
+    except (TypeError, ValueError):
+        return json_response({"error": "queue and priority must be integers"}, status=400)
+
+    # the queue is in the body, which @sharding.routed does not parse here
+    with sharding.using(await sync_to_async(sharding.shard_for_queue)(queue_id) if sharding.enabled() else None):
+        return await join(queue_id, user_name, phone_number, priority, request.headers.get("Idempotency-Key"))
+
+async def join(queue_id, user_name, phone_number, priority, idempotency_key=None):
+    try:
+        queue = await Queue.objects.aget(id=queue_id)
+    except Queue.DoesNotExist:
+        return json_response({"error": "Queue not found"}, status=404)
+
+    if priority is None:
+        priority = min(queue.priority_levels)
+    if priority not in queue.priority_levels:
+        return json_response({"error": f"priority must be one of {queue.priority_levels}"}, status=400)
+
+    # the async ORM has no transactions, so the allocation runs in one sync hop
+    try:
+        token, replayed = await sync_to_async(join_token)(queue, user_name, phone_number, priority, idempotency_key)
+    except (idempotency.KeyReused, ActiveTokenExists) as e:
+        return json_response(*join_conflict(e))
+    people_ahead, _ = await positions.aposition(token)
+    return json_response({
+        "message": "Token created successfully",
+        "token": joined_token_payload(token, await eta.await_minutes(queue.id, people_ahead))
+    }, status=201, headers=REPLAYED_HEADERS if replayed else None)
@@ -0,0 +1,21 @@
+"""
+Helpers shared by the jobs that work through tokens in batches: archiving,
+moving queues between shards, the transition log and analytics.
+"""
+
+# a token in one of these is done with: archived, copied once, never changed again
+FINISHED_STATUSES = ("COMPLETED", "SKIPPED")
+# ids per IN (...) list, below SQLite's bound parameter limit
+ID_CHUNK = 500
+
+
+def chunks(items, size=ID_CHUNK):
+    """Lists of up to `size` items, consuming any iterable (e.g. a streaming queryset) as it goes."""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
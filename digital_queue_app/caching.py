@@ -0,0 +1,189 @@
+"""
+Response cache for the polling endpoints (current_serving, my_token_status).
+
+Every queue has a version number in the cache that is bumped, on commit,
+whenever one of its tokens changes state. Cached responses and ETags carry the
+version they were built at, so a bump invalidates exactly that queue's entries
+and nothing has to be deleted. A poll whose If-None-Match still matches gets a
+304 without the body being looked up at all. Concurrent misses of the same
+response share one build (see coalescing.py).
+"""
+import threading
+import time
+from collections import Counter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import transaction
+from rest_framework.response import Response
+
+from . import coalescing, routers, sharding
+from .models import Token
+
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+def _cache():
+    return caches[getattr(settings, "QUEUE_RESPONSE_CACHE", "default")]
+
+def _timeout():
+    return getattr(settings, "QUEUE_RESPONSE_CACHE_TIMEOUT", 300)
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+def stats():
+    with _stats_lock:
+        hits, misses, not_modified, coalesced = _stats["hit"], _stats["miss"], _stats["not_modified"], _stats["coalesced"]
+    served = hits + misses + not_modified
+    return {
+        "hits": hits,
+        "misses": misses,
+        "not_modified": not_modified,
+        # misses that shared a concurrent identical build
+        "coalesced": coalesced,
+        "hit_ratio": (hits + not_modified) / served if served else 0.0,
+    }
+
+def reset_stats():
+    with _stats_lock:
+        _stats.clear()
+
+
+def queue_version(queue_id):
+    key = f"queue:{queue_id}:version"
+    version = _cache().get(key)
+    if version is None:
+        # a fresh, never-reused base so entries cached under an evicted version stay dead
+        version = time.time_ns()
+        if not _cache().add(key, version, None):
+            version = _cache().get(key, version)
+    return version
+
+def _bump(queue_id):
+    key = f"queue:{queue_id}:version"
+    try:
+        _cache().incr(key)
+    except ValueError:
+        _cache().set(key, time.time_ns(), None)
+
+def invalidate(queue_id):
+    transaction.on_commit(lambda: _bump(queue_id), using=sharding.db())
+
+
+def _token_queue(token_id):
+    return Token.objects.filter(id=token_id).values_list('queue_id', flat=True)
+
+def _find_token_queue(token_id):
+    if sharding.enabled():
+        # which shard holds the token is what is being looked up
+        return sharding.queue_of(Token, token_id)
+    queue_id = _token_queue(token_id).first()
+    if queue_id is None and routers.using_replica():
+        # may have joined after the replica last caught up
+        with routers.primary():
+            queue_id = _token_queue(token_id).first()
+    return queue_id
+
+def token_queue_id(token_id):
+    """Queue of a token, or None if it does not exist. Tokens never change queue."""
+    key = f"token:{token_id}:queue"
+    queue_id = _cache().get(key)
+    if queue_id is None:
+        queue_id = _find_token_queue(token_id)
+        if queue_id is not None:
+            _cache().set(key, queue_id, None)
+    return queue_id
+
+def forget_tokens(token_ids):
+    # archived tokens are gone from Token, drop their queue lookups on commit
+    keys = [f"token:{token_id}:queue" for token_id in token_ids]
+    transaction.on_commit(lambda: _cache().delete_many(keys), using=sharding.db())
+
+
+def lookup(request, name, queue_id):
+    """Return (etag, not_modified, key, cached data or None) for a polling response."""
+    version = queue_version(queue_id)
+    etag = f'"{name}-{version}"'
+
+    if etag in request.headers.get("If-None-Match", ""):
+        _count("not_modified")
+        return etag, True, None, None
+
+    key = f"response:{name}:{version}"
+    data = _cache().get(key)
+    _count("miss" if data is None else "hit")
+    return etag, False, key, data
+
+def store(key, data):
+    timeout = _timeout()
+    if routers.using_replica():
+        # the replica may not have the commit that bumped the version yet
+        timeout = min(timeout, getattr(settings, "QUEUE_REPLICA_CACHE_TIMEOUT", 5))
+    _cache().set(key, data, timeout)
+
+def build_once(key, build):
+    """Build and store a missed response; concurrent misses of the same key share one build."""
+    def build_and_store():
+        data = build()
+        store(key, data)
+        return data
+
+    if not coalescing.enabled():
+        return build_and_store()
+    data, shared = coalescing.flights.do(key, build_and_store)
+    if shared:
+        _count("coalesced")
+    return data
+
+def cached_response(request, name, queue_id, build):
+    etag, not_modified, key, data = lookup(request, name, queue_id)
+    if not_modified:
+        return Response(status=304, headers={"ETag": etag})
+    if data is None:
+        data = build_once(key, build)
+    return Response(data, headers={"ETag": etag})
+
+
+# Async views call the helpers above through arun(). The in-process cache
+# never blocks, so it is used straight from the event loop; any other backend
+# is driven from a worker thread.
+
+async def arun(fn, *args):
+    if isinstance(_cache(), LocMemCache):
+        return fn(*args)
+    return await sync_to_async(fn)(*args)
+
+async def abuild_once(key, build):
+    """build_once() for async views; build is an async callable."""
+    async def build_and_store():
+        data = await build()
+        await arun(store, key, data)
+        return data
+
+    if not coalescing.enabled():
+        return await build_and_store()
+    data, shared = await coalescing.async_flights.do(key, build_and_store)
+    if shared:
+        _count("coalesced")
+    return data
+
+async def atoken_queue_id(token_id):
+    key = f"token:{token_id}:queue"
+    queue_id = await arun(_cache().get, key)
+    if queue_id is None:
+        if sharding.enabled():
+            queue_id = await sync_to_async(_find_token_queue)(token_id)
+        else:
+            queue_id = await _token_queue(token_id).afirst()
+            if queue_id is None and routers.using_replica():
+                with routers.primary():
+                    queue_id = await _token_queue(token_id).afirst()
+        if queue_id is not None:
+            await arun(_cache().set, key, queue_id, None)
+    return queue_id
@@ -0,0 +1,81 @@
+"""
+Single-flight request coalescing for the polling endpoints.
+
+When a call bumps a queue's cache version, every customer polling that queue
+misses the response cache at the same moment. Instead of each request
+building the same response, the first one builds it and the rest wait for
+and share its result (or its exception). Only concurrent requests are
+coalesced; once the build finishes, later ones read the response cache.
+
+The sync views share a build across threads, the async views across
+coroutines of one event loop. Like the other in-process state, nothing is
+shared between worker processes. QUEUE_REQUEST_COALESCING = False turns it
+off.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+
+
+def enabled():
+    return getattr(settings, "QUEUE_REQUEST_COALESCING", True)
+
+
+class Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flights = {}
+
+    def do(self, key, build):
+        """Return (build() or the result of the identical build in progress, whether it was shared)."""
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = Flight()
+
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result, True
+
+        try:
+            flight.result = build()
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, False
+
+
+class AsyncSingleFlight:
+    def __init__(self):
+        self._flights = {}
+
+    async def do(self, key, build):
+        """SingleFlight.do() for coroutines; build is an async callable."""
+        # keyed by loop too: a task can only be awaited from its own loop
+        key = (asyncio.get_running_loop(), key)
+        task = self._flights.get(key)
+        shared = task is not None
+        if not shared:
+            # a task of its own, so a waiter that disconnects does not cancel it for the rest
+            task = self._flights[key] = asyncio.ensure_future(build())
+            task.add_done_callback(lambda _: self._flights.pop(key, None))
+        return await asyncio.shield(task), shared
+
+
+flights = SingleFlight()
+async_flights = AsyncSingleFlight()
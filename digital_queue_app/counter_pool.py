@@ -0,0 +1,118 @@
+"""
+In-process pool of the counters of each queue.
+
+Counter rows stay the source of truth (state plus is_busy). The pool keeps, per
+queue, the open counters that are free in the order they became free, so
+call_next hands work to the counter that has been idle longest in O(1)
+instead of scanning for the lowest free id, which piled work onto the first
+counters. Like the position index it is loaded on first use and kept current
+on commit by the views.
+
+Candidates from the pool are still claimed with a conditional UPDATE, so a
+stale pool (another worker process claimed or freed a counter) costs a retry
+and a reload, never a double assignment. QUEUE_COUNTER_POOL = False goes back
+to finding a free counter with a query on every call.
+"""
+import threading
+from collections import OrderedDict
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+
+from . import sharding
+from .models import Counter
+
+
+class CounterPool:
+    def __init__(self, counters=()):
+        self.states = {}
+        self.busy = set()
+        self.free = OrderedDict()  # longest idle first
+        for counter_id, state, is_busy in counters:
+            self.update(counter_id, state, is_busy)
+
+    def update(self, counter_id, state, is_busy):
+        self.states[counter_id] = state
+        if is_busy:
+            self.busy.add(counter_id)
+        else:
+            self.busy.discard(counter_id)
+        if state == "OPEN" and not is_busy:
+            self.free.setdefault(counter_id, None)
+        else:
+            self.free.pop(counter_id, None)
+
+    def claim(self, counter_id):
+        self.busy.add(counter_id)
+        self.free.pop(counter_id, None)
+
+    def release(self, counter_id):
+        self.busy.discard(counter_id)
+        self.free.pop(counter_id, None)
+        if self.states.get(counter_id) == "OPEN":
+            self.free[counter_id] = None
+
+    def candidates(self, limit):
+        return list(islice(self.free, limit))
+
+    def summary(self):
+        counts = {state: 0 for state, _ in Counter.STATE_CHOICES}
+        for state in self.states.values():
+            counts[state] += 1
+        return {"states": counts, "busy": len(self.busy), "free": len(self.free)}
+
+
+_lock = threading.Lock()
+_queues = {}
+
+
+def enabled():
+    return getattr(settings, "QUEUE_COUNTER_POOL", True)
+
+def load(queue_id):
+    return CounterPool(Counter.objects.filter(queue_id=queue_id).values_list('id', 'state', 'is_busy'))
+
+def _get(queue_id):
+    pool = _queues.get(queue_id)
+    if pool is None:
+        pool = _queues[queue_id] = load(queue_id)
+    return pool
+
+def reload(queue_id):
+    pool = load(queue_id)
+    with _lock:
+        _queues[queue_id] = pool
+
+def clear():
+    with _lock:
+        _queues.clear()
+
+
+def _apply(queue_id, method, *args):
+    with _lock:
+        if queue_id in _queues:
+            getattr(_queues[queue_id], method)(*args)
+
+def counter_saved(counter):
+    transaction.on_commit(lambda: _apply(counter.queue_id, "update", counter.id, counter.state, counter.is_busy), using=sharding.db())
+
+def counter_claimed(counter):
+    transaction.on_commit(lambda: _apply(counter.queue_id, "claim", counter.id), using=sharding.db())
+
+def counter_released(queue_id, counter_id):
+    transaction.on_commit(lambda: _apply(queue_id, "release", counter_id), using=sharding.db())
+
+def counter_unavailable(queue_id, counter_id):
+    # the pool offered a counter the database would not hand out; drop it now,
+    # a reload brings it back if it frees up again
+    _apply(queue_id, "claim", counter_id)
+
+
+def candidates(queue_id, limit):
+    with _lock:
+        return _get(queue_id).candidates(limit)
+
+def summary(queue_id):
+    with _lock:
+        return _get(queue_id).summary()
@@ -0,0 +1,152 @@
+"""
+Wait time estimates from observed service times.
+
+Each queue keeps an exponentially weighted moving average of how long a token
+spends at a counter (called_at -> completed_at), both for the queue as a whole
+and for every counter in it. A queue's service rate is the sum of its open
+counters' rates, so a waiting token's ETA is people_ahead / rate. Completions
+update the averages in O(1) and a status request is a dictionary lookup.
+
+Until a queue has completed tokens to learn from, Queue.avg_handle_time is
+used. Estimates live in the current process and are reloaded from the Token
+table (topped up from the archive) every QUEUE_ETA_REFRESH_SECONDS so several
+workers converge.
+"""
+import threading
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+
+from . import sharding
+from .models import ArchivedToken, Counter, Queue, Token
+
+
+ALPHA = 0.2
+WARMUP_SAMPLES = 50
+
+
+class QueueEstimator:
+    def __init__(self, default_seconds, counter_ids=(), alpha=ALPHA):
+        self.alpha = alpha
+        self.service_seconds = float(default_seconds)
+        # learned per counter; a counter on break or closed keeps its average
+        self.counters = {counter_id: None for counter_id in counter_ids}
+        self.open = set(counter_ids)
+        self.loaded_at = time.monotonic()
+
+    def record_service(self, counter_id, seconds):
+        if seconds < 0:
+            return
+        self.service_seconds += self.alpha * (seconds - self.service_seconds)
+        current = self.counters.get(counter_id)
+        self.counters[counter_id] = seconds if current is None else current + self.alpha * (seconds - current)
+
+    def add_counter(self, counter_id):
+        self.counters.setdefault(counter_id, None)
+        self.open.add(counter_id)
+
+    def remove_counter(self, counter_id):
+        self.open.discard(counter_id)
+
+    def seconds_per_position(self):
+        """Average time for the queue's open counters to get through one waiting token."""
+        if not self.open:
+            return self.service_seconds
+        rate = sum(1.0 / max(self.counters.get(counter_id) or self.service_seconds, 1.0) for counter_id in self.open)
+        return 1.0 / rate
+
+    def wait_seconds(self, people_ahead):
+        return people_ahead * self.seconds_per_position()
+
+
+_lock = threading.Lock()
+_queues = {}
+
+
+def _refresh_seconds():
+    return getattr(settings, "QUEUE_ETA_REFRESH_SECONDS", 300)
+
+def load(queue_id):
+    avg_handle_time = Queue.objects.values_list('avg_handle_time', flat=True).get(id=queue_id)
+    counter_ids = Counter.objects.filter(queue_id=queue_id, state="OPEN").values_list('id', flat=True)
+    estimator = QueueEstimator(avg_handle_time * 60, counter_ids)
+
+    recent = []
+    # after a nightly archive run the Token table may hold too few completions
+    for model in (Token, ArchivedToken):
+        recent += (
+            model.objects.filter(queue_id=queue_id, status="COMPLETED", completed_at__isnull=False, called_at__isnull=False)
+            .order_by('-completed_at')
+            .values_list('counter_id', 'called_at', 'completed_at')[:WARMUP_SAMPLES - len(recent)]
+        )
+        if len(recent) >= WARMUP_SAMPLES:
+            break
+    for counter_id, called_at, completed_at in reversed(recent):
+        estimator.record_service(counter_id, (completed_at - called_at).total_seconds())
+    return estimator
+
+def _get(queue_id):
+    estimator = _queues.get(queue_id)
+    if estimator is None or time.monotonic() - estimator.loaded_at > _refresh_seconds():
+        estimator = _queues[queue_id] = load(queue_id)
+    return estimator
+
+def clear():
+    with _lock:
+        _queues.clear()
+
+
+def _record_completion(token):
+    with _lock:
+        if token.queue_id in _queues:
+            _queues[token.queue_id].record_service(
+                token.counter_id, (token.completed_at - token.called_at).total_seconds()
+            )
+
+def token_completed(token):
+    if token.called_at and token.completed_at:
+        transaction.on_commit(lambda: _record_completion(token), using=sharding.db())
+
+def _counter_saved(counter):
+    with _lock:
+        if counter.queue_id in _queues:
+            if counter.state == "OPEN":
+                _queues[counter.queue_id].add_counter(counter.id)
+            else:
+                _queues[counter.queue_id].remove_counter(counter.id)
+
+def counter_saved(counter):
+    transaction.on_commit(lambda: _counter_saved(counter), using=sharding.db())
+
+
+def wait_minutes(queue_id, people_ahead):
+    with _lock:
+        seconds = _get(queue_id).wait_seconds(people_ahead)
+    return round(seconds / 60)
+
+def cached_minutes(queue_id, people_ahead):
+    """wait_minutes() from a loaded, fresh estimator; None when it would need the database."""
+    with _lock:
+        estimator = _queues.get(queue_id)
+        if estimator is not None and time.monotonic() - estimator.loaded_at <= _refresh_seconds():
+            return round(estimator.wait_seconds(people_ahead) / 60)
+    return None
+
+async def await_minutes(queue_id, people_ahead):
+    """wait_minutes() for async views; a loaded, fresh estimator is read in place."""
+    minutes = cached_minutes(queue_id, people_ahead)
+    return minutes if minutes is not None else await sync_to_async(wait_minutes)(queue_id, people_ahead)
+
+def snapshot(queue_id):
+    with _lock:
+        estimator = _get(queue_id)
+        return {
+            "service_seconds": round(estimator.service_seconds, 1),
+            "seconds_per_position": round(estimator.seconds_per_position(), 1),
+            "counters": {
+                counter_id: round(seconds, 1) if seconds is not None else None
+                for counter_id, seconds in estimator.counters.items() if counter_id in estimator.open
+            },
+        }
@@ -0,0 +1,123 @@
+"""
+Push channel for queue state changes.
+
+The views publish an event for every token that joins, is called, skipped or
+completed, on commit, to the channel of its queue. Server-Sent Event streams
+(see stream_views.py) subscribe to those channels so displays and phones no
+longer have to poll current_serving / my_token_status.
+
+The broker is chosen with QUEUE_EVENT_BROKER. The default InProcessBroker
+fans out to subscribers of the current process only; a multi-worker
+deployment plugs in a Broker subclass backed by a shared pub/sub service.
+"""
+import asyncio
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from . import sharding
+
+
+SUBSCRIBER_BUFFER = 100
+
+
+class Subscription:
+    def __init__(self, broker, channel, loop):
+        self.broker = broker
+        self.channel = channel
+        self.loop = loop
+        self.events = asyncio.Queue(SUBSCRIBER_BUFFER)
+
+    def deliver(self, event):
+        # runs on the subscriber's loop; a slow reader loses its oldest events
+        if self.events.full():
+            self.events.get_nowait()
+        self.events.put_nowait(event)
+
+    async def get(self, timeout=None):
+        return await asyncio.wait_for(self.events.get(), timeout)
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class Broker:
+    def subscribe(self, channel):
+        """Return a Subscription bound to the running event loop."""
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+    def publish(self, channel, event):
+        """Deliver event to every subscriber of channel. Safe to call from any thread."""
+        raise NotImplementedError
+
+
+class InProcessBroker(Broker):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.channels = {}
+
+    def subscribe(self, channel):
+        subscription = Subscription(self, channel, asyncio.get_running_loop())
+        with self.lock:
+            self.channels.setdefault(channel, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            subscribers = self.channels.get(subscription.channel, set())
+            subscribers.discard(subscription)
+            if not subscribers:
+                self.channels.pop(subscription.channel, None)
+
+    def publish(self, channel, event):
+        with self.lock:
+            subscribers = list(self.channels.get(channel, ()))
+        for subscription in subscribers:
+            try:
+                subscription.loop.call_soon_threadsafe(subscription.deliver, event)
+            except RuntimeError:
+                # loop already closed, the stream is going away
+                self.unsubscribe(subscription)
+
+    def subscriber_count(self, channel=None):
+        with self.lock:
+            if channel is not None:
+                return len(self.channels.get(channel, ()))
+            return sum(len(subscribers) for subscribers in self.channels.values())
+
+
+_broker = None
+_broker_lock = threading.Lock()
+
+
+def get_broker():
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                path = getattr(settings, "QUEUE_EVENT_BROKER", "digital_queue_app.events.InProcessBroker")
+                _broker = import_string(path)()
+    return _broker
+
+
+def queue_channel(queue_id):
+    return f"queue:{queue_id}"
+
+
+def token_event(token, event_type):
+    """Publish a token's state change to its queue's channel once the transaction commits."""
+    event = {
+        "type": event_type,
+        "queue": token.queue_id,
+        "token": token.id,
+        "token_number": token.token_number,
+        "priority": token.priority,
+        "status": token.status,
+        "counter": token.counter_id,
+    }
+    transaction.on_commit(lambda: get_broker().publish(queue_channel(token.queue_id), event), using=sharding.db())
@@ -0,0 +1,64 @@
+"""
+Idempotency-Key support for joins.
+
+A kiosk on a flaky network retries a join it never saw the answer to. With an
+Idempotency-Key header the first join records the key, hashed, next to the
+token it created, in the same transaction; a retry with the same key gets
+that token back instead of a new one. Two copies of the same join racing each
+other are settled by the unique key: the loser's transaction rolls back and
+it replays the winner's token.
+
+A key is kept QUEUE_IDEMPOTENCY_KEY_HOURS (24 by default) and then treated as
+unused; archive_tokens purges the expired rows. Reusing a live key for a
+different join is refused rather than replayed.
+"""
+import hashlib
+import json
+from datetime import timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from . import sharding
+from .models import IdempotencyKey, Token
+
+
+class KeyReused(Exception):
+    """The key was already used for a join with different fields."""
+
+
+def ttl():
+    return timedelta(hours=getattr(settings, "QUEUE_IDEMPOTENCY_KEY_HOURS", 24))
+
+def digest(value):
+    return hashlib.sha256(value.encode()).hexdigest()
+
+def fingerprint(queue_id, user_name, phone_number, priority):
+    return digest(json.dumps([queue_id, user_name, phone_number, priority]))
+
+
+def lookup(key, request_fingerprint):
+    """The token an earlier join with this key created, or None."""
+    entry = IdempotencyKey.objects.filter(key=key).first()
+    if entry is None:
+        return None
+    token = Token.objects.filter(id=entry.token_id).first() if entry.created_at >= timezone.now() - ttl() else None
+    if token is None:
+        # expired, or its token has been archived: the key is free again
+        entry.delete()
+        return None
+    if entry.fingerprint != request_fingerprint:
+        raise KeyReused
+    return token
+
+def remember(key, request_fingerprint, token):
+    """Record the key for the token, in the transaction that created it."""
+    IdempotencyKey.objects.create(key=key, fingerprint=request_fingerprint, queue_id=token.queue_id, token_id=token.id)
+
+def purge(now=None):
+    """Delete expired keys on every shard; returns how many."""
+    cutoff = (now or timezone.now()) - ttl()
+    return sum(
+        IdempotencyKey.objects.using(alias).filter(created_at__lt=cutoff).delete()[0]
+        for alias in sharding.shards()
+    )
@@ -0,0 +1,29 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from digital_queue_app import idempotency
+from digital_queue_app.archive import archive_tokens
+
+
+class Command(BaseCommand):
+    help = (
+        "Move completed and skipped tokens older than --older-than hours into the archive "
+        "and roll them up into daily queue stats, and delete expired Idempotency-Keys. "
+        "Meant to run from cron, e.g. every night."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--older-than", type=float, default=getattr(settings, "QUEUE_ARCHIVE_AFTER_HOURS", 24),
+            help="Archive finished tokens created more than this many hours ago",
+        )
+        parser.add_argument("--batch-size", type=int, default=5000, help="Tokens moved per transaction")
+
+    def handle(self, *args, **options):
+        cutoff = timezone.now() - timedelta(hours=options["older_than"])
+        archived = archive_tokens(cutoff, options["batch_size"])
+        self.stdout.write(f"Archived {archived} tokens created before {cutoff.isoformat()}")
+        self.stdout.write(f"Purged {idempotency.purge()} expired idempotency keys")
@@ -0,0 +1,821 @@
+import asyncio
+import heapq
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from datetime import timedelta
+from unittest import mock
+
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from digital_queue_app import analytics, caching, events, metrics, notifications, sharding, transitions, views
+from digital_queue_app.archive import archive_tokens
+from digital_queue_app.eta import QueueEstimator
+from digital_queue_app.models import ArchivedToken, Counter, Queue, Token, TokenTransition
+from digital_queue_app.positions import QueuePositions
+from digital_queue_app.serializers import TOKEN_ROW, TokenSerializer
+from digital_queue_app.views import allocate_token_number, get_next_token
+
+
+SEED_BATCH = 10000
+
+
+# ---------------- Helpers ----------------
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "samples": len(samples),
+        "p50_ms": round(statistics.median(samples) * 1000, 3),
+        "p95_ms": round(samples[max(int(len(samples) * 0.95) - 1, 0)] * 1000, 3),
+        "p99_ms": round(samples[max(int(len(samples) * 0.99) - 1, 0)] * 1000, 3),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+def timed(fn, samples):
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return timings
+
+def seed_tokens(queue, count, status="WAITING", priority=1):
+    queue.refresh_from_db(fields=["last_token_number"])
+    start = queue.last_token_number + 1
+    for offset in range(0, count, SEED_BATCH):
+        Token.objects.bulk_create([
+            Token(queue=queue, token_number=n, status=status, priority=priority)
+            for n in range(start + offset, start + min(offset + SEED_BATCH, count))
+        ])
+    queue.last_token_number += count
+    Queue.objects.filter(id=queue.id).update(last_token_number=queue.last_token_number)
+
+
+# ---------------- Scenarios ----------------
+def bench_join(options):
+    client = APIClient()
+    queue = Queue.objects.create(name="bench-join")
+    results = []
+    for size in options["sizes"]:
+        seed_tokens(queue, max(size - Token.objects.filter(queue=queue).count(), 0), status="COMPLETED")
+
+        def join():
+            client.post("/join/", {"queue": queue.id, "user_name": "bench", "phone_number": "0"}, format="json")
+
+        results.append({
+            "table_rows": size,
+            "allocate": summarize(timed(lambda: allocate_token_number(queue), options["samples"])),
+            "join": summarize(timed(join, options["samples"])),
+        })
+    return results
+
+
+def bench_bulk(options):
+    client = APIClient()
+    queue = Queue.objects.create(name="bench-bulk")
+    batch = options["batch"]
+    entry = {"queue": queue.id, "user_name": "bench", "phone_number": "0"}
+
+    start = time.perf_counter()
+    single_ids = [
+        client.post("/join/", entry, format="json").data["token"]["id"] for _ in range(batch)
+    ]
+    single_join = time.perf_counter() - start
+
+    start = time.perf_counter()
+    response = client.post("/join/bulk/", {"tokens": [entry] * batch}, format="json")
+    bulk_join = time.perf_counter() - start
+    bulk_ids = [result["token"]["id"] for result in response.data["results"]]
+
+    start = time.perf_counter()
+    for token_id in single_ids:
+        client.post(f"/skip/{token_id}/")
+    single_skip = time.perf_counter() - start
+
+    start = time.perf_counter()
+    client.post("/skip/bulk/", {"token_ids": bulk_ids}, format="json")
+    bulk_skip = time.perf_counter() - start
+
+    def rate(seconds):
+        return round(batch / seconds, 1)
+
+    return {
+        "batch": batch,
+        "join_tokens_per_second": {"single": rate(single_join), "bulk": rate(bulk_join)},
+        "skip_tokens_per_second": {"single": rate(single_skip), "bulk": rate(bulk_skip)},
+    }
+
+
+def synthesize_history(queue, counters, count, rng, mean_service=300.0):
+    # Serve `count` arrivals with the real dispatch order (priority, then number)
+    # on counters of uneven speed, and store them as completed tokens.
+    speeds = {counter.id: mean_service * rng.uniform(0.5, 1.5) for counter in counters}
+    clock = timezone.now() - timedelta(days=30)
+    arrivals = []
+    for number in range(1, count + 1):
+        clock += timedelta(seconds=rng.expovariate(len(counters) / mean_service * 0.95))
+        arrivals.append((clock, number, rng.choices([1, 2, 3], [85, 12, 3])[0]))
+
+    free_at = {counter_id: arrivals[0][0] for counter_id in speeds}
+    waiting, rows, i = [], [], 0
+    while i < len(arrivals) or waiting:
+        counter_id = min(free_at, key=free_at.get)
+        now = free_at[counter_id]
+        while i < len(arrivals) and arrivals[i][0] <= now:
+            created_at, number, priority = arrivals[i]
+            heapq.heappush(waiting, (-priority, number, created_at))
+            i += 1
+        if not waiting:
+            free_at[counter_id] = arrivals[i][0]
+            continue
+        priority, number, created_at = heapq.heappop(waiting)
+        completed_at = now + timedelta(seconds=rng.expovariate(1 / speeds[counter_id]))
+        free_at[counter_id] = completed_at
+        rows.append(Token(
+            queue=queue, token_number=number, priority=-priority, status="COMPLETED", counter_id=counter_id,
+            created_at=created_at, called_at=now, completed_at=completed_at,
+        ))
+    Token.objects.bulk_create(rows, batch_size=SEED_BATCH)
+
+def bench_eta(options):
+    rng = random.Random(7)
+    queue = Queue.objects.create(name="bench-eta", avg_handle_time=5)
+    counters = [Counter.objects.create(name=f"eta-{n}", queue=queue) for n in range(options["counters"])]
+    synthesize_history(queue, counters, options["history"], rng)
+
+    # replay joins, calls and completions in time order, predicting each wait at join time
+    timeline = []
+    history = Token.objects.filter(queue=queue).values_list(
+        'token_number', 'priority', 'counter_id', 'created_at', 'called_at', 'completed_at'
+    )
+    for row in history.iterator(chunk_size=SEED_BATCH):
+        created_at, called_at, completed_at = row[3:]
+        timeline += [(created_at, 0, row), (called_at, 1, row), (completed_at, 2, row)]
+    timeline.sort(key=lambda event: event[:2])
+
+    index = QueuePositions()
+    estimator = QueueEstimator(queue.avg_handle_time * 60, [counter.id for counter in counters])
+    static_errors, engine_errors, cost = [], [], 0.0
+    for _, kind, (number, priority, counter_id, created_at, called_at, completed_at) in timeline:
+        if kind == 0:
+            start = time.perf_counter()
+            ahead, _ = index.rank(priority, number)
+            predicted = estimator.wait_seconds(ahead)
+            cost += time.perf_counter() - start
+
+            actual = (called_at - created_at).total_seconds()
+            engine_errors.append(abs(predicted - actual) / 60)
+            static_errors.append(abs(ahead * queue.avg_handle_time * 60 - actual) / 60)
+            index.add(priority, number)
+        elif kind == 1:
+            index.remove(priority, number)
+        else:
+            estimator.record_service(counter_id, (completed_at - called_at).total_seconds())
+
+    def accuracy(errors):
+        errors = sorted(errors)
+        return {
+            "mean_abs_error_mins": round(statistics.fmean(errors), 2),
+            "p90_abs_error_mins": round(errors[int(len(errors) * 0.9)], 2),
+        }
+
+    return {
+        "tokens": options["history"],
+        "counters": options["counters"],
+        "static_avg_handle_time": accuracy(static_errors),
+        "ewma_engine": accuracy(engine_errors),
+        "engine_us_per_estimate": round(cost / len(engine_errors) * 1e6, 2),
+    }
+
+
+def legacy_get_next_token(queue, locked=False):
+    # Pre-0005 dispatch: one probe per hardcoded priority level.
+    for p in [3, 2, 1]:
+        token = Token.objects.filter(queue=queue, status="WAITING", priority=p).order_by('token_number').first()
+        if token:
+            return token
+    return None
+
+def bench_dispatch(options):
+    client = APIClient()
+    idle = Queue.objects.create(name="bench-idle")
+    queue = Queue.objects.create(name="bench-dispatch")
+    seed_tokens(queue, options["waiting"])
+    samples = options["samples"]
+    results = {"waiting_tokens": options["waiting"]}
+
+    for label, dispatch in (("before", legacy_get_next_token), ("after", get_next_token)):
+        Counter.objects.bulk_create(Counter(name=f"{label}-{n}", queue=queue) for n in range(samples))
+
+        def call_next():
+            client.post("/next/", {"queue_id": queue.id}, format="json")
+
+        with mock.patch.object(views, "get_next_token", dispatch):
+            results[label] = {
+                "dispatch_idle_queue": summarize(timed(lambda: dispatch(idle), samples)),
+                "dispatch": summarize(timed(lambda: dispatch(queue), samples)),
+                "call_next": summarize(timed(call_next, samples)),
+            }
+    return results
+
+
+def bench_polling(options):
+    # Status polls from every waiting customer, with a call_next every
+    # --call-every polls, to show the response cache hit ratio under load.
+    client = APIClient()
+    queue = Queue.objects.create(name="bench-polling")
+    Counter.objects.bulk_create(Counter(name=f"poll-{n}", queue=queue) for n in range(options["samples"]))
+    seed_tokens(queue, options["waiting"])
+    token_ids = list(Token.objects.filter(queue=queue).values_list("id", flat=True)[:1000])
+    caching.reset_stats()
+
+    polls = []
+    for n in range(options["samples"] * options["call_every"]):
+        if n % options["call_every"] == 0:
+            client.post("/next/", {"queue_id": queue.id}, format="json")
+        token_id = random.choice(token_ids)
+        start = time.perf_counter()
+        client.get(f"/my-token/{token_id}/")
+        client.get(f"/serving/{queue.id}/")
+        polls.append(time.perf_counter() - start)
+    return {"waiting_tokens": options["waiting"], "poll_pair": summarize(polls), "cache": caching.stats()}
+
+
+def bench_notifications(options):
+    # call_next without and with notifications (sent by the worker pool through
+    # the fake transport), and the status polls --customers waiting customers
+    # send while the queue is served: each one polling after every call, or
+    # once on joining and then once per text they get.
+    client = APIClient()
+    customers = options["customers"]
+    results = {"customers": customers}
+    fake = "digital_queue_app.notifications.FakeTransport"
+    # a warm-up round first, so neither measured one pays for cold caches
+    for label, transport in (("warm-up", fake), ("without", None), ("with", fake)):
+        with override_settings(QUEUE_NOTIFICATION_TRANSPORT=transport):
+            notifications.reset()
+            queue = Queue.objects.create(name=f"bench-notifications-{label}")
+            Counter.objects.create(name="C1", queue=queue)
+            seed_tokens(queue, customers)
+            token_ids = list(Token.objects.filter(queue=queue).order_by("token_number").values_list("id", flat=True))
+
+            calls, polls, texts = [], 0, 0
+            woken = token_ids if transport else []
+            for step in range(customers):
+                for token_id in woken:
+                    client.get(f"/my-token/{token_id}/")
+                polls += len(woken)
+                start = time.perf_counter()
+                client.post("/next/", {"queue_id": queue.id}, format="json")
+                calls.append(time.perf_counter() - start)
+                client.post(f"/complete/{queue.id}/", {}, format="json")
+                if transport:
+                    dispatcher = notifications.get_dispatcher()
+                    dispatcher.flush()
+                    sent, dispatcher.transport.sent = dispatcher.transport.sent, []
+                    texts += len(sent)
+                    woken = [notification.token_id for notification in sent]
+                else:
+                    woken = token_ids[step + 1:]
+            results[label] = {"call_next": summarize(calls), "status_polls": polls, "texts": texts}
+
+    del results["warm-up"]
+    # all call_next itself does on commit: hand the queue over to the pool. The
+    # p50 difference above is within run-to-run noise (the tables grow between runs).
+    with override_settings(QUEUE_NOTIFICATION_TRANSPORT=fake):
+        dispatcher = notifications.get_dispatcher()
+        enqueue = timed(lambda: dispatcher.submit([queue.id]), options["samples"])
+        dispatcher.flush()
+    results["enqueue_p50_us"] = round(statistics.median(enqueue) * 1e6, 1)
+    notifications.reset()
+    results["call_next_added_p50_ms"] = round(results["with"]["call_next"]["p50_ms"] - results["without"]["call_next"]["p50_ms"], 3)
+    results["status_polls_saved"] = round(1 - results["with"]["status_polls"] / results["without"]["status_polls"], 4)
+    return results
+
+
+def bench_serializers(options):
+    # Serializing --tokens tokens for list_tokens: TokenSerializer on model
+    # instances against the TOKEN_ROW row serializer, with and without the
+    # query, and checking the rendered JSON is byte for byte the same.
+    queue = Queue.objects.create(name="bench-serializers")
+    Counter.objects.create(name="ser-1", queue=queue)
+    seed_tokens(queue, options["tokens"])
+    Token.objects.filter(queue=queue, token_number__lte=options["tokens"] // 2).update(
+        status="COMPLETED", called_at=timezone.now()
+    )
+    tokens = Token.objects.filter(queue=queue).order_by("created_at", "id")
+    instances, rows = list(tokens), list(TOKEN_ROW.rows(tokens))
+    renderer = JSONRenderer()
+    samples = max(options["samples"] // 20, 5)
+
+    def model_path(objects):
+        return renderer.render(TokenSerializer(objects, many=True).data)
+
+    def row_path(values):
+        return renderer.render(TOKEN_ROW.data(values))
+
+    model = summarize(timed(lambda: model_path(instances), samples))
+    row = summarize(timed(lambda: row_path(rows), samples))
+    return {
+        "tokens": options["tokens"],
+        "identical_output": model_path(instances) == row_path(rows),
+        "serialize_and_render": {"model_serializer": model, "row_serializer": row,
+                                 "speedup": round(model["p50_ms"] / row["p50_ms"], 1)},
+        "with_query": {
+            "model_serializer": summarize(timed(lambda: model_path(list(tokens)), samples)),
+            "row_serializer": summarize(timed(lambda: row_path(list(TOKEN_ROW.rows(tokens))), samples)),
+        },
+    }
+
+
+def bench_archive(options):
+    # Hot paths on a queue whose Token table is mostly finished history,
+    # before and after archive_tokens moves that history out.
+    client = APIClient()
+    queue = Queue.objects.create(name="bench-archive")
+    seed_tokens(queue, options["history"], status="COMPLETED")
+    Token.objects.filter(queue=queue).update(created_at=timezone.now() - timedelta(days=2))
+    seed_tokens(queue, options["waiting"])
+    token_id = Token.objects.filter(queue=queue, status="WAITING").order_by("-token_number").values_list("id", flat=True)[0]
+    samples = options["samples"]
+
+    def hot_paths(label):
+        Counter.objects.bulk_create(Counter(name=f"{label}-{n}", queue=queue) for n in range(samples))
+        return {
+            "token_rows": Token.objects.count(),
+            "join": summarize(timed(lambda: client.post(
+                "/join/", {"queue": queue.id, "user_name": "bench", "phone_number": "0"}, format="json"
+            ), samples)),
+            "call_next": summarize(timed(lambda: client.post("/next/", {"queue_id": queue.id}, format="json"), samples)),
+            "current_serving": summarize(timed(lambda: views.current_serving_data(queue.id), samples)),
+            "my_token_status": summarize(timed(lambda: views.my_token_status_data(token_id), samples)),
+            "list_waiting": summarize(timed(lambda: client.get("/tokens/", {"queue": queue.id, "status": "WAITING"}), samples)),
+        }
+
+    results = {"history": options["history"], "waiting_tokens": options["waiting"], "before": hot_paths("before")}
+    start = time.perf_counter()
+    archived = archive_tokens(timezone.now() - timedelta(days=1))
+    seconds = time.perf_counter() - start
+    results["archive"] = {"tokens": archived, "seconds": round(seconds, 3), "tokens_per_second": round(archived / seconds)}
+    results["after"] = hot_paths("after")
+    return results
+
+
+def bench_metrics(options):
+    # Per-request cost of MetricsMiddleware: the same cached status poll with
+    # and without it, plus the bare recording call.
+    queue = Queue.objects.create(name="bench-metrics")
+    seed_tokens(queue, 100)
+    token_id = Token.objects.filter(queue=queue).values_list("id", flat=True)[0]
+    samples = options["samples"] * 10
+    without = [m for m in settings.MIDDLEWARE if m != "digital_queue_app.middleware.MetricsMiddleware"]
+
+    results = {}
+    for label, middleware in (("without", without), ("with", settings.MIDDLEWARE)):
+        with override_settings(MIDDLEWARE=middleware):
+            client = APIClient()
+            client.get(f"/my-token/{token_id}/")
+            results[label] = summarize(timed(lambda: client.get(f"/my-token/{token_id}/"), samples))
+
+    tracker = metrics.QueryTracker()
+    record = timed(lambda: metrics.record_request("bench", "GET", 200, 0.001, tracker), samples)
+    results["overhead_p50_us"] = round((results["with"]["p50_ms"] - results["without"]["p50_ms"]) * 1000, 1)
+    results["record_request_p50_us"] = round(statistics.median(record) * 1e6, 2)
+    return results
+
+
+def bench_analytics(options):
+    # A year-long report over --history archived tokens spread across --days:
+    # cold (every day computed), then warm (every day cached), with the peak
+    # memory of the cold run.
+    rng = random.Random(7)
+    queue = Queue.objects.create(name="bench-analytics")
+    counters = Counter.objects.bulk_create(Counter(name=f"C{n}", queue=queue) for n in range(options["counters"]))
+    end = timezone.localdate()
+    start = end - timedelta(days=options["days"] - 1)
+    first = analytics.day_bounds(start)[0]
+    span = options["days"] * 86400
+
+    # past every shard's id range, so they never collide with the tokens bench_archive archives
+    base = len(sharding.shards()) * sharding.ID_SPAN
+    rows = []
+    for number in range(1, options["history"] + 1):
+        created_at = first + timedelta(seconds=rng.uniform(0, span))
+        called_at = created_at + timedelta(seconds=rng.expovariate(1 / 900))
+        skipped = rng.random() < 0.05
+        rows.append(ArchivedToken(
+            token_id=base + number, queue=queue, token_number=number, priority=1,
+            status="SKIPPED" if skipped else "COMPLETED", counter_id=rng.choice(counters).id,
+            created_at=created_at, called_at=called_at,
+            completed_at=None if skipped else called_at + timedelta(seconds=rng.expovariate(1 / 300)),
+            user_name="bench", phone_number="0",
+        ))
+        if len(rows) == SEED_BATCH:
+            ArchivedToken.objects.bulk_create(rows)
+            rows = []
+    ArchivedToken.objects.bulk_create(rows)
+
+    caching._cache().clear()
+    started = time.perf_counter()
+    analytics.report(queue.id, start, end)
+    cold = time.perf_counter() - started
+    # again under tracemalloc, which would slow down the timed run
+    caching._cache().clear()
+    tracemalloc.start()
+    analytics.report(queue.id, start, end)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    warm = timed(lambda: analytics.report(queue.id, start, end), 10)
+    return {
+        "tokens": options["history"],
+        "days": options["days"],
+        "cold_seconds": round(cold, 3),
+        "cold_rows_per_second": round(options["history"] / cold),
+        "cold_peak_mb": round(peak / 2 ** 20, 1),
+        "warm": summarize(warm),
+    }
+
+
+def bench_transitions(options):
+    # Cost of the transition log per transition: join, call and complete
+    # through the views and a bulk join with the log off and on, then how fast
+    # replay() folds the log back.
+    client = APIClient()
+    samples = options["samples"]
+    batch = options["batch"]
+
+    results = {}
+    # a warm-up round first, so neither measured one pays for cold caches
+    for label, log in (("warm-up", True), ("without", False), ("with", True)):
+        with override_settings(QUEUE_TRANSITION_LOG=log):
+            queue = Queue.objects.create(name=f"bench-transitions-{label}")
+            Counter.objects.create(name="C1", queue=queue)
+            entry = {"queue": queue.id, "user_name": "bench", "phone_number": "0"}
+            results[label] = {
+                "join": summarize(timed(lambda: client.post("/join/", entry, format="json"), samples)),
+                "call_next": summarize(timed(lambda: (
+                    client.post("/next/", {"queue_id": queue.id}, format="json"),
+                    client.post(f"/complete/{queue.id}/", {}, format="json"),
+                ), samples)),
+                "bulk_join": summarize(timed(lambda: client.post("/join/bulk/", {"tokens": [entry] * batch}, format="json"), 10)),
+            }
+
+    del results["warm-up"]
+
+    def overhead_us(name, per=1):
+        return round((results["with"][name]["p50_ms"] - results["without"][name]["p50_ms"]) * 1000 / per, 1)
+
+    results["overhead_per_transition_us"] = {
+        "join": overhead_us("join"),
+        "call_and_complete": overhead_us("call_next", 2),
+        "bulk_join": overhead_us("bulk_join", batch),
+    }
+
+    token = Token.objects.filter(queue__name="bench-transitions-with").first()
+    # inside a transaction, as in the views: the INSERT without its own commit
+    with transaction.atomic():
+        record = timed(lambda: transitions.record([token], "skipped"), samples)
+    results["record_p50_us"] = round(statistics.median(record) * 1e6, 1)
+
+    rows = TokenTransition.objects.count()
+    start = time.perf_counter()
+    transitions.replay()
+    seconds = time.perf_counter() - start
+    results["replay"] = {"rows": rows, "seconds": round(seconds, 3), "rows_per_second": round(rows / seconds)}
+    return results
+
+
+async def open_stream(app, path, on_chunk, closed):
+    # Minimal ASGI client: one request, then stay connected until `closed` is set.
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await closed.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.body" and message.get("body"):
+            on_chunk()
+
+    await app(http_scope(path), receive, send)
+
+def http_scope(path):
+    return {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+        "scheme": "http", "path": path, "raw_path": path.encode(), "query_string": b"",
+        "headers": [(b"host", b"testserver")], "server": ("testserver", 80), "client": ("127.0.0.1", 0),
+    }
+
+async def run_subscribers(options):
+    app = ASGIHandler()
+    client = APIClient()
+    queue = await Queue.objects.acreate(name="bench-subscribers")
+    await Counter.objects.acreate(name="sub-1", queue=queue)
+    await sync_to_async(seed_tokens)(queue, 10)
+
+    count = options["subscribers"]
+    chunks = 0
+    closed = asyncio.Event()
+
+    def on_chunk():
+        nonlocal chunks
+        chunks += 1
+
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    start = time.perf_counter()
+    streams = [asyncio.create_task(open_stream(app, f"/serving/{queue.id}/events/", on_chunk, closed)) for _ in range(count)]
+    while chunks < count:
+        await asyncio.sleep(0.01)
+    connect_seconds = time.perf_counter() - start
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # one call_next fans out to every idle subscriber
+    chunks = 0
+    start = time.perf_counter()
+    await sync_to_async(client.post)("/next/", {"queue_id": queue.id}, format="json")
+    while chunks < count:
+        await asyncio.sleep(0.001)
+    fanout_seconds = time.perf_counter() - start
+
+    closed.set()
+    await asyncio.gather(*streams)
+    return {
+        "subscribers": count,
+        "connect_seconds": round(connect_seconds, 3),
+        "bytes_per_subscriber": (after - before) // count,
+        "fanout_ms": round(fanout_seconds * 1000, 3),
+        "remaining_subscriptions": events.get_broker().subscriber_count(),
+    }
+
+def bench_subscribers(options):
+    return async_to_sync(run_subscribers)(options)
+
+
+def rss_bytes():
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return None
+
+def wsgi_get(app, path):
+    environ = {
+        "REQUEST_METHOD": "GET", "PATH_INFO": path, "QUERY_STRING": "", "SERVER_NAME": "testserver",
+        "SERVER_PORT": "80", "SERVER_PROTOCOL": "HTTP/1.1", "wsgi.url_scheme": "http",
+        "wsgi.input": io.BytesIO(), "wsgi.errors": sys.stderr,
+    }
+    status = []
+    response = app(environ, lambda line, headers: status.append(line))
+    b"".join(response)
+    response.close()
+    return int(status[0][:3])
+
+async def asgi_get(app, path):
+    status, messages = [], [{"type": "http.request", "body": b"", "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop()
+        # the handler listens for a disconnect until the response is sent
+        await asyncio.Future()
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            status.append(message["status"])
+
+    await app(http_scope(path), receive, send)
+    return status[0]
+
+def deployment_report(connections, timings, errors, seconds, traced, rss):
+    return {
+        "connections": connections,
+        "requests": len(timings),
+        "errors": errors,
+        "throughput_rps": round(len(timings) / seconds, 1),
+        **summarize(timings),
+        "traced_bytes_per_connection": traced // connections,
+        "rss_bytes_per_connection": rss // connections if rss is not None else None,
+    }
+
+# Every client makes one request and parks until all of them are connected,
+# so memory is read with every connection open at once.
+
+def run_wsgi_clients(app, paths, connections, samples):
+    connected, release = threading.Barrier(connections + 1), threading.Event()
+    timings, errors = [], []
+
+    def client():
+        for n in range(samples):
+            begin = time.perf_counter()
+            status = wsgi_get(app, random.choice(paths))
+            timings.append(time.perf_counter() - begin)
+            if status != 200:
+                errors.append(status)
+            if n == 0:
+                connected.wait()
+                release.wait()
+
+    tracemalloc.start()
+    traced, rss = tracemalloc.get_traced_memory()[0], rss_bytes()
+    start = time.perf_counter()
+    threads = [threading.Thread(target=client) for _ in range(connections)]
+    for thread in threads:
+        thread.start()
+    connected.wait()
+    traced, rss = tracemalloc.get_traced_memory()[0] - traced, rss and rss_bytes() - rss
+    tracemalloc.stop()
+    release.set()
+    for thread in threads:
+        thread.join()
+    return deployment_report(connections, timings, len(errors), time.perf_counter() - start, traced, rss)
+
+async def run_asgi_clients(app, paths, connections, samples):
+    connected, release = 0, asyncio.Event()
+    timings, errors = [], []
+
+    async def client():
+        nonlocal connected
+        for n in range(samples):
+            begin = time.perf_counter()
+            status = await asgi_get(app, random.choice(paths))
+            timings.append(time.perf_counter() - begin)
+            if status != 200:
+                errors.append(status)
+            if n == 0:
+                connected += 1
+                await release.wait()
+
+    tracemalloc.start()
+    traced, rss = tracemalloc.get_traced_memory()[0], rss_bytes()
+    start = time.perf_counter()
+    tasks = [asyncio.create_task(client()) for _ in range(connections)]
+    while connected < connections:
+        await asyncio.sleep(0.001)
+    traced, rss = tracemalloc.get_traced_memory()[0] - traced, rss and rss_bytes() - rss
+    tracemalloc.stop()
+    release.set()
+    await asyncio.gather(*tasks)
+    return deployment_report(connections, timings, len(errors), time.perf_counter() - start, traced, rss)
+
+def bench_deployments(options):
+    # The same status polls through the WSGI handler, one thread per
+    # connection, and through asgi.py's handler, one coroutine per connection
+    # served by the async views. In process, so this compares handler and
+    # view cost rather than servers; load_test --transport wsgi/asgi drives
+    # real ones.
+    from digital_queue_project.asgi import application as asgi_application
+
+    queue = Queue.objects.create(name="bench-deployments")
+    Counter.objects.create(name="deploy-1", queue=queue)
+    seed_tokens(queue, options["waiting"])
+    token_ids = Token.objects.filter(queue=queue).values_list("id", flat=True)[:1000]
+    paths = [f"/my-token/{token_id}/" for token_id in token_ids] + [f"/serving/{queue.id}/"]
+
+    results = {"waiting_tokens": options["waiting"]}
+    for connections in options["connections"]:
+        caching.reset_stats()
+        results[f"wsgi_{connections}"] = run_wsgi_clients(WSGIHandler(), paths, connections, options["samples"])
+        results[f"asgi_{connections}"] = async_to_sync(run_asgi_clients)(asgi_application, paths, connections, options["samples"])
+    return results
+
+
+def burst(app, paths, clients):
+    # every client waits at the barrier, so the polls all miss the freshly
+    # invalidated cache together, like customers reacting to the display
+    start, statuses, timings = threading.Barrier(clients), [], []
+
+    def client(share):
+        start.wait()
+        for path in share:
+            begin = time.perf_counter()
+            statuses.append(wsgi_get(app, path))
+            timings.append(time.perf_counter() - begin)
+
+    threads = [threading.Thread(target=client, args=(paths[n::clients],)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return statuses, timings
+
+def burst_report(statuses, timings):
+    _, _, queries, _, _, _ = metrics._merged()
+    return {
+        "queries": {view: int(queries[view].sum) for view in ("my_token_status", "current_serving") if view in queries},
+        "responses": {str(status): statuses.count(status) for status in sorted(set(statuses))},
+        **summarize(timings),
+        "cache": caching.stats(),
+    }
+
+def bench_burst(options):
+    # --polls status polls released at once right after a call_next, from
+    # --clients threads: half of them serving/, the rest my-token/ spread over
+    # --burst-tokens customers, who each have it open on a few devices.
+    # Compares the database queries with and without request coalescing,
+    # then with the token-bucket limits on.
+    client = APIClient()
+    queue = Queue.objects.create(name="bench-burst")
+    Counter.objects.create(name="burst-1", queue=queue)
+    seed_tokens(queue, options["waiting"])
+    token_ids = list(Token.objects.filter(queue=queue).values_list("id", flat=True)[:options["burst_tokens"]])
+    paths = [f"/serving/{queue.id}/" if n % 2 else f"/my-token/{token_ids[n // 2 % len(token_ids)]}/" for n in range(options["polls"])]
+    random.Random(1).shuffle(paths)
+    app = WSGIHandler()
+
+    results = {"polls": len(paths), "clients": options["clients"]}
+    runs = {
+        "uncoalesced": {"QUEUE_REQUEST_COALESCING": False},
+        "coalesced": {"QUEUE_REQUEST_COALESCING": True},
+        "coalesced_rate_limited": {"QUEUE_REQUEST_COALESCING": True, "QUEUE_RATE_LIMITS": {"token": (1, 5), "queue": (1000, 1000)}},
+    }
+    for label, overrides in runs.items():
+        with override_settings(**overrides):
+            # the call everyone reacts to; also invalidates every cached poll of the queue
+            client.post("/next/", {"queue_id": queue.id}, format="json")
+            client.post(f"/complete/{queue.id}/", {}, format="json")
+            caching.reset_stats()
+            metrics.reset()
+            results[label] = burst_report(*burst(app, paths, options["clients"]))
+    return results
+
+
+SCENARIOS = {
+    "analytics": bench_analytics,
+    "archive": bench_archive,
+    "bulk": bench_bulk,
+    "burst": bench_burst,
+    "deployments": bench_deployments,
+    "dispatch": bench_dispatch,
+    "eta": bench_eta,
+    "join": bench_join,
+    "metrics": bench_metrics,
+    "notifications": bench_notifications,
+    "polling": bench_polling,
+    "serializers": bench_serializers,
+    "subscribers": bench_subscribers,
+    "transitions": bench_transitions,
+}
+
+
+class Command(BaseCommand):
+    help = "Run hot-path benchmarks against a throwaway test database and print JSON results."
+
+    def add_arguments(self, parser):
+        # checked in handle(): argparse tests an empty list against choices as one value
+        parser.add_argument("scenarios", nargs="*", help=f"Scenarios to run, of {', '.join(sorted(SCENARIOS))} (default: all)")
+        parser.add_argument("--sizes", default="0,100000,1000000", help="Comma separated table sizes to seed")
+        parser.add_argument("--samples", type=int, default=200)
+        parser.add_argument("--waiting", type=int, default=100000, help="Waiting tokens seeded for dispatch")
+        parser.add_argument("--call-every", type=int, default=50, help="Status polls per call_next when polling")
+        parser.add_argument("--batch", type=int, default=500, help="Tokens per bulk request")
+        parser.add_argument("--history", type=int, default=50000, help="Historical tokens replayed for eta / archived / analyzed")
+        parser.add_argument("--counters", type=int, default=3, help="Counters serving the eta replay / analytics queue")
+        parser.add_argument("--days", type=int, default=365, help="Days the analytics history is spread over")
+        parser.add_argument("--customers", type=int, default=100, help="Waiting customers served when comparing notifications")
+        parser.add_argument("--subscribers", type=int, default=5000, help="Idle event stream subscribers")
+        parser.add_argument("--tokens", type=int, default=10000, help="Tokens serialized per sample")
+        parser.add_argument("--connections", default="10,100", help="Comma separated concurrent connections for deployments")
+        parser.add_argument("--polls", type=int, default=5000, help="Status polls in the synchronized burst")
+        parser.add_argument("--clients", type=int, default=200, help="Threads sending the burst")
+        parser.add_argument("--burst-tokens", type=int, default=250, help="Distinct tokens polled in the burst")
+
+    def handle(self, *args, **options):
+        unknown = sorted(set(options["scenarios"]) - set(SCENARIOS))
+        if unknown:
+            raise CommandError(f"unknown scenarios {', '.join(unknown)}; choose from {', '.join(sorted(SCENARIOS))}")
+        options["scenarios"] = options["scenarios"] or sorted(SCENARIOS)
+        options["sizes"] = [int(size) for size in options["sizes"].split(",")]
+        options["connections"] = [int(n) for n in options["connections"].split(",")]
+
+        setup_test_environment(debug=False)
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        try:
+            # the scenarios measure the views, not the limiter (burst sets its own limits)
+            with override_settings(QUEUE_RATE_LIMITS={}):
+                report = {name: SCENARIOS[name](options) for name in options["scenarios"]}
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            teardown_test_environment()
+
+        self.stdout.write(json.dumps(report, indent=2))
@@ -0,0 +1,306 @@
+import http.client
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from itertools import count
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler, get_internal_wsgi_application
+from django.db import connection, connections
+from django.test.utils import override_settings, setup_test_environment, teardown_test_environment
+from django.utils.module_loading import import_string
+from rest_framework.test import APIClient
+
+from digital_queue_app import metrics
+from digital_queue_app.models import Counter, Queue, Token
+from .benchmark_queue import seed_tokens, summarize
+
+try:
+    import uvicorn
+except ImportError:
+    uvicorn = None
+
+
+# Endpoint label -> (weight in the default mix, view name in the metrics)
+OPERATIONS = {
+    "join": (20, "join_queue"),
+    "poll_token": (40, "my_token_status"),
+    "poll_serving": (20, "current_serving"),
+    "call_next": (10, "call_next"),
+    "complete": (10, "complete_token"),
+}
+
+
+# ---------------- Transports ----------------
+class TestClientTransport:
+    def __init__(self):
+        self.client = APIClient()
+
+    def request(self, method, path, data=None):
+        response = self.client.generic(method, path, json.dumps(data) if data is not None else "", "application/json")
+        return response.status_code, response.content
+
+    def close(self):
+        connections.close_all()
+
+
+class HTTPTransport:
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+
+    def request(self, method, path, data=None):
+        body = json.dumps(data) if data is not None else None
+        conn = http.client.HTTPConnection(self.host, self.port, timeout=60)
+        try:
+            conn.request(method, path, body, {"Content-Type": "application/json"} if body else {})
+            response = conn.getresponse()
+            return response.status, response.read()
+        finally:
+            conn.close()
+
+    def close(self):
+        pass
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def start_wsgi_server():
+    server = ThreadedWSGIServer(("127.0.0.1", 0), QuietHandler, allow_reuse_address=False)
+    server.set_app(get_internal_wsgi_application())
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    def stop():
+        server.shutdown()
+        server.server_close()
+    return server.server_address[1], stop
+
+def start_asgi_server():
+    server = uvicorn.Server(uvicorn.Config(import_string(settings.ASGI_APPLICATION), host="127.0.0.1", port=0, log_level="warning", lifespan="off"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+
+    def stop():
+        server.should_exit = True
+        thread.join()
+    return port, stop
+
+
+# ---------------- Workload ----------------
+def seed(options):
+    queues = []
+    for n in range(options["queues"]):
+        queue = Queue.objects.create(name=f"load-{n}")
+        Counter.objects.bulk_create(Counter(name=f"load-{n}-{c}", queue=queue) for c in range(options["counters"]))
+        seed_tokens(queue, options["history"], status="COMPLETED")
+        seed_tokens(queue, options["waiting"])
+        queues.append(queue.id)
+
+    known = list(
+        Token.objects.filter(status="WAITING").order_by("-id").values_list("queue_id", "id")[:1000 * len(queues)]
+    )
+    return queues, known
+
+def parse_mix(value):
+    mix = {name: weight for name, (weight, _) in OPERATIONS.items()}
+    if value:
+        for part in value.split(","):
+            name, _, weight = part.partition("=")
+            if name not in OPERATIONS:
+                raise CommandError(f"Unknown operation {name!r} in --mix, expected {sorted(OPERATIONS)}")
+            mix[name] = float(weight)
+    return mix
+
+def perform(transport, name, queue_id, known, rng, worker):
+    if name == "join":
+        status, body = transport.request("POST", "/join/", {
+            "queue": queue_id, "user_name": f"load-{worker}", "phone_number": str(rng.randrange(10 ** 9))
+        })
+        if status == 201:
+            known.append((queue_id, json.loads(body)["token"]["id"]))
+        return status
+    if name == "poll_token":
+        return transport.request("GET", f"/my-token/{rng.choice(known)[1]}/")[0]
+    if name == "poll_serving":
+        return transport.request("GET", f"/serving/{queue_id}/")[0]
+    if name == "call_next":
+        return transport.request("POST", "/next/", {"queue_id": queue_id})[0]
+    return transport.request("POST", f"/complete/{queue_id}/", {})[0]
+
+def run_workload(transport_factory, queues, known, options):
+    mix = parse_mix(options["mix"])
+    names, weights = list(mix), list(mix.values())
+    budget = count()
+    # one set of counters per client, merged once they are done
+    results = [({name: [] for name in OPERATIONS}, {name: 0 for name in OPERATIONS}) for _ in range(options["clients"])]
+
+    def client(worker):
+        samples, failures = results[worker]
+        rng = random.Random(options["seed"] * 1000 + worker)
+        transport = transport_factory()
+        try:
+            while next(budget) < options["requests"]:
+                name = rng.choices(names, weights)[0]
+                start = time.perf_counter()
+                try:
+                    status = perform(transport, name, rng.choice(queues), known, rng, worker)
+                except Exception:
+                    status = 599
+                samples[name].append(time.perf_counter() - start)
+                # a 404 from complete just means nothing was being served
+                if status >= 500 or (status >= 400 and name != "complete"):
+                    failures[name] += 1
+        finally:
+            transport.close()
+
+    threads = [threading.Thread(target=client, args=(worker,)) for worker in range(options["clients"])]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.perf_counter() - start
+    samples = {name: [timing for worker_samples, _ in results for timing in worker_samples[name]] for name in OPERATIONS}
+    failures = {name: sum(worker_failures[name] for _, worker_failures in results) for name in OPERATIONS}
+    return samples, failures, seconds
+
+def build_report(samples, failures, seconds, options):
+    _, _, queries, _, _, _ = metrics._merged()
+    endpoints = {}
+    for name, timings in samples.items():
+        if not timings:
+            continue
+        view_queries = queries.get(OPERATIONS[name][1])
+        endpoints[name] = {
+            "requests": len(timings),
+            "errors": failures[name],
+            "throughput_rps": round(len(timings) / seconds, 1),
+            **summarize(timings),
+            "queries_per_request": round(view_queries.sum / view_queries.count, 2) if view_queries else None,
+        }
+    total = sum(len(timings) for timings in samples.values())
+    config = {key: options[key] for key in ("transport", "queues", "counters", "waiting", "history", "clients", "requests", "mix", "seed")}
+    return {
+        "config": config,
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(total / seconds, 1),
+        "errors": sum(failures.values()),
+        "endpoints": endpoints,
+    }
+
+
+# ---------------- Comparison ----------------
+def compare(report, baseline, max_regression):
+    """Return the regressions of report against a baseline report, as readable lines."""
+    regressions = []
+    for name, current in report["endpoints"].items():
+        before = baseline.get("endpoints", {}).get(name)
+        if not before:
+            continue
+        for key in ("p50_ms", "p95_ms"):
+            if current[key] > before[key] * (1 + max_regression):
+                regressions.append(f"{name} {key}: {before[key]} -> {current[key]}")
+        if current["throughput_rps"] < before["throughput_rps"] / (1 + max_regression):
+            regressions.append(f"{name} throughput_rps: {before['throughput_rps']} -> {current['throughput_rps']}")
+        if (current["queries_per_request"] or 0) > (before["queries_per_request"] or 0) + 0.5:
+            regressions.append(f"{name} queries_per_request: {before['queries_per_request']} -> {current['queries_per_request']}")
+        error_rate = current["errors"] / current["requests"]
+        if error_rate > before["errors"] / before["requests"] + 0.01:
+            regressions.append(f"{name} errors: {before['errors']}/{before['requests']} -> {current['errors']}/{current['requests']}")
+    return regressions
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway database and drive a mixed join / poll / call_next / complete workload "
+        "through the test client or a real HTTP server. Prints a JSON report; with --compare, "
+        "fails when the run regressed against an earlier report."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--transport", choices=("client", "wsgi", "asgi"), default="wsgi",
+                            help="Django test client, threaded WSGI server, or uvicorn ASGI server")
+        parser.add_argument("--queues", type=int, default=5)
+        parser.add_argument("--counters", type=int, default=10, help="Counters per queue")
+        parser.add_argument("--waiting", type=int, default=10000, help="Waiting tokens seeded per queue")
+        parser.add_argument("--history", type=int, default=100000, help="Completed tokens seeded per queue")
+        parser.add_argument("--clients", type=int, default=16, help="Concurrent clients")
+        parser.add_argument("--requests", type=int, default=5000, help="Total requests across all clients")
+        parser.add_argument("--mix", default="", help="Operation weights, e.g. join=20,poll_token=40,call_next=10")
+        parser.add_argument("--seed", type=int, default=1)
+        parser.add_argument("--db-file", help="SQLite file for the test database (default: a temporary file)")
+        parser.add_argument("--output", help="Also write the report to this file")
+        parser.add_argument("--compare", help="Earlier report to compare against")
+        parser.add_argument("--max-regression", type=float, default=0.25,
+                            help="Allowed slowdown before --compare fails, as a fraction")
+
+    def handle(self, *args, **options):
+        if options["transport"] == "asgi" and uvicorn is None:
+            raise CommandError("--transport asgi needs uvicorn installed (pip install uvicorn)")
+
+        baseline = None
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                baseline = json.load(f)
+
+        # worker threads need a database they can share, which in-memory SQLite is not
+        temp_dir = None
+        if connection.vendor == "sqlite":
+            if not options["db_file"]:
+                temp_dir = tempfile.TemporaryDirectory()
+                options["db_file"] = os.path.join(temp_dir.name, "load_test.sqlite3")
+            connection.settings_dict.setdefault("TEST", {})["NAME"] = options["db_file"]
+
+        setup_test_environment(debug=False)
+        # restored by teardown_test_environment()
+        settings.ALLOWED_HOSTS = [*settings.ALLOWED_HOSTS, "127.0.0.1"]
+        # every client connects from 127.0.0.1, which the per-IP limit would throttle
+        same_ip = override_settings(QUEUE_RATE_LIMITS={**getattr(settings, "QUEUE_RATE_LIMITS", {}), "ip": None})
+        same_ip.enable()
+        old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+        for alias in connections:
+            # point the replica (if any) at the throwaway database too
+            if connections[alias].settings_dict.get("TEST", {}).get("MIRROR") == "default":
+                connections[alias].creation.set_as_test_mirror(connection.settings_dict)
+        try:
+            queues, known = seed(options)
+            metrics.reset()
+            if options["transport"] == "client":
+                samples, failures, seconds = run_workload(TestClientTransport, queues, known, options)
+            else:
+                port, stop = start_wsgi_server() if options["transport"] == "wsgi" else start_asgi_server()
+                try:
+                    samples, failures, seconds = run_workload(lambda: HTTPTransport("127.0.0.1", port), queues, known, options)
+                finally:
+                    stop()
+            report = build_report(samples, failures, seconds, options)
+        finally:
+            connections.close_all()
+            connection.creation.destroy_test_db(old_name, verbosity=0)
+            same_ip.disable()
+            teardown_test_environment()
+            if temp_dir:
+                temp_dir.cleanup()
+
+        output = json.dumps(report, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output + "\n")
+        self.stdout.write(output)
+
+        if baseline is not None:
+            regressions = compare(report, baseline, options["max_regression"])
+            if regressions:
+                raise CommandError("Performance regressions:\n  " + "\n  ".join(regressions))
+            self.stderr.write("No regressions against " + options["compare"])
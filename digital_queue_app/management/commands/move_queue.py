@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from digital_queue_app.models import Queue
+from digital_queue_app.rebalance import move_queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Move a queue with its counters, tokens, archive and stats to another shard "
+        "(one of QUEUE_SHARDS) while it stays in use; it is locked only for the final switch."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue_id", type=int)
+        parser.add_argument("shard", help="Database alias to move the queue to")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Finished tokens copied per batch")
+
+    def handle(self, *args, **options):
+        try:
+            moved = move_queue(options["queue_id"], options["shard"], options["batch_size"])
+        except (ValueError, Queue.DoesNotExist) as e:
+            raise CommandError(str(e))
+        self.stdout.write(
+            f"Moved queue {moved['queue']} from {moved['source']} to {moved['target']} "
+            f"({moved['tokens']} tokens, {moved['archived']} archived)"
+        )
@@ -0,0 +1,35 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from digital_queue_app import analytics, sharding
+from digital_queue_app.models import Queue
+
+
+class Command(BaseCommand):
+    help = (
+        "Print throughput per hour, wait and service time percentiles, skip rates and counter "
+        "utilization of queues as JSON, for tokens created between --from and --to (dates, both included)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue_ids", nargs="*", type=int, help="Queues to report on (default: all)")
+        parser.add_argument("--from", dest="start", help="First day, default 6 days before --to")
+        parser.add_argument("--to", dest="end", help="Last day, default today")
+
+    def handle(self, *args, **options):
+        try:
+            start, end = analytics.date_range(options["start"], options["end"])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        queue_ids = options["queue_ids"] or [
+            queue_id for alias in sharding.shards() for queue_id in Queue.objects.using(alias).values_list('id', flat=True)
+        ]
+        reports = []
+        for queue_id in queue_ids:
+            with sharding.using(sharding.shard_for_queue(queue_id)):
+                if not Queue.objects.filter(id=queue_id).exists():
+                    raise CommandError(f"Queue {queue_id} not found")
+                reports.append(analytics.report(queue_id, start, end))
+        self.stdout.write(json.dumps(reports, indent=2))
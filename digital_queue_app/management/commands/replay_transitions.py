@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from digital_queue_app import transitions
+
+
+class Command(BaseCommand):
+    help = (
+        "Rebuild every queue's state and statistics from the token transition log in one streaming pass "
+        "and print them as JSON. --check lists tokens whose status differs from the log, --repair sets "
+        "them back to it (restart the web workers afterwards to drop their in-process indexes)."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--queue", type=int, action="append", dest="queues", help="Only this queue (repeatable)")
+        parser.add_argument("--check", action="store_true", help="Compare the Token table with the log")
+        parser.add_argument("--repair", action="store_true", help="Set tokens that differ from the log to its status")
+        parser.add_argument("--chunk-size", type=int, default=transitions.REPLAY_CHUNK, help="Log rows fetched per round trip")
+
+    def handle(self, *args, **options):
+        if options["check"] or options["repair"]:
+            found = transitions.drift(options["queues"])
+            for token_id, (queue_id, status, logged, _) in sorted(found.items()):
+                self.stdout.write(f"Token {token_id} of queue {queue_id}: {status or 'missing'}, log says {logged}")
+            if options["repair"]:
+                self.stdout.write(f"Repaired {transitions.repair(found)} tokens")
+            else:
+                self.stdout.write(f"{len(found)} tokens differ from the log")
+            return
+
+        states, _ = transitions.replay(options["queues"], chunk_size=options["chunk_size"])
+        self.stdout.write(json.dumps([states[queue_id].summary() for queue_id in sorted(states)], indent=2))
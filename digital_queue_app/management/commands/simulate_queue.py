@@ -0,0 +1,56 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from digital_queue_app import sharding, simulation
+from digital_queue_app.models import Queue
+
+
+def priority_mix(value):
+    """'1:85,2:12,3:3' -> {1: 85.0, 2: 12.0, 3: 3.0}"""
+    try:
+        return {int(p): float(w) for p, w in (part.split(":") for part in value.split(","))}
+    except ValueError:
+        raise CommandError("--priority-mix must look like 1:85,2:12,3:3")
+
+
+class Command(BaseCommand):
+    help = (
+        "Simulate a queue's dispatch policy offline with arrivals, priority mix and service times "
+        "fitted from its recent tokens, for each number of --counters, and print wait time "
+        "percentiles per priority as JSON."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("queue_id", type=int)
+        parser.add_argument("--counters", default="1,2,3,4", help="Comma separated numbers of open counters to compare")
+        parser.add_argument("--days", type=int, default=1000, help="Simulated days per number of counters")
+        parser.add_argument("--fit-days", type=int, default=30, help="Days of history the model is fitted from")
+        parser.add_argument("--arrival-scale", type=float, default=1.0, help="Multiply the fitted arrival rates")
+        parser.add_argument("--priority-mix", help="Replace the fitted priority mix, e.g. 1:85,2:12,3:3")
+        parser.add_argument("--workers", type=int, help="Processes to run the days on (default: one per CPU)")
+        parser.add_argument("--seed", type=int, default=0)
+
+    def handle(self, *args, **options):
+        try:
+            counters = [int(n) for n in options["counters"].split(",")]
+        except ValueError:
+            raise CommandError("--counters must be comma separated integers")
+        if min(counters) < 1:
+            raise CommandError("--counters must be at least 1")
+
+        with sharding.using(sharding.shard_for_queue(options["queue_id"])):
+            try:
+                queue = Queue.objects.get(id=options["queue_id"])
+            except Queue.DoesNotExist:
+                raise CommandError(f"Queue {options['queue_id']} not found")
+            model = simulation.fit(queue, options["fit_days"])
+        model = model.scaled(options["arrival_scale"])
+        if options["priority_mix"]:
+            model = model.with_mix(priority_mix(options["priority_mix"]))
+
+        results = [
+            simulation.simulate(model, n, options["days"], options["workers"], options["seed"])
+            for n in counters
+        ]
+        self.stdout.write(json.dumps({"model": model.summary(), "results": results}, indent=2))
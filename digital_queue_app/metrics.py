@@ -0,0 +1,271 @@
+"""
+In-process request and queue metrics, exposed in Prometheus text format.
+
+MetricsMiddleware records every request's latency, status and database work
+(query count and time) per view, and the views count token state transitions.
+Each thread writes to its own shard, so recording never takes a lock; the
+shards are only summed when /metrics is scraped. Queue gauges (waiting tokens,
+counter states, actual waits) are read from the database at scrape time.
+
+Counters are per process, like any Prometheus client without a shared
+registry: scrape every worker, or sum them in the query.
+"""
+import threading
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count
+from django.http import HttpResponse
+from django.utils import timezone
+
+from . import caching, sharding
+from .models import Counter, Token
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+WAIT_QUANTILES = (0.5, 0.95)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def merge(self, other):
+        for i, n in enumerate(other.counts):
+            self.counts[i] += n
+        self.sum += other.sum
+        self.count += other.count
+
+
+class Shard:
+    def __init__(self):
+        self.requests = defaultdict(int)
+        self.latency = {}
+        self.queries = {}
+        self.query_seconds = defaultdict(float)
+        self.transitions = defaultdict(int)
+        self.notifications = defaultdict(int)
+
+    def histogram(self, table, key, buckets):
+        histogram = table.get(key)
+        if histogram is None:
+            histogram = table[key] = Histogram(buckets)
+        return histogram
+
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+
+
+def _shard():
+    shard = getattr(_local, "shard", None)
+    if shard is None:
+        # once per thread; every later write goes to this thread's own shard
+        shard = _local.shard = Shard()
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+def reset():
+    with _shards_lock:
+        for shard in _shards:
+            shard.__init__()
+
+
+class QueryTracker:
+    """connection.execute_wrapper() that counts and times queries, and keeps their SQL if asked."""
+
+    def __init__(self, keep_sql=False):
+        self.count = 0
+        self.seconds = 0.0
+        self.statements = [] if keep_sql else None
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+            if self.statements is not None:
+                self.statements.append(sql)
+
+
+_tracker = ContextVar("query_tracker", default=None)
+
+
+def track_queries(execute, sql, params, many, context):
+    """On every connection: feeds the query to the tracker of the request running it, if any."""
+    tracker = _tracker.get()
+    if tracker is None:
+        return execute(sql, params, many, context)
+    return tracker(execute, sql, params, many, context)
+
+def connection_created(sender, connection, **kwargs):
+    # the wrapper list outlives reconnects of the same connection object
+    if track_queries not in connection.execute_wrappers:
+        connection.execute_wrappers.append(track_queries)
+
+@contextmanager
+def tracking(tracker):
+    """
+    Count the queries run in this context into tracker. A ContextVar rather
+    than a wrapper on this thread's connections, so it follows the request's
+    database work into the threads sync_to_async runs it in.
+    """
+    token = _tracker.set(tracker)
+    try:
+        yield tracker
+    finally:
+        _tracker.reset(token)
+
+
+def record_request(view, method, status, seconds, queries=None):
+    shard = _shard()
+    shard.requests[view, method, status] += 1
+    shard.histogram(shard.latency, (view, method), LATENCY_BUCKETS).observe(seconds)
+    if queries is not None:
+        shard.histogram(shard.queries, view, QUERY_BUCKETS).observe(queries.count)
+        shard.query_seconds[view] += queries.seconds
+
+def _count_transition(event_type):
+    _shard().transitions[event_type] += 1
+
+def transition(event_type):
+    transaction.on_commit(lambda: _count_transition(event_type), using=sharding.db())
+
+def notifications(outcome, n=1):
+    _shard().notifications[outcome] += n
+
+
+def _merged():
+    with _shards_lock:
+        shards = list(_shards)
+    requests, transitions, notified, query_seconds = defaultdict(int), defaultdict(int), defaultdict(int), defaultdict(float)
+    latency, queries = {}, {}
+    for shard in shards:
+        # list() copies are atomic, so a writer adding a key cannot break the loop
+        for key, n in list(shard.requests.items()):
+            requests[key] += n
+        for key, n in list(shard.transitions.items()):
+            transitions[key] += n
+        for key, n in list(shard.notifications.items()):
+            notified[key] += n
+        for key, seconds in list(shard.query_seconds.items()):
+            query_seconds[key] += seconds
+        for table, merged, buckets in ((shard.latency, latency, LATENCY_BUCKETS), (shard.queries, queries, QUERY_BUCKETS)):
+            for key, histogram in list(table.items()):
+                merged.setdefault(key, Histogram(buckets)).merge(histogram)
+    return requests, latency, queries, query_seconds, transitions, notified
+
+
+# ---------------- Queue gauges ----------------
+def _wait_window():
+    return timedelta(seconds=getattr(settings, "QUEUE_METRICS_WAIT_WINDOW_SECONDS", 3600))
+
+def quantile(sorted_values, q):
+    return sorted_values[min(int(q * len(sorted_values)), len(sorted_values) - 1)]
+
+def queue_gauges():
+    waiting, counters = [], []
+    # actual waits (created_at -> called_at) of tokens that joined within the window
+    waits = defaultdict(list)
+    for alias in sharding.shards():
+        waiting += (
+            Token.objects.using(alias).filter(status="WAITING")
+            .values_list('queue_id', 'priority').annotate(n=Count('id')).order_by()
+        )
+        counters += Counter.objects.using(alias).values_list('queue_id', 'state', 'is_busy').annotate(n=Count('id')).order_by()
+
+        recent = Token.objects.using(alias).filter(
+            created_at__gte=timezone.now() - _wait_window(), called_at__isnull=False
+        ).values_list('queue_id', 'created_at', 'called_at')
+        for queue_id, created_at, called_at in recent.iterator():
+            waits[queue_id].append((called_at - created_at).total_seconds())
+
+    wait_quantiles = {}
+    for queue_id, values in waits.items():
+        values.sort()
+        wait_quantiles[queue_id] = {q: quantile(values, q) for q in WAIT_QUANTILES}
+    return waiting, counters, wait_quantiles
+
+
+# ---------------- Exposition ----------------
+def _labels(**labels):
+    return "{" + ",".join(f'{name}="{value}"' for name, value in labels.items()) + "}"
+
+def _histogram_lines(name, key_labels, histograms):
+    for key, histogram in sorted(histograms.items()):
+        labels = key_labels(key)
+        cumulative = 0
+        for bound, n in zip(histogram.buckets + ("+Inf",), histogram.counts):
+            cumulative += n
+            yield f"{name}_bucket{_labels(**labels, le=bound)} {cumulative}"
+        yield f"{name}_sum{_labels(**labels)} {histogram.sum}"
+        yield f"{name}_count{_labels(**labels)} {histogram.count}"
+
+def render():
+    requests, latency, queries, query_seconds, transitions, notified = _merged()
+    waiting, counters, wait_quantiles = queue_gauges()
+    cache = caching.stats()
+
+    def family(name, kind, help_text):
+        return [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+
+    lines = family("queue_http_requests_total", "counter", "HTTP requests by view, method and status.")
+    lines += [
+        f"queue_http_requests_total{_labels(view=view, method=method, status=status)} {n}"
+        for (view, method, status), n in sorted(requests.items())
+    ]
+    lines += family("queue_http_request_duration_seconds", "histogram", "Time spent handling a request.")
+    lines += _histogram_lines(
+        "queue_http_request_duration_seconds", lambda key: {"view": key[0], "method": key[1]}, latency
+    )
+    lines += family("queue_db_queries_per_request", "histogram", "Database queries run by one request.")
+    lines += _histogram_lines("queue_db_queries_per_request", lambda key: {"view": key}, queries)
+    lines += family("queue_db_query_seconds_total", "counter", "Time spent in database queries.")
+    lines += [f"queue_db_query_seconds_total{_labels(view=view)} {seconds}" for view, seconds in sorted(query_seconds.items())]
+    lines += family("queue_token_transitions_total", "counter", "Committed token state changes by event.")
+    lines += [f"queue_token_transitions_total{_labels(event=event)} {n}" for event, n in sorted(transitions.items())]
+    lines += family("queue_notifications_total", "counter", "Customer notifications sent, retried and given up on.")
+    lines += [f"queue_notifications_total{_labels(outcome=outcome)} {n}" for outcome, n in sorted(notified.items())]
+
+    lines += family("queue_waiting_tokens", "gauge", "Tokens waiting, by queue and priority.")
+    lines += [f"queue_waiting_tokens{_labels(queue=q, priority=p)} {n}" for q, p, n in sorted(waiting)]
+    lines += family("queue_counters", "gauge", "Counters by queue, state and whether they are busy.")
+    lines += [
+        f"queue_counters{_labels(queue=q, state=state, busy=str(busy).lower())} {n}"
+        for q, state, busy, n in sorted(counters)
+    ]
+    lines += family("queue_actual_wait_seconds", "gauge", "Quantiles of created_at to called_at for recent tokens.")
+    lines += [
+        f"queue_actual_wait_seconds{_labels(queue=q, quantile=quant)} {seconds}"
+        for q, quantiles in sorted(wait_quantiles.items()) for quant, seconds in quantiles.items()
+    ]
+
+    for name in ("hits", "misses", "not_modified"):
+        lines += family(f"queue_response_cache_{name}_total", "counter", f"Polling response cache {name.replace('_', ' ')}.")
+        lines.append(f"queue_response_cache_{name}_total {cache[name]}")
+    return "\n".join(lines) + "\n"
+
+
+def metrics_view(request):
+    return HttpResponse(render(), content_type="text/plain; version=0.0.4; charset=utf-8")
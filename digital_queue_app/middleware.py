@@ -0,0 +1,73 @@
+import logging
+import time
+from collections import Counter
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from . import metrics
+
+
+slow_log = logging.getLogger("digital_queue_app.slow_requests")
+
+
+def view_label(request):
+    match = getattr(request, "resolver_match", None)
+    return match.view_name.rsplit(".", 1)[-1] if match else "unmatched"
+
+
+class MetricsMiddleware:
+    """
+    Feeds digital_queue_app.metrics: latency, status and database work per view.
+
+    With QUEUE_SLOW_QUERY_THRESHOLD = N, a request that runs more than N
+    queries is logged to digital_queue_app.slow_requests together with its
+    repeated statements, which is how lazy per-row loads show up.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_threshold = getattr(settings, "QUEUE_SLOW_QUERY_THRESHOLD", None)
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+
+        start = time.perf_counter()
+        with metrics.tracking(self.tracker()) as tracker:
+            response = self.get_response(request)
+        return self.record(request, response, tracker, time.perf_counter() - start)
+
+    async def __acall__(self, request):
+        # the async views' database work runs in sync_to_async threads, which
+        # get this context and so the tracker; a streaming response's reads
+        # after it is returned are not counted
+        start = time.perf_counter()
+        with metrics.tracking(self.tracker()) as tracker:
+            response = await self.get_response(request)
+        return self.record(request, response, tracker, time.perf_counter() - start)
+
+    def tracker(self):
+        return metrics.QueryTracker(keep_sql=self.slow_threshold is not None)
+
+    def record(self, request, response, tracker, seconds):
+        view = view_label(request)
+        metrics.record_request(view, request.method, response.status_code, seconds, tracker)
+        if self.slow_threshold is not None and tracker.count > self.slow_threshold:
+            self.log_slow(view, request, tracker, seconds)
+        return response
+
+    def log_slow(self, view, request, tracker, seconds):
+        repeated = [(sql, n) for sql, n in Counter(tracker.statements).most_common(3) if n > 1]
+        slow_log.warning(
+            "%s %s ran %d queries (%.1f ms in the database, %.1f ms total); repeated: %s",
+            request.method, request.get_full_path(), tracker.count, tracker.seconds * 1000, seconds * 1000,
+            "; ".join(f"{n}x {sql}" for sql, n in repeated) or "none",
+            extra={"view": view, "queries": tracker.count},
+        )
@@ -0,0 +1,55 @@
+# Generated by Django 6.0 on 2026-10-17 09:12
+
+from django.db import migrations, models
+from django.db.models import Count, Max
+
+
+def renumber_duplicate_tokens(apps, schema_editor):
+    # tokens that lost the allocation race share a number; all but the first
+    # get new numbers past the queue's last, so the constraint can be added
+    db_alias = schema_editor.connection.alias
+    Token = apps.get_model('digital_queue_app', 'Token')
+    tokens = Token.objects.using(db_alias)
+    duplicates = (
+        tokens.order_by().values('queue_id', 'token_number').annotate(n=Count('id')).filter(n__gt=1)
+        .values_list('queue_id', 'token_number')
+    )
+    last = {}
+    for queue_id, token_number in sorted(duplicates):
+        if queue_id not in last:
+            last[queue_id] = tokens.filter(queue_id=queue_id).aggregate(last=Max('token_number'))['last']
+        extra = tokens.filter(queue_id=queue_id, token_number=token_number).order_by('id').values_list('id', flat=True)[1:]
+        for token_id in list(extra):
+            last[queue_id] += 1
+            tokens.filter(id=token_id).update(token_number=last[queue_id])
+
+
+def backfill_last_token_number(apps, schema_editor):
+    db_alias = schema_editor.connection.alias
+    Queue = apps.get_model('digital_queue_app', 'Queue')
+    Token = apps.get_model('digital_queue_app', 'Token')
+    for queue in Queue.objects.using(db_alias):
+        last = Token.objects.using(db_alias).filter(queue=queue).aggregate(last=Max('token_number'))['last']
+        if last:
+            Queue.objects.using(db_alias).filter(id=queue.id).update(last_token_number=last)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0002_token_phone_number_token_user_name'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='last_token_number',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(renumber_duplicate_tokens, migrations.RunPython.noop),
+        migrations.RunPython(backfill_last_token_number, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='token',
+            constraint=models.UniqueConstraint(fields=('queue', 'token_number'), name='unique_token_number_per_queue'),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 6.0 on 2026-10-17 10:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0003_queue_last_token_number_token_unique_token_number_per_queue'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['queue', 'status', 'token_number'], name='token_queue_status_number_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(condition=models.Q(('status', 'WAITING')), fields=['queue', '-priority', 'token_number'], name='token_waiting_dispatch_idx'),
+        ),
+    ]
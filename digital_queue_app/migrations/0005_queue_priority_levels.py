@@ -0,0 +1,19 @@
+# Generated by Django 6.0 on 2026-10-17 11:20
+
+import digital_queue_app.models
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0004_token_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='priority_levels',
+            field=models.JSONField(default=digital_queue_app.models.default_priority_levels),
+        ),
+    ]
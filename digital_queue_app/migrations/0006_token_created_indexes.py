@@ -0,0 +1,21 @@
+# Generated by Django 6.0 on 2026-10-17 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0005_queue_priority_levels'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['created_at', 'id'], name='token_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(fields=['queue', 'created_at', 'id'], name='token_queue_created_idx'),
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 6.0 on 2026-10-17 15:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0006_token_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='token',
+            name='completed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='token',
+            index=models.Index(condition=models.Q(('status', 'COMPLETED')), fields=['queue', '-completed_at'], name='token_completed_recent_idx'),
+        ),
+    ]
@@ -0,0 +1,53 @@
+# Generated by Django 6.0 on 2026-10-17 16:02
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0007_token_completed_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_id', models.BigIntegerField(unique=True)),
+                ('token_number', models.IntegerField()),
+                ('priority', models.IntegerField()),
+                ('status', models.CharField(choices=[('WAITING', 'Waiting'), ('SERVING', 'Serving'), ('SKIPPED', 'Skipped'), ('COMPLETED', 'Completed')], max_length=10)),
+                ('counter_id', models.BigIntegerField(blank=True, null=True)),
+                ('created_at', models.DateTimeField()),
+                ('called_at', models.DateTimeField(blank=True, null=True)),
+                ('completed_at', models.DateTimeField(blank=True, null=True)),
+                ('user_name', models.CharField(max_length=100)),
+                ('phone_number', models.CharField(max_length=15)),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='digital_queue_app.queue')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['queue', 'created_at'], name='archived_queue_created_idx'), models.Index(fields=['queue', '-completed_at'], name='archived_queue_completed_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyQueueStats',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField()),
+                ('completed', models.IntegerField(default=0)),
+                ('skipped', models.IntegerField(default=0)),
+                ('called', models.IntegerField(default=0)),
+                ('total_wait_seconds', models.FloatField(default=0)),
+                ('served', models.IntegerField(default=0)),
+                ('total_service_seconds', models.FloatField(default=0)),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='digital_queue_app.queue')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('queue', 'date'), name='unique_daily_stats_per_queue')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 6.0 on 2026-10-17 17:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0008_archivedtoken_dailyqueuestats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='counter',
+            name='state',
+            field=models.CharField(choices=[('OPEN', 'Open'), ('ON_BREAK', 'On break'), ('CLOSED', 'Closed')], default='OPEN', max_length=10),
+        ),
+    ]
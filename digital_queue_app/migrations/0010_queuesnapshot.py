@@ -0,0 +1,55 @@
+# Generated by Django 6.0 on 2026-10-17 18:05
+
+import django.core.serializers.json
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def build_snapshots(apps, schema_editor):
+    Queue = apps.get_model('digital_queue_app', 'Queue')
+    Counter = apps.get_model('digital_queue_app', 'Counter')
+    Token = apps.get_model('digital_queue_app', 'Token')
+    QueueSnapshot = apps.get_model('digital_queue_app', 'QueueSnapshot')
+
+    def entry(token):
+        return {"id": token.id, "token_number": token.token_number, "priority": token.priority}
+
+    db = schema_editor.connection.alias
+    for queue in Queue.objects.using(db):
+        serving = {
+            token.counter_id: {**entry(token), "called_at": token.called_at}
+            for token in Token.objects.using(db).filter(queue=queue, status="SERVING")
+        }
+        waiting = Token.objects.using(db).filter(queue=queue, status="WAITING")
+        QueueSnapshot.objects.using(db).create(
+            queue=queue,
+            queue_name=queue.name,
+            waiting_count=waiting.count(),
+            counters=[
+                {"id": counter.id, "name": counter.name, "state": counter.state, "serving": serving.get(counter.id)}
+                for counter in Counter.objects.using(db).filter(queue=queue).order_by('id')
+            ],
+            next_tokens=[entry(token) for token in waiting.order_by('-priority', 'token_number')[:5]],
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0009_counter_state'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueSnapshot',
+            fields=[
+                ('queue', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='snapshot', serialize=False, to='digital_queue_app.queue')),
+                ('queue_name', models.CharField(max_length=100)),
+                ('waiting_count', models.IntegerField(default=0)),
+                ('counters', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('next_tokens', models.JSONField(default=list, encoder=django.core.serializers.json.DjangoJSONEncoder)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(build_snapshots, migrations.RunPython.noop),
+    ]
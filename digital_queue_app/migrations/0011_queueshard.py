@@ -0,0 +1,27 @@
+# Generated by Django 6.0 on 2026-10-18 09:20
+
+from django.db import migrations, models
+
+
+def reserve_id_range(apps, schema_editor):
+    from digital_queue_app.sharding import reserve_id_range
+    reserve_id_range(schema_editor.connection.alias)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0010_queuesnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueueShard',
+            fields=[
+                ('queue_id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('shard', models.CharField(max_length=100)),
+                ('moved_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.RunPython(reserve_id_range, migrations.RunPython.noop),
+    ]
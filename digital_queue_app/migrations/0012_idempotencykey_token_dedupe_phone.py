@@ -0,0 +1,40 @@
+# Generated by Django 6.0 on 2026-10-18 11:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0011_queueshard'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='queue',
+            name='one_token_per_phone',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='token',
+            name='dedupe_phone',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddConstraint(
+            model_name='token',
+            constraint=models.UniqueConstraint(condition=models.Q(('dedupe_phone', True), ('status__in', ('WAITING', 'SERVING'))), fields=('queue', 'phone_number'), name='unique_active_phone_per_queue'),
+        ),
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('fingerprint', models.CharField(max_length=64)),
+                ('token_id', models.BigIntegerField()),
+                ('created_at', models.DateTimeField(db_index=True, default=django.utils.timezone.now)),
+                ('queue', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='digital_queue_app.queue')),
+            ],
+        ),
+    ]
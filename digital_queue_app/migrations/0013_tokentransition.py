@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-18 11:05
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('digital_queue_app', '0012_idempotencykey_token_dedupe_phone'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TokenTransition',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token_id', models.BigIntegerField()),
+                ('token_number', models.IntegerField()),
+                ('priority', models.SmallIntegerField()),
+                ('event', models.PositiveSmallIntegerField(choices=[(1, 'joined'), (2, 'called'), (3, 'skipped'), (4, 'completed')])),
+                ('counter_id', models.BigIntegerField(blank=True, null=True)),
+                ('at', models.DateTimeField()),
+                ('queue', models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, to='digital_queue_app.queue')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['queue', 'id'], name='transition_queue_log_idx')],
+            },
+        ),
+    ]
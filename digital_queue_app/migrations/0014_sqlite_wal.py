@@ -0,0 +1,30 @@
+# Generated by Django 6.0 on 2026-10-18 14:10
+
+from django.db import migrations
+
+
+def enable_wal(apps, schema_editor):
+    # the journal mode is kept in the database file, so it is set once here
+    # rather than by every connection
+    if schema_editor.connection.vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=WAL')
+
+
+def disable_wal(apps, schema_editor):
+    if schema_editor.connection.vendor == 'sqlite':
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute('PRAGMA journal_mode=DELETE')
+
+
+class Migration(migrations.Migration):
+    # SQLite cannot change the journal mode inside a transaction
+    atomic = False
+
+    dependencies = [
+        ('digital_queue_app', '0013_tokentransition'),
+    ]
+
+    operations = [
+        migrations.RunPython(enable_wal, disable_wal),
+    ]
@@ -1,17 +1,34 @@
+from django.core.serializers.json import DjangoJSONEncoder
 from django.db import models
 from django.utils import timezone
 
+
+def default_priority_levels():
+    return [1, 2, 3]
+
+
 class Queue(models.Model):
     name = models.CharField(max_length=100)
     avg_handle_time = models.IntegerField(default=5) 
+    last_token_number = models.IntegerField(default=0)
+    priority_levels = models.JSONField(default=default_priority_levels)
+    # at most one WAITING or SERVING token per phone_number
+    one_token_per_phone = models.BooleanField(default=False)
 
     def __str__(self):
         return self.name
 
 
 class Counter(models.Model):
+    STATE_CHOICES = (
+        ('OPEN', 'Open'),
+        ('ON_BREAK', 'On break'),
+        ('CLOSED', 'Closed'),
+    )
+
     name = models.CharField(max_length=50)
     queue = models.ForeignKey(Queue, on_delete=models.CASCADE)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default='OPEN')
     is_busy = models.BooleanField(default=False)
 
     def __str__(self):
@@ -33,9 +50,152 @@ class Token(models.Model):
     counter = models.ForeignKey(Counter, null=True, blank=True, on_delete=models.SET_NULL)
     created_at = models.DateTimeField(default=timezone.now)
     called_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
 
     user_name = models.CharField(max_length=100, default="Anonymous")
     phone_number = models.CharField(max_length=15, default="0000000000")
+    # Queue.one_token_per_phone as it was when the token joined
+    dedupe_phone = models.BooleanField(default=False)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'token_number'], name='unique_token_number_per_queue'),
+            # only over the active tokens of queues that asked for it, so the
+            # join check is one probe of a small index
+            models.UniqueConstraint(
+                fields=['queue', 'phone_number'],
+                condition=models.Q(status__in=('WAITING', 'SERVING'), dedupe_phone=True),
+                name='unique_active_phone_per_queue',
+            ),
+        ]
+        indexes = [
+            # current_serving, complete_token and people_ahead / people_behind counts
+            models.Index(fields=['queue', 'status', 'token_number'], name='token_queue_status_number_idx'),
+            # get_next_token dispatch order, only over the live waiting set
+            models.Index(
+                fields=['queue', '-priority', 'token_number'],
+                condition=models.Q(status='WAITING'),
+                name='token_waiting_dispatch_idx',
+            ),
+            # keyset pagination and exports of list_tokens
+            models.Index(fields=['created_at', 'id'], name='token_created_idx'),
+            models.Index(fields=['queue', 'created_at', 'id'], name='token_queue_created_idx'),
+            # most recent service times, replayed into the ETA estimator
+            models.Index(
+                fields=['queue', '-completed_at'],
+                condition=models.Q(status='COMPLETED'),
+                name='token_completed_recent_idx',
+            ),
+        ]
 
     def __str__(self):
         return f"Token {self.token_number} - {self.user_name} ({self.status})"
+
+
+class ArchivedToken(models.Model):
+    # Finished tokens moved out of Token by the archive_tokens command.
+    token_id = models.BigIntegerField(unique=True)
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE)
+    token_number = models.IntegerField()
+    priority = models.IntegerField()
+    status = models.CharField(max_length=10, choices=Token.STATUS_CHOICES)
+    counter_id = models.BigIntegerField(null=True, blank=True)
+    created_at = models.DateTimeField()
+    called_at = models.DateTimeField(null=True, blank=True)
+    completed_at = models.DateTimeField(null=True, blank=True)
+    user_name = models.CharField(max_length=100)
+    phone_number = models.CharField(max_length=15)
+    archived_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['queue', 'created_at'], name='archived_queue_created_idx'),
+            models.Index(fields=['queue', '-completed_at'], name='archived_queue_completed_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived token {self.token_number} ({self.status})"
+
+
+class DailyQueueStats(models.Model):
+    # Per queue and day totals kept when tokens are archived. Sums rather than
+    # averages so batches and reruns can simply be added together.
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE)
+    date = models.DateField()
+    completed = models.IntegerField(default=0)
+    skipped = models.IntegerField(default=0)
+    called = models.IntegerField(default=0)
+    total_wait_seconds = models.FloatField(default=0)
+    served = models.IntegerField(default=0)
+    total_service_seconds = models.FloatField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['queue', 'date'], name='unique_daily_stats_per_queue'),
+        ]
+
+    def __str__(self):
+        return f"{self.queue.name} {self.date}"
+
+
+class QueueSnapshot(models.Model):
+    # Denormalized live view of one queue for the dashboard, kept current in
+    # the same transaction as every token and counter change (see snapshots.py).
+    queue = models.OneToOneField(Queue, on_delete=models.CASCADE, primary_key=True, related_name='snapshot')
+    queue_name = models.CharField(max_length=100)
+    waiting_count = models.IntegerField(default=0)
+    counters = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    next_tokens = models.JSONField(default=list, encoder=DjangoJSONEncoder)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Snapshot of {self.queue_name}"
+
+
+class IdempotencyKey(models.Model):
+    # Joins already answered, by a hash of their Idempotency-Key header, so a
+    # retried join gets the token it created the first time (see idempotency.py).
+    key = models.CharField(max_length=64, unique=True)
+    fingerprint = models.CharField(max_length=64)
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE)
+    token_id = models.BigIntegerField()
+    created_at = models.DateTimeField(default=timezone.now, db_index=True)
+
+    def __str__(self):
+        return f"Idempotency key for token {self.token_id}"
+
+
+class TokenTransition(models.Model):
+    # Append-only log of token state changes, written in the transaction that
+    # makes them (see transitions.py). Kept when the token itself is archived.
+    JOINED, CALLED, SKIPPED, COMPLETED = 1, 2, 3, 4
+    EVENT_CHOICES = [(JOINED, 'joined'), (CALLED, 'called'), (SKIPPED, 'skipped'), (COMPLETED, 'completed')]
+
+    # leading column of the (queue, id) index already
+    queue = models.ForeignKey(Queue, on_delete=models.CASCADE, db_index=False)
+    token_id = models.BigIntegerField()
+    token_number = models.IntegerField()
+    priority = models.SmallIntegerField()
+    event = models.PositiveSmallIntegerField(choices=EVENT_CHOICES)
+    counter_id = models.BigIntegerField(null=True, blank=True)
+    at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            # replay of one queue in log order
+            models.Index(fields=['queue', 'id'], name='transition_queue_log_idx'),
+        ]
+
+    def __str__(self):
+        return f"Token {self.token_id} {self.get_event_display()}"
+
+
+class QueueShard(models.Model):
+    # Queues moved off the shard their id was allocated on (see sharding.py).
+    # Always kept on the default database.
+    queue_id = models.BigIntegerField(primary_key=True)
+    shard = models.CharField(max_length=100)
+    moved_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Queue {self.queue_id} on {self.shard}"
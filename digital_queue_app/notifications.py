@@ -0,0 +1,219 @@
+"""
+Messages to waiting customers, so they need not keep polling my-token/.
+
+A customer is texted at the phone number they joined with when their token
+gets close to the front (when its people ahead first drop to one of
+QUEUE_NOTIFY_PEOPLE_AHEAD) and when it is called. call_next and skips only
+hand work over when their transaction commits: the called token's "now
+serving" message, and the id of the queue that moved. Everything else runs
+in a pool of worker threads. A worker takes what is queued, up to
+QUEUE_NOTIFICATION_BATCH items or whatever arrives within
+QUEUE_NOTIFICATION_BATCH_WAIT seconds, reads each queue that moved once
+however many calls it saw (its first few waiting tokens, one indexed query),
+and sends the messages in batches, retrying failures with exponential
+backoff. Which thresholds a token was texted for is kept in the shared cache,
+so every worker process sends each message once.
+
+QUEUE_NOTIFICATION_TRANSPORT is the dotted path of the Transport that sends
+them (an SMS gateway client); None turns notifications off. LogTransport
+writes them to the log, FakeTransport keeps them in memory for tests.
+QUEUE_NOTIFICATION_WORKERS = 0 sends them on commit in the committing thread.
+"""
+import logging
+import queue
+import threading
+import time
+from collections import namedtuple
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.utils.module_loading import import_string
+
+from . import caching, metrics, sharding
+from .models import Token
+
+
+log = logging.getLogger("digital_queue_app.notifications")
+
+Notification = namedtuple("Notification", "phone_number text token_id kind")
+
+
+class Transport:
+    """Sends one batch of notifications; returns the ones that failed, or raises to fail them all."""
+
+    def send(self, notifications):
+        raise NotImplementedError
+
+
+class LogTransport(Transport):
+    def send(self, notifications):
+        for notification in notifications:
+            log.info("to %s: %s", notification.phone_number, notification.text)
+        return []
+
+
+class FakeTransport(Transport):
+    """Keeps every notification it sends; the next `fail` batches raise instead."""
+
+    def __init__(self):
+        self.sent = []
+        self.batches = []
+        self.fail = 0
+        self.lock = threading.Lock()
+
+    def send(self, notifications):
+        with self.lock:
+            self.batches.append(len(notifications))
+            if self.fail:
+                self.fail -= 1
+                raise ConnectionError("fake transport is down")
+            self.sent.extend(notifications)
+        return []
+
+
+def enabled():
+    return bool(getattr(settings, "QUEUE_NOTIFICATION_TRANSPORT", None))
+
+def thresholds():
+    return sorted(getattr(settings, "QUEUE_NOTIFY_PEOPLE_AHEAD", (5, 1)))
+
+
+# ---------------- Messages ----------------
+def serving_message(token):
+    return Notification(token.phone_number, f"Token {token.token_number}: it's your turn, please go to the counter.", token.id, "serving")
+
+def approaching_message(token_id, token_number, phone_number, people_ahead):
+    if people_ahead:
+        text = f"Token {token_number}: you are {people_ahead} away, please make your way back."
+    else:
+        text = f"Token {token_number}: you are next, please make your way back."
+    return Notification(phone_number, text, token_id, "approaching")
+
+def approaching(queue_ids):
+    """Messages for the waiting tokens of the queues that reached a threshold they were not texted for yet."""
+    steps = thresholds()
+    if not steps:
+        return []
+    timeout = getattr(settings, "QUEUE_NOTIFICATION_DEDUPE_SECONDS", 86400)
+    found = []
+    for queue_id in queue_ids:
+        # from the primary, in dispatch order: the replica may not have the call yet
+        waiting = (
+            Token.objects.using(sharding.shard_for_queue(queue_id))
+            .filter(queue_id=queue_id, status="WAITING").order_by('-priority', 'token_number')
+            .values_list('id', 'token_number', 'phone_number')[:steps[-1] + 1]
+        )
+        for people_ahead, (token_id, token_number, phone_number) in enumerate(waiting):
+            # a token moved past several thresholds at once only hears about the nearest
+            threshold = next(step for step in steps if step >= people_ahead)
+            if phone_number and caching._cache().add(f"notified:{token_id}:{threshold}", True, timeout):
+                found.append(approaching_message(token_id, token_number, phone_number, people_ahead))
+    return found
+
+
+# ---------------- Dispatch ----------------
+class Dispatcher:
+    def __init__(self, transport, workers):
+        self.transport = transport
+        self.workers = workers
+        self.items = queue.Queue()  # queue ids that moved and Notifications
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def submit(self, items):
+        if not self.workers:
+            self.process(items)
+            return
+        if len(self.threads) < self.workers:
+            self._start()
+        for item in items:
+            self.items.put(item)
+
+    def _start(self):
+        with self.lock:
+            while len(self.threads) < self.workers:
+                thread = threading.Thread(target=self._run, name=f"notifications-{len(self.threads)}", daemon=True)
+                thread.start()
+                self.threads.append(thread)
+
+    def _run(self):
+        size = getattr(settings, "QUEUE_NOTIFICATION_BATCH", 100)
+        wait = getattr(settings, "QUEUE_NOTIFICATION_BATCH_WAIT", 0.05)
+        while True:
+            batch = [self.items.get()]
+            deadline = time.monotonic() + wait
+            while len(batch) < size:
+                try:
+                    batch.append(self.items.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.process(batch)
+            except Exception:
+                log.exception("Dropped a batch of %d notification items", len(batch))
+            finally:
+                # this thread's connections would otherwise stay open between batches
+                connections.close_all()
+                for _ in batch:
+                    self.items.task_done()
+
+    def flush(self):
+        """Wait until everything submitted so far was sent or given up on."""
+        self.items.join()
+
+    def process(self, items):
+        notifications = [item for item in items if isinstance(item, Notification)]
+        notifications += approaching(sorted({item for item in items if not isinstance(item, Notification)}))
+        size = getattr(settings, "QUEUE_NOTIFICATION_BATCH", 100)
+        for start in range(0, len(notifications), size):
+            self.send(notifications[start:start + size])
+
+    def send(self, notifications):
+        retries = getattr(settings, "QUEUE_NOTIFICATION_RETRIES", 3)
+        backoff = getattr(settings, "QUEUE_NOTIFICATION_BACKOFF_SECONDS", 0.5)
+        pending = notifications
+        for attempt in range(retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+                metrics.notifications("retried", len(pending))
+            try:
+                failed = list(self.transport.send(pending) or ())
+            except Exception:
+                log.warning("Sending %d notifications failed (attempt %d)", len(pending), attempt + 1, exc_info=True)
+                failed = pending
+            metrics.notifications("sent", len(pending) - len(failed))
+            pending = failed
+            if not pending:
+                return
+        log.error("Gave up on %d notifications after %d attempts", len(pending), retries + 1)
+        metrics.notifications("failed", len(pending))
+
+
+_dispatcher = None
+_dispatcher_lock = threading.Lock()
+
+
+def get_dispatcher():
+    global _dispatcher
+    if _dispatcher is None:
+        with _dispatcher_lock:
+            if _dispatcher is None:
+                transport = import_string(settings.QUEUE_NOTIFICATION_TRANSPORT)()
+                _dispatcher = Dispatcher(transport, getattr(settings, "QUEUE_NOTIFICATION_WORKERS", 2))
+    return _dispatcher
+
+def reset():
+    """Start over with the current settings (tests). Workers of the old dispatcher finish what they have."""
+    global _dispatcher
+    with _dispatcher_lock:
+        _dispatcher = None
+
+
+def tokens_changed(tokens, event_type):
+    """Queue the notifications a call or skip leads to, once the transaction commits."""
+    if not enabled() or event_type not in ("called", "skipped"):
+        return
+    items = [serving_message(token) for token in tokens if event_type == "called" and token.phone_number]
+    # the tokens behind a skipped one move up too; a serving token's skip moves nobody, which costs one read
+    items += sorted({token.queue_id for token in tokens})
+    transaction.on_commit(lambda: get_dispatcher().submit(items), using=sharding.db())
@@ -0,0 +1,157 @@
+"""
+In-process index of the waiting set of each queue.
+
+Every queue keeps one sorted list of token numbers per priority level, so a
+token's position in dispatch order (higher priority first, then lower token
+number) is a few bisects instead of COUNT(*) queries. A queue is loaded from
+the Token table the first time it is asked about and then kept current by the
+views through token_joined() / token_left(), which are applied on commit.
+
+The index lives in the current process, which only sees its own commits, so
+each queue is reloaded every QUEUE_POSITION_REFRESH_SECONDS to pick up other
+workers' joins and calls. QUEUE_POSITION_INDEX = False answers the same
+questions with indexed COUNT queries instead.
+"""
+import threading
+import time
+from bisect import bisect_left, insort
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+
+from . import sharding
+from .models import Token
+
+
+class QueuePositions:
+    def __init__(self, waiting=()):
+        self.loaded_at = time.monotonic()
+        self.buckets = {}
+        for priority, number in waiting:
+            self.buckets.setdefault(priority, []).append(number)
+        for numbers in self.buckets.values():
+            numbers.sort()
+
+    def add(self, priority, number):
+        numbers = self.buckets.setdefault(priority, [])
+        # joins almost always carry the highest number yet, so this is an append
+        if not numbers or numbers[-1] < number:
+            numbers.append(number)
+            return
+        i = bisect_left(numbers, number)
+        if i == len(numbers) or numbers[i] != number:
+            insort(numbers, number)
+
+    def remove(self, priority, number):
+        numbers = self.buckets.get(priority, [])
+        i = bisect_left(numbers, number)
+        if i < len(numbers) and numbers[i] == number:
+            del numbers[i]
+
+    def rank(self, priority, number):
+        numbers = self.buckets.get(priority, [])
+        i = bisect_left(numbers, number)
+        waiting = i < len(numbers) and numbers[i] == number
+
+        ahead = i
+        total = 0
+        for p, bucket in self.buckets.items():
+            total += len(bucket)
+            if p > priority:
+                ahead += len(bucket)
+        return ahead, total - ahead - waiting
+
+
+_lock = threading.Lock()
+_queues = {}
+_loading = {}  # queue id -> changes committed while it is read from the database
+_load_locks = {}
+
+
+def enabled():
+    return getattr(settings, "QUEUE_POSITION_INDEX", True)
+
+def _refresh_seconds():
+    return getattr(settings, "QUEUE_POSITION_REFRESH_SECONDS", 10)
+
+def _fresh(positions):
+    return positions is not None and time.monotonic() - positions.loaded_at <= _refresh_seconds()
+
+def _get(queue_id):
+    with _lock:
+        positions = _queues.get(queue_id)
+        if _fresh(positions):
+            return positions
+        load_lock = _load_locks.setdefault(queue_id, threading.Lock())
+    # one load per queue at a time, without holding up lookups in other queues
+    with load_lock:
+        with _lock:
+            positions = _queues.get(queue_id)
+            if _fresh(positions):
+                return positions
+            changes = _loading[queue_id] = []
+        try:
+            # from the primary: the index is kept current from commits from here on,
+            # so it must not start out behind them (read replica)
+            waiting = Token.objects.using(sharding.shard_for_queue(queue_id)).filter(queue_id=queue_id, status="WAITING").values_list('priority', 'token_number')
+            positions = QueuePositions(waiting.iterator())
+        finally:
+            with _lock:
+                del _loading[queue_id]
+        with _lock:
+            # the read may or may not have seen these; add and remove are idempotent
+            for method, priority, number in changes:
+                getattr(positions, method)(priority, number)
+            _queues[queue_id] = positions
+    return positions
+
+def clear():
+    with _lock:
+        _queues.clear()
+
+def _apply(method, token):
+    with _lock:
+        # queues nobody has asked about yet are read fresh on first use
+        if token.queue_id in _queues:
+            getattr(_queues[token.queue_id], method)(token.priority, token.token_number)
+        if token.queue_id in _loading:
+            _loading[token.queue_id].append((method, token.priority, token.token_number))
+
+def token_joined(token):
+    transaction.on_commit(lambda: _apply("add", token), using=sharding.db())
+
+def token_left(token):
+    transaction.on_commit(lambda: _apply("remove", token), using=sharding.db())
+
+
+def position(token):
+    """Return (people_ahead, people_behind) for a waiting token in dispatch order."""
+    if not enabled():
+        waiting = Token.objects.filter(queue_id=token.queue_id, status="WAITING")
+        ahead = waiting.filter(
+            Q(priority__gt=token.priority) | Q(priority=token.priority, token_number__lt=token.token_number)
+        ).count()
+        behind = waiting.filter(
+            Q(priority__lt=token.priority) | Q(priority=token.priority, token_number__gt=token.token_number)
+        ).count()
+        return ahead, behind
+
+    positions = _get(token.queue_id)
+    with _lock:
+        return positions.rank(token.priority, token.token_number)
+
+def cached_position(token):
+    """position() from a loaded, fresh index; None when it would need the database."""
+    if enabled():
+        with _lock:
+            positions = _queues.get(token.queue_id)
+            if _fresh(positions):
+                return positions.rank(token.priority, token.token_number)
+    return None
+
+async def aposition(token):
+    """position() for async views; only leaves the event loop to load a queue or count."""
+    found = cached_position(token)
+    return found if found is not None else await sync_to_async(position)(token)
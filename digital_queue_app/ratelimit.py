@@ -0,0 +1,122 @@
+"""
+Token-bucket rate limits for the polling endpoints.
+
+settings.QUEUE_RATE_LIMITS gives a (requests per second, burst) pair per
+scope: "token" (the token being polled), "queue" (the queue being polled) and
+"ip" (the client address, read from QUEUE_CLIENT_IP_HEADER when set, e.g.
+X-Forwarded-For behind a proxy, else REMOTE_ADDR). None leaves a scope
+unlimited. Every key of a scope has a bucket of `burst` requests refilled at
+`rate` per second; a request needs one from each of its buckets, and is
+otherwise rejected with 429 and a Retry-After of when that will be the case.
+
+Buckets are kept in process, least recently used ones dropped beyond
+MAX_BUCKETS, so every worker process enforces the limits on its own.
+"""
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from rest_framework.exceptions import Throttled
+
+
+MAX_BUCKETS = 100000
+
+_lock = threading.Lock()
+_buckets = OrderedDict()
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait(self):
+        """Seconds until a request can be taken, 0 if one can now."""
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+def limits():
+    return getattr(settings, "QUEUE_RATE_LIMITS", {})
+
+def clear():
+    with _lock:
+        _buckets.clear()
+
+def _bucket(key, rate, burst, now):
+    bucket = _buckets.get(key)
+    if bucket is None or (bucket.rate, bucket.burst) != (rate, burst):
+        bucket = _buckets[key] = TokenBucket(rate, burst, now)
+        if len(_buckets) > MAX_BUCKETS:
+            _buckets.popitem(last=False)
+    else:
+        _buckets.move_to_end(key)
+        bucket.refill(now)
+    return bucket
+
+def take(keys):
+    """
+    Take one request from the bucket of every (scope, value) in keys. Returns
+    0 if it was allowed, else the seconds to wait; nothing is taken then.
+    """
+    configured = limits()
+    now = time.monotonic()
+    with _lock:
+        buckets = [
+            _bucket(f"{scope}:{value}", *configured[scope], now)
+            for scope, value in keys if configured.get(scope) and value is not None
+        ]
+        wait = max((bucket.wait() for bucket in buckets), default=0)
+        if not wait:
+            for bucket in buckets:
+                bucket.tokens -= 1
+    return wait
+
+
+def client_ip(request):
+    header = getattr(settings, "QUEUE_CLIENT_IP_HEADER", None)
+    if header:
+        forwarded = request.headers.get(header)
+        if forwarded:
+            return forwarded.split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR")
+
+def request_keys(scopes, request, kwargs):
+    sources = {
+        "token": lambda: kwargs.get("token_id"),
+        "queue": lambda: kwargs.get("queue_id"),
+        "ip": lambda: client_ip(request),
+    }
+    return [(scope, sources[scope]()) for scope in scopes]
+
+def check(scopes, request, kwargs):
+    wait = take(request_keys(scopes, request, kwargs))
+    if wait:
+        # DRF renders it as 429 with Retry-After, rounded up to whole seconds
+        raise Throttled(wait=wait)
+
+def limited(*scopes):
+    """Rate limit the view per scope; applied before routing or any database work."""
+    def decorator(view):
+        if iscoroutinefunction(view):
+            @wraps(view)
+            async def wrapped(request, *args, **kwargs):
+                check(scopes, request, kwargs)
+                return await view(request, *args, **kwargs)
+        else:
+            @wraps(view)
+            def wrapped(request, *args, **kwargs):
+                check(scopes, request, kwargs)
+                return view(request, *args, **kwargs)
+        return wrapped
+    return decorator
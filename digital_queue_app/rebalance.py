@@ -0,0 +1,136 @@
+"""
+Moving a queue to another shard while it is in use.
+
+move_queue() first copies what no longer changes, the finished tokens, the
+archive and the transition log, in batches and without locks, so a queue
+with a long history is not blocked while it is copied. It then locks the queue's row and snapshot
+row on the source shard, which every join, call, skip and completion also
+locks, copies whatever is still live, points the queue at the target in
+QueueShard and deletes it from the source, all before that lock is released.
+
+Requests for the queue wait on the lock meanwhile; ones already routed to the
+source fail with 404 once it is released, and other processes keep routing
+there until their cached shard entry expires (QUEUE_SHARD_CACHE_TIMEOUT).
+A move that dies halfway leaves a partial copy on the target, which the next
+move there clears first; the source is only changed in the final transaction.
+"""
+from django.db import connections, transaction
+
+from . import sharding
+from .batching import FINISHED_STATUSES, chunks
+from .models import ArchivedToken, Counter, DailyQueueStats, IdempotencyKey, Queue, QueueShard, QueueSnapshot, Token, TokenTransition
+
+
+def _upsert(model, alias, objs):
+    """Insert objs on alias with their ids, overwriting rows already there."""
+    if not objs:
+        return
+    opts = model._meta
+    features = connections[alias].features
+    model.objects.using(alias).bulk_create(
+        objs,
+        update_conflicts=True,
+        unique_fields=[opts.pk.name] if features.supports_update_conflicts_with_target else None,
+        update_fields=[field.name for field in opts.concrete_fields if not field.primary_key],
+    )
+
+def _copies(model, rows):
+    """Unsaved copies of rows that get new ids wherever they are inserted."""
+    fields = [field.attname for field in model._meta.concrete_fields if not field.primary_key]
+    return [model(**{field: getattr(row, field) for field in fields}) for row in rows]
+
+
+def _delete(queue_id, alias):
+    for model in (IdempotencyKey, TokenTransition, Token, ArchivedToken, DailyQueueStats, QueueSnapshot, Counter):
+        model.objects.using(alias).filter(queue_id=queue_id).delete()
+    Queue.objects.using(alias).filter(id=queue_id).delete()
+
+def _copy_queue(queue_id, source, target):
+    _upsert(Queue, target, list(Queue.objects.using(source).filter(id=queue_id)))
+    _upsert(Counter, target, list(Counter.objects.using(source).filter(queue_id=queue_id)))
+
+def _copy_finished(queue_id, source, target, batch_size):
+    last = 0
+    while True:
+        batch = list(
+            Token.objects.using(source)
+            .filter(queue_id=queue_id, status__in=FINISHED_STATUSES, id__gt=last)
+            .order_by('id')[:batch_size]
+        )
+        if not batch:
+            return
+        _upsert(Token, target, batch)
+        last = batch[-1].id
+
+def _copy_appended(model, queue_id, source, target, batch_size, last=0):
+    """Copy rows of an append-only model after id `last`; returns the last id copied."""
+    while True:
+        batch = list(model.objects.using(source).filter(queue_id=queue_id, id__gt=last).order_by('id')[:batch_size])
+        if not batch:
+            return last
+        model.objects.using(target).bulk_create(_copies(model, batch))
+        last = batch[-1].id
+
+def _sync_tokens(queue_id, source, target):
+    """Make the target's tokens of the queue exactly the source's."""
+    source_ids = set(Token.objects.using(source).filter(queue_id=queue_id).values_list('id', flat=True))
+    target_ids = set(Token.objects.using(target).filter(queue_id=queue_id).values_list('id', flat=True))
+    # finished tokens copied earlier cannot have changed since
+    live = Token.objects.using(source).filter(queue_id=queue_id).exclude(status__in=FINISHED_STATUSES)
+    changed = (source_ids - target_ids) | set(live.values_list('id', flat=True))
+
+    for chunk in chunks(sorted(target_ids - source_ids)):
+        # archived meanwhile
+        Token.objects.using(target).filter(id__in=chunk).delete()
+    for chunk in chunks(sorted(changed)):
+        _upsert(Token, target, list(Token.objects.using(source).filter(id__in=chunk)))
+    return len(source_ids)
+
+
+def move_queue(queue_id, target, batch_size=5000):
+    """Move a queue and everything of it to the shard `target`. Returns what was moved."""
+    if target not in sharding.shards():
+        raise ValueError(f"{target!r} is not one of QUEUE_SHARDS {sharding.shards()}")
+    source = sharding.shard_for_queue(queue_id)
+    if source is None or not Queue.objects.using(source).filter(id=queue_id).exists():
+        raise Queue.DoesNotExist(f"Queue {queue_id} not found")
+    if source == target:
+        return {"queue": queue_id, "source": source, "target": target, "tokens": 0, "archived": 0}
+
+    # online: whatever will not change any more
+    _delete(queue_id, target)
+    _copy_queue(queue_id, source, target)
+    _copy_finished(queue_id, source, target, batch_size)
+    last_archived = _copy_appended(ArchivedToken, queue_id, source, target, batch_size)
+    last_logged = _copy_appended(TokenTransition, queue_id, source, target, batch_size)
+
+    with transaction.atomic(using=source):
+        # every token and counter change of the queue locks its snapshot row
+        Queue.objects.using(source).select_for_update().get(id=queue_id)
+        snapshot = QueueSnapshot.objects.using(source).select_for_update().filter(queue_id=queue_id).first()
+
+        with transaction.atomic(using=target):
+            _copy_queue(queue_id, source, target)
+            if snapshot:
+                _upsert(QueueSnapshot, target, [snapshot])
+            DailyQueueStats.objects.using(target).filter(queue_id=queue_id).delete()
+            DailyQueueStats.objects.using(target).bulk_create(
+                _copies(DailyQueueStats, DailyQueueStats.objects.using(source).filter(queue_id=queue_id))
+            )
+            _copy_appended(ArchivedToken, queue_id, source, target, batch_size, last_archived)
+            _copy_appended(TokenTransition, queue_id, source, target, batch_size, last_logged)
+            tokens = _sync_tokens(queue_id, source, target)
+            IdempotencyKey.objects.using(target).filter(queue_id=queue_id).delete()
+            IdempotencyKey.objects.using(target).bulk_create(
+                _copies(IdempotencyKey, IdempotencyKey.objects.using(source).filter(queue_id=queue_id))
+            )
+            archived = ArchivedToken.objects.using(target).filter(queue_id=queue_id).count()
+
+        if target == sharding.home_shard(queue_id):
+            QueueShard.objects.filter(queue_id=queue_id).delete()
+        else:
+            QueueShard.objects.update_or_create(queue_id=queue_id, defaults={"shard": target})
+        _delete(queue_id, source)
+        transaction.on_commit(lambda: sharding.queue_moved(queue_id, target), using=source)
+
+    return {"queue": queue_id, "source": source, "target": target, "tokens": tokens, "archived": archived}
@@ -0,0 +1,78 @@
+"""
+Read replica routing.
+
+Views decorated with @read_only (the list endpoints, current_serving and
+my_token_status) run their reads against settings.QUEUE_READ_REPLICA; every
+write, and every read anywhere else, goes to default. The flag lives in a
+context variable, so it follows a request through sync_to_async and back.
+
+A replica lags the primary. Code that must see a row the client has just
+created (a token that joined a moment ago) retries on the primary with
+primary(), and the response cache keeps replica-built entries only briefly
+(see caching.store).
+
+With queues sharded across databases (sharding.ShardRouter, which runs
+first), the queue tables of a request routed to a shard stay on that shard.
+"""
+import contextvars
+from contextlib import contextmanager
+from functools import wraps
+from inspect import iscoroutinefunction
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS
+
+
+_read_only = contextvars.ContextVar("queue_read_only", default=False)
+
+
+def replica_alias():
+    return getattr(settings, "QUEUE_READ_REPLICA", None)
+
+def using_replica():
+    return _read_only.get() and replica_alias() is not None
+
+
+def read_only(view):
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapped(*args, **kwargs):
+            token = _read_only.set(True)
+            try:
+                return await view(*args, **kwargs)
+            finally:
+                _read_only.reset(token)
+    else:
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            token = _read_only.set(True)
+            try:
+                return view(*args, **kwargs)
+            finally:
+                _read_only.reset(token)
+    return wrapped
+
+@contextmanager
+def primary():
+    token = _read_only.set(False)
+    try:
+        yield
+    finally:
+        _read_only.reset(token)
+
+
+class ReadReplicaRouter:
+    def db_for_read(self, model, **hints):
+        return replica_alias() if _read_only.get() else None
+
+    def db_for_write(self, model, **hints):
+        # explicitly, or an instance read from the replica would be saved there
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # the replica holds the same rows as default
+        return True
+
+    def allow_migrate(self, db, app_label, **hints):
+        # the replica gets its schema from default; shards are migrated like it
+        return False if db == replica_alias() or settings.DATABASES[db].get('TEST', {}).get('MIRROR') else None
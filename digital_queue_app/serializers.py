@@ -1,11 +1,14 @@
-from rest_framework import serializers
+from django.conf import settings
+from django.utils import timezone
+from rest_framework import ISO_8601, serializers
+from rest_framework.settings import api_settings
 from .models import Queue, Counter, Token
 
 
 class QueueSerializer(serializers.ModelSerializer):
     class Meta:
         model = Queue
-        fields = "__all__"
+        exclude = ['last_token_number']
 
 class CounterSerializer(serializers.ModelSerializer):
     class Meta:
@@ -31,3 +34,93 @@ class TokenSerializer(serializers.ModelSerializer):
             'created_at', 
             'called_at'
         ]
+
+
+# ---------------- Row serializers ----------------
+# The polling and listing endpoints read values_list() rows and shape them with
+# a RowSerializer declared per endpoint, instead of building model instances
+# and running them through a ModelSerializer field by field. The output is the
+# same data the ModelSerializer produces for those fields.
+
+def datetime_renderer():
+    """A function rendering a datetime exactly as DRF's DateTimeField would, right now."""
+    if (api_settings.DATETIME_FORMAT or "").lower() != ISO_8601:
+        return serializers.DateTimeField().to_representation
+
+    tz = timezone.get_current_timezone() if settings.USE_TZ else None
+
+    def render(value):
+        if tz is not None:
+            value = value.astimezone(tz) if timezone.is_aware(value) else timezone.make_aware(value, tz)
+        value = value.isoformat()
+        return value[:-6] + 'Z' if value.endswith('+00:00') else value
+    return render
+
+
+class RowSerializer:
+    def __init__(self, fields, datetimes=(), extra=()):
+        """
+        fields maps output names, in output order, to the columns they are read
+        from; datetimes are the output names rendered like DateTimeField. extra
+        columns are read into the rows but not output.
+        """
+        self.names = tuple(fields)
+        self.columns = tuple(fields.values()) + tuple(extra)
+        self.datetime_indexes = tuple(self.names.index(name) for name in datetimes)
+
+    def rows(self, queryset):
+        return queryset.values_list(*self.columns, named=True)
+
+    def to_representation(self, row, render_datetime=None):
+        if not self.datetime_indexes:
+            return dict(zip(self.names, row))
+        render_datetime = render_datetime or datetime_renderer()
+        values = list(row)
+        for i in self.datetime_indexes:
+            if values[i] is not None:
+                values[i] = render_datetime(values[i])
+        return dict(zip(self.names, values))
+
+    def data(self, rows):
+        render_datetime = datetime_renderer()
+        return [self.to_representation(row, render_datetime) for row in rows]
+
+
+# TokenSerializer's fields, as list_tokens returns them
+TOKEN_ROW = RowSerializer({
+    'id': 'id',
+    'token_number': 'token_number',
+    'user_name': 'user_name',
+    'phone_number': 'phone_number',
+    'queue': 'queue_id',
+    'priority': 'priority',
+    'status': 'status',
+    'counter': 'counter_id',
+    'created_at': 'created_at',
+    'called_at': 'called_at',
+}, datetimes=('created_at', 'called_at'))
+
+# current_serving: TokenSerializer without queue and status
+SERVING_ROW = RowSerializer({
+    'id': 'id',
+    'token_number': 'token_number',
+    'user_name': 'user_name',
+    'phone_number': 'phone_number',
+    'priority': 'priority',
+    'counter': 'counter_id',
+    'created_at': 'created_at',
+    'called_at': 'called_at',
+}, datetimes=('created_at', 'called_at'))
+
+# my_token_status: completed by token_status_data(); created_at stays a
+# datetime here, as it always has on this endpoint
+TOKEN_STATUS_ROW = RowSerializer({
+    'id': 'id',
+    'token_number': 'token_number',
+    'created_at': 'created_at',
+    'user_name': 'user_name',
+    'phone_number': 'phone_number',
+    'queue': 'queue_id',
+    'priority': 'priority',
+    'status': 'status',
+}, extra=('called_at', 'queue__avg_handle_time'))
@@ -0,0 +1,261 @@
+"""
+Queues sharded across databases.
+
+settings.QUEUE_SHARDS lists the database aliases holding queue data, default
+first. A queue lives on exactly one of them together with its counters,
+tokens, snapshot, archive, daily stats, idempotency keys and transition log,
+so a busy queue only loads its own shard. Every shard hands out ids from its
+own range of ID_SPAN (see reserve_id_range(), run by migration 0011), so a
+queue id names the shard the queue was created on and token and counter ids
+never collide across shards. Queues moved since (the move_queue command) are
+recorded in QueueShard on default, which wins over the id range.
+
+Views run inside using(shard): ShardRouter sends every query on the queue
+models there, and db() is the alias for transaction.atomic() and on_commit().
+@routed picks the shard from the queue_id / token_id / counter_id in the URL,
+or the queue / queue_id in the request; views spanning queues (bulk
+endpoints, lists, the dashboard) split their work per shard themselves.
+
+With the one default shard none of this looks anything up, and every query
+goes to default as before.
+"""
+import heapq
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from inspect import iscoroutinefunction
+from operator import attrgetter
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from . import caching
+from .models import Counter, Queue, QueueShard
+
+
+ID_SPAN = 10 ** 12
+SHARDED_MODELS = frozenset({
+    "queue", "counter", "token", "archivedtoken", "dailyqueuestats", "queuesnapshot", "idempotencykey", "tokentransition",
+})
+
+_current = ContextVar("queue_shard", default=None)
+
+
+def shards():
+    return list(getattr(settings, "QUEUE_SHARDS", [DEFAULT_DB_ALIAS]))
+
+def enabled():
+    return len(shards()) > 1
+
+def current():
+    """Shard the current request works on, None outside one."""
+    return _current.get()
+
+def db():
+    """Alias for transaction.atomic() and on_commit() in the current request."""
+    return _current.get() or DEFAULT_DB_ALIAS
+
+@contextmanager
+def using(alias):
+    token = _current.set(alias)
+    try:
+        yield
+    finally:
+        _current.reset(token)
+
+
+# ---------------- Lookups ----------------
+def _int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def home_shard(object_id):
+    """The shard an id was allocated on."""
+    aliases = shards()
+    index = int(object_id) // ID_SPAN
+    return aliases[index] if 0 <= index < len(aliases) else None
+
+def _cache_timeout():
+    # other processes pick up a moved queue once their entry expires
+    return getattr(settings, "QUEUE_SHARD_CACHE_TIMEOUT", 60)
+
+def shard_for_queue(queue_id):
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    queue_id = _int(queue_id)
+    if queue_id is None:
+        return None
+    key = f"queue:{queue_id}:shard"
+    alias = caching._cache().get(key)
+    if alias is None:
+        alias = (
+            QueueShard.objects.filter(queue_id=queue_id).values_list('shard', flat=True).first()
+            or home_shard(queue_id)
+        )
+        if alias is None:
+            return None
+        caching._cache().set(key, alias, _cache_timeout())
+    return alias
+
+def queue_moved(queue_id, alias):
+    caching._cache().set(f"queue:{queue_id}:shard", alias, _cache_timeout())
+
+def queue_of(model, object_id):
+    """Queue id of a token or counter, looked for on the shard its id came from first."""
+    home = home_shard(object_id)
+    for alias in sorted(shards(), key=lambda alias: alias != home):
+        queue_id = model.objects.using(alias).filter(id=object_id).values_list('queue_id', flat=True).first()
+        if queue_id is not None:
+            return queue_id
+    return None
+
+def shard_for_token(token_id):
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    queue_id = caching.token_queue_id(token_id)
+    return shard_for_queue(queue_id) if queue_id is not None else None
+
+def shard_for_counter(counter_id):
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    queue_id = queue_of(Counter, counter_id)
+    return shard_for_queue(queue_id) if queue_id is not None else None
+
+def shard_for_new_queue():
+    """The shard holding the fewest queues."""
+    if not enabled():
+        return DEFAULT_DB_ALIAS
+    return min(shards(), key=lambda alias: Queue.objects.using(alias).count())
+
+def group(ids, shard_for):
+    """{alias: ids on that shard}; ids on no shard are left out."""
+    if not enabled():
+        return {DEFAULT_DB_ALIAS: list(ids)} if ids else {}
+    groups = {}
+    for object_id in ids:
+        alias = shard_for(object_id)
+        if alias is not None:
+            groups.setdefault(alias, []).append(object_id)
+    return groups
+
+
+# ---------------- Requests ----------------
+def shard_for_request(request, kwargs):
+    if not enabled():
+        return None
+    for name, shard_for in (("queue_id", shard_for_queue), ("token_id", shard_for_token), ("counter_id", shard_for_counter)):
+        if name in kwargs:
+            return shard_for(kwargs[name])
+    # DRF requests carry a parsed body; plain async views route their body themselves
+    for params in (getattr(request, "data", None), request.GET):
+        if hasattr(params, "get"):
+            for name in ("queue", "queue_id"):
+                queue_id = _int(params.get(name))
+                if queue_id is not None:
+                    return shard_for_queue(queue_id)
+    return None
+
+def routed(view):
+    """Run the view on the shard of the queue, token or counter it is about."""
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def wrapped(request, *args, **kwargs):
+            alias = await sync_to_async(shard_for_request)(request, kwargs) if enabled() else None
+            with using(alias):
+                return await view(request, *args, **kwargs)
+    else:
+        @wraps(view)
+        def wrapped(request, *args, **kwargs):
+            with using(shard_for_request(request, kwargs)):
+                return view(request, *args, **kwargs)
+    return wrapped
+
+def bound(fn):
+    """fn run on the current shard later on, e.g. from a response stream."""
+    alias = _current.get()
+
+    @wraps(fn)
+    def wrapped(*args, **kwargs):
+        with using(alias):
+            return fn(*args, **kwargs)
+    return wrapped
+
+
+# ---------------- Fan-out ----------------
+def _merge_key(keys):
+    getter = attrgetter(*keys)
+    return getter if len(keys) > 1 else lambda row: (getter(row),)
+
+def gather(queryset, keys):
+    """
+    Rows of an ordered, sliced queryset from every shard, merged in `keys`
+    order. Inside using() only that shard is read.
+    """
+    if not enabled() or _current.get() is not None:
+        return list(queryset)
+    return list(heapq.merge(*(list(queryset.using(alias)) for alias in shards()), key=_merge_key(keys)))[:_limit(queryset)]
+
+async def agather(queryset, keys):
+    if not enabled() or _current.get() is not None:
+        return [row async for row in queryset]
+    parts = [[row async for row in queryset.using(alias)] for alias in shards()]
+    return list(heapq.merge(*parts, key=_merge_key(keys)))[:_limit(queryset)]
+
+def _limit(queryset):
+    high = queryset.query.high_mark
+    return None if high is None else high - queryset.query.low_mark
+
+def merged(queryset, key, chunk_size):
+    """
+    Lazily stream an ordered queryset from every shard, merged by key(row).
+    The shard is fixed now, as streams are read after the view has returned.
+    """
+    alias = _current.get()
+    if not enabled() or alias is not None:
+        return queryset.using(alias).iterator(chunk_size=chunk_size)
+    return heapq.merge(*(queryset.using(alias).iterator(chunk_size=chunk_size) for alias in shards()), key=key)
+
+
+# ---------------- Router ----------------
+class ShardRouter:
+    def _route(self, model):
+        if model._meta.model_name == "queueshard":
+            return DEFAULT_DB_ALIAS
+        if model._meta.model_name in SHARDED_MODELS and _current.get() not in (None, DEFAULT_DB_ALIAS):
+            return _current.get()
+        return None
+
+    def db_for_read(self, model, **hints):
+        return self._route(model)
+
+    def db_for_write(self, model, **hints):
+        return self._route(model)
+
+
+# ---------------- Id ranges ----------------
+ID_RANGE_TABLES = ("digital_queue_app_queue", "digital_queue_app_counter", "digital_queue_app_token")
+
+def reserve_id_range(alias):
+    """Make the shard at `alias` hand out queue, counter and token ids from its own range."""
+    if alias not in shards():
+        return
+    base = shards().index(alias) * ID_SPAN
+    if not base:
+        return
+    connection = connections[alias]
+    with connection.cursor() as cursor:
+        for table in ID_RANGE_TABLES:
+            if connection.vendor == "sqlite":
+                cursor.execute("UPDATE sqlite_sequence SET seq = MAX(seq, %s) WHERE name = %s", [base, table])
+                if not cursor.rowcount:
+                    cursor.execute("INSERT INTO sqlite_sequence (name, seq) VALUES (%s, %s)", [table, base])
+            elif connection.vendor == "postgresql":
+                cursor.execute(
+                    f"SELECT setval(pg_get_serial_sequence(%s, 'id'), GREATEST(%s, (SELECT COALESCE(MAX(id), 1) FROM {table})))",
+                    [table, base]
+                )
+            elif connection.vendor == "mysql":
+                cursor.execute(f"ALTER TABLE {table} AUTO_INCREMENT = %s", [base + 1])
@@ -0,0 +1,173 @@
+"""
+Offline discrete-event simulation of a queue, for staffing and capacity planning.
+
+A simulated day runs the dispatch policy the views run, in memory: a freed
+counter takes the waiting token get_next_token() would return (highest
+priority, then lowest number, only the queue's priority levels), and a new
+token goes to the counter CounterPool.candidates() would offer (the one idle
+longest). Tokens arrive as a Poisson process with a rate per hour of day, get
+a priority from the queue's priority mix and a service time drawn from the
+observed ones. fit() estimates all three from a queue's recent live and
+archived tokens; any of them can be overridden to ask "what if".
+
+simulate() runs many independent days, split across a process pool, and
+reports wait time percentiles per priority from one-minute histograms, so
+what comes back from each worker is a few fixed-size arrays per batch of days
+whatever the number of tokens.
+"""
+import heapq
+import os
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import repeat
+
+import django
+import numpy as np
+from django.db.models import Count
+from django.utils import timezone
+
+from .analytics import HISTOGRAM_MINUTES, Epoch, minutes_histogram, percentiles
+from .counter_pool import CounterPool
+from .models import ArchivedToken, Token
+
+
+DAYS_PER_TASK = 50
+# service times kept from history; drawn from with replacement
+MAX_SERVICE_SAMPLES = 10000
+
+
+class QueueModel:
+    """What a simulated day is drawn from. Plain data, so it pickles to the worker processes."""
+
+    def __init__(self, hourly_arrivals, priority_mix, service_seconds):
+        self.hourly_arrivals = np.asarray(hourly_arrivals, float)  # expected arrivals per hour of day
+        self.priority_mix = {int(p): float(w) for p, w in priority_mix.items() if w > 0}
+        self.service_seconds = np.asarray(service_seconds, float)
+
+    def scaled(self, factor):
+        return QueueModel(self.hourly_arrivals * factor, self.priority_mix, self.service_seconds)
+
+    def with_mix(self, priority_mix):
+        return QueueModel(self.hourly_arrivals, priority_mix, self.service_seconds)
+
+    def summary(self):
+        return {
+            "arrivals_per_day": round(float(self.hourly_arrivals.sum()), 1),
+            "hourly_arrivals": [round(float(rate), 2) for rate in self.hourly_arrivals],
+            "priority_mix": self.priority_mix,
+            "mean_service_seconds": round(float(self.service_seconds.mean()), 1),
+            "service_samples": int(self.service_seconds.size),
+        }
+
+
+def fit(queue, days=30, now=None):
+    """A QueueModel from the queue's tokens created in the last `days` days, live and archived."""
+    since = (now or timezone.now()) - timedelta(days=days)
+    offset = timezone.localtime(since).utcoffset().total_seconds()
+    arrivals = np.zeros(24)
+    mix = {}
+    services = []
+    for model in (Token, ArchivedToken):
+        rows = model.objects.filter(queue=queue, created_at__gte=since)
+        created = np.array(rows.annotate(epoch=Epoch('created_at')).values_list('epoch', flat=True), float)
+        arrivals += np.bincount(((created + offset) // 3600 % 24).astype(np.int64), minlength=24)
+        for priority, count in rows.values_list('priority').annotate(count=Count('id')).order_by():
+            mix[priority] = mix.get(priority, 0) + count
+        done = rows.filter(status="COMPLETED", called_at__isnull=False, completed_at__isnull=False)
+        services.append(np.array(
+            done.annotate(called=Epoch('called_at'), completed=Epoch('completed_at'))
+            .order_by('-completed_at').values_list('called', 'completed')[:MAX_SERVICE_SAMPLES], float
+        ).reshape(-1, 2))
+
+    services = np.concatenate(services)
+    service_seconds = services[:, 1] - services[:, 0]
+    service_seconds = service_seconds[service_seconds >= 0][:MAX_SERVICE_SAMPLES]
+    if not service_seconds.size:
+        service_seconds = np.array([queue.avg_handle_time * 60.0])
+    mix = {priority: count for priority, count in mix.items() if priority in queue.priority_levels}
+    return QueueModel(arrivals / days, mix or {min(queue.priority_levels): 1}, service_seconds)
+
+
+def simulate_day(model, counters, rng):
+    """
+    One day with `counters` open counters. Returns the arrival times and
+    priorities and the waits of its tokens in seconds, the total busy seconds
+    and the seconds from the first arrival to the last completion.
+    """
+    counts = rng.poisson(model.hourly_arrivals)
+    arrived = np.sort(np.concatenate([hour * 3600 + rng.uniform(0, 3600, count) for hour, count in enumerate(counts)]))
+    levels = np.array(list(model.priority_mix))
+    weights = np.array(list(model.priority_mix.values()))
+    priorities = rng.choice(levels, arrived.size, p=weights / weights.sum())
+    services = rng.choice(model.service_seconds, arrived.size)
+    waits = np.zeros(arrived.size)
+    if not arrived.size:
+        return arrived, priorities, waits, 0.0, 0.0
+
+    pool = CounterPool((counter_id, "OPEN", False) for counter_id in range(counters))
+    # plain lists: indexing numpy arrays one element at a time is slow
+    arrivals, ranks, service = arrived.tolist(), (-priorities).tolist(), services.tolist()
+    waiting = []  # (-priority, token number): get_next_token's order
+    busy = []  # (free at, counter id)
+    now = 0.0
+    number = 0
+    while number < len(arrivals) or waiting or busy:
+        # a completion at the same moment as an arrival frees its counter first
+        if busy and (number == len(arrivals) or busy[0][0] <= arrivals[number]):
+            now, counter_id = heapq.heappop(busy)
+            pool.release(counter_id)
+        else:
+            now = arrivals[number]
+            heapq.heappush(waiting, (ranks[number], number))
+            number += 1
+        while waiting and pool.free:
+            counter_id = next(iter(pool.free))
+            pool.claim(counter_id)
+            _, token = heapq.heappop(waiting)
+            waits[token] = now - arrivals[token]
+            heapq.heappush(busy, (now + service[token], counter_id))
+    return arrived, priorities, waits, float(services.sum()), now - arrivals[0]
+
+
+def run_days(model, counters, days, seed):
+    """Simulate `days` days; returns wait histograms per priority, busy and open seconds summed over them."""
+    rng = np.random.default_rng(seed)
+    histograms = {priority: np.zeros(HISTOGRAM_MINUTES + 1, np.int64) for priority in model.priority_mix}
+    busy_seconds = open_seconds = 0.0
+    for _ in range(days):
+        _, priorities, waits, busy, span = simulate_day(model, counters, rng)
+        for priority in histograms:
+            histograms[priority] += minutes_histogram(waits[priorities == priority])
+        busy_seconds += busy
+        open_seconds += span
+    return histograms, busy_seconds, open_seconds
+
+
+def simulate(model, counters, days, workers=None, seed=0):
+    """
+    Simulate `days` days with `counters` counters across `workers` processes
+    (all CPU cores by default, 1 runs in this process). Seeded, so a run can be repeated.
+    """
+    tasks = [min(DAYS_PER_TASK, days - start) for start in range(0, days, DAYS_PER_TASK)]
+    seeds = np.random.SeedSequence(seed).spawn(len(tasks))
+    workers = workers or os.cpu_count()
+    if workers == 1:
+        results = [run_days(model, counters, count, task_seed) for count, task_seed in zip(tasks, seeds)]
+    else:
+        # spawned workers import this module, and with it the models, so they set Django up first
+        with ProcessPoolExecutor(min(workers, len(tasks)), initializer=django.setup) as pool:
+            results = list(pool.map(run_days, repeat(model), repeat(counters), tasks, seeds))
+
+    histograms = {priority: sum(result[0][priority] for result in results) for priority in model.priority_mix}
+    busy_seconds = sum(result[1] for result in results)
+    open_seconds = sum(result[2] for result in results)
+    overall = sum(histograms.values())
+    return {
+        "counters": counters,
+        "days": days,
+        "utilization": round(busy_seconds / (open_seconds * counters), 4) if open_seconds else None,
+        "wait_minutes": {"all": {"tokens": int(overall.sum()), **percentiles(overall)}, **{
+            priority: {"tokens": int(histogram.sum()), **percentiles(histogram)}
+            for priority, histogram in sorted(histograms.items())
+        }},
+    }
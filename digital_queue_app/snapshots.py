@@ -0,0 +1,124 @@
+"""
+Per-queue live snapshot behind the dashboard endpoint.
+
+Each queue has one QueueSnapshot row holding what a waiting-room screen
+shows: how many tokens are waiting, every counter with the token it is
+serving, and the next few tokens in dispatch order. The views update the row
+inside the same transaction as the token or counter change, with the row
+locked, so the dashboard is one primary key (or one table) read however many
+tokens and queues there are.
+
+Joins, calls, skips and completions are applied as deltas. Only when a call or
+skip takes a token out of next_tokens is the list refilled, with one LIMIT
+query on the waiting dispatch index. A missing row is built from scratch.
+"""
+from .models import Counter, Queue, QueueSnapshot, Token
+
+
+NEXT_TOKENS = 5
+
+
+def token_entry(token):
+    return {"id": token.id, "token_number": token.token_number, "priority": token.priority}
+
+def serving_entry(token):
+    return {**token_entry(token), "called_at": token.called_at}
+
+def dispatch_key(entry):
+    return (-entry["priority"], entry["token_number"])
+
+def next_waiting(queue_id):
+    waiting = Token.objects.filter(queue_id=queue_id, status="WAITING").order_by('-priority', 'token_number')
+    return [token_entry(token) for token in waiting.only('id', 'token_number', 'priority')[:NEXT_TOKENS]]
+
+
+def build(queue):
+    serving = {
+        token.counter_id: serving_entry(token)
+        for token in Token.objects.filter(queue=queue, status="SERVING").only('id', 'token_number', 'priority', 'counter_id', 'called_at')
+    }
+    counters = [
+        {"id": counter_id, "name": name, "state": state, "serving": serving.get(counter_id)}
+        for counter_id, name, state in Counter.objects.filter(queue=queue).order_by('id').values_list('id', 'name', 'state')
+    ]
+    return {
+        "queue_name": queue.name,
+        "waiting_count": Token.objects.filter(queue=queue, status="WAITING").count(),
+        "counters": counters,
+        "next_tokens": next_waiting(queue.id),
+    }
+
+def rebuild(queue):
+    QueueSnapshot.objects.update_or_create(queue=queue, defaults=build(queue))
+
+def created(queue):
+    QueueSnapshot.objects.create(queue=queue, queue_name=queue.name)
+
+
+def _locked(queue_id):
+    """The snapshot row locked for update, or None if it was just built and is already current."""
+    snapshot = QueueSnapshot.objects.select_for_update().filter(queue_id=queue_id).first()
+    if snapshot is None:
+        rebuild(Queue.objects.get(id=queue_id))
+    return snapshot
+
+
+def apply(queue_id, joined=(), left=(), called=(), finished=()):
+    """
+    Fold token changes, already written in this transaction, into the snapshot.
+
+    joined: tokens that are now WAITING. left: tokens that were WAITING and
+    no longer are. called: tokens now SERVING. finished: tokens that were
+    SERVING and no longer are.
+    """
+    snapshot = _locked(queue_id)
+    if snapshot is None:
+        return
+
+    snapshot.waiting_count += len(joined) - len(left)
+
+    left_ids = {token.id for token in left}
+    next_tokens = [entry for entry in snapshot.next_tokens if entry["id"] not in left_ids]
+    if len(next_tokens) < len(snapshot.next_tokens) and snapshot.waiting_count > len(next_tokens):
+        next_tokens = next_waiting(queue_id)
+    else:
+        next_tokens = sorted(next_tokens + [token_entry(token) for token in joined], key=dispatch_key)[:NEXT_TOKENS]
+    snapshot.next_tokens = next_tokens
+
+    finished_ids = {token.id for token in finished}
+    serving = {token.counter_id: serving_entry(token) for token in called}
+    for counter in snapshot.counters:
+        if counter["serving"] and counter["serving"]["id"] in finished_ids:
+            counter["serving"] = None
+        if counter["id"] in serving:
+            counter["serving"] = serving.pop(counter["id"])
+
+    if serving:
+        # a counter the snapshot has not seen (created outside the views)
+        rebuild(Queue.objects.get(id=queue_id))
+        return
+    snapshot.save()
+
+def counter_saved(counter):
+    snapshot = _locked(counter.queue_id)
+    if snapshot is None:
+        return
+
+    for entry in snapshot.counters:
+        if entry["id"] == counter.id:
+            entry.update(name=counter.name, state=counter.state)
+            break
+    else:
+        snapshot.counters.append({"id": counter.id, "name": counter.name, "state": counter.state, "serving": None})
+    snapshot.save()
+
+
+def data(snapshot):
+    return {
+        "queue": snapshot.queue_id,
+        "name": snapshot.queue_name,
+        "waiting_count": snapshot.waiting_count,
+        "counters": snapshot.counters,
+        "next_tokens": snapshot.next_tokens,
+        "updated_at": snapshot.updated_at,
+    }
@@ -0,0 +1,104 @@
+import asyncio
+import json
+
+from asgiref.sync import sync_to_async
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import JsonResponse, StreamingHttpResponse
+
+from . import caching, eta, positions, sharding
+from .events import get_broker, queue_channel
+from .models import Queue, Token
+from .views import current_serving_data, my_token_status_data, waiting_fields, waiting_status
+
+
+# Server-Sent Event streams. These are plain async Django views (DRF's
+# @api_view is sync only) and are meant to be served through asgi.py, where an
+# idle subscriber is a parked coroutine rather than a worker thread.
+
+HEARTBEAT_SECONDS = 15
+
+
+def sse(event_type, data):
+    return f"event: {event_type}\ndata: {json.dumps(data, cls=DjangoJSONEncoder)}\n\n"
+
+def event_stream(stream):
+    response = StreamingHttpResponse(stream, content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+def cached_waiting_status(token):
+    """
+    waiting_status() from the in-process position index and ETA estimator,
+    or None when either is not loaded. Every subscriber of a queue recomputes
+    its position on every event, so that must not mean a trip each through
+    the one thread sync_to_async runs database work in.
+    """
+    rank = positions.cached_position(token)
+    if rank is None:
+        return None
+    minutes = eta.cached_minutes(token.queue_id, rank[0])
+    if minutes is None:
+        return None
+    return waiting_fields(*rank, minutes)
+
+async def next_event(subscription):
+    try:
+        return await subscription.get(HEARTBEAT_SECONDS)
+    except asyncio.TimeoutError:
+        return None
+
+
+@sharding.routed
+async def queue_events(request, queue_id):
+    if not await Queue.objects.filter(id=queue_id).aexists():
+        return JsonResponse({"error": "Queue not found"}, status=404)
+    # the stream is read after this view returns, outside its shard
+    serving_data = sync_to_async(sharding.bound(current_serving_data))
+
+    async def stream():
+        # subscribe before the snapshot so nothing between the two is missed
+        subscription = get_broker().subscribe(queue_channel(queue_id))
+        try:
+            yield sse("serving", await serving_data(queue_id))
+            while True:
+                event = await next_event(subscription)
+                yield sse(event["type"], event) if event else ": ping\n\n"
+        finally:
+            subscription.close()
+
+    return event_stream(stream())
+
+
+@sharding.routed
+async def token_events(request, token_id):
+    queue_id = await sync_to_async(caching.token_queue_id)(token_id)
+    if queue_id is None:
+        return JsonResponse({"error": "Token not found"}, status=404)
+    status_data = sync_to_async(sharding.bound(my_token_status_data))
+    position_data = sync_to_async(sharding.bound(waiting_status))
+    load_token = sync_to_async(sharding.bound(Token.objects.select_related('queue').get))
+
+    async def stream():
+        subscription = get_broker().subscribe(queue_channel(queue_id))
+        try:
+            status = await status_data(token_id)
+            yield sse("status", status)
+
+            token = await load_token(id=token_id)
+            while status["status"] in ("WAITING", "SERVING"):
+                event = await next_event(subscription)
+                if event is None:
+                    yield ": ping\n\n"
+                elif event["token"] == token_id:
+                    status = await status_data(token_id)
+                    yield sse("status", status)
+                elif status["status"] == "WAITING":
+                    position = cached_waiting_status(token) or await position_data(token)
+                    if any(status[field] != value for field, value in position.items()):
+                        status.update(position)
+                        yield sse("position", position)
+        finally:
+            subscription.close()
+
+    return event_stream(stream())
@@ -1,3 +1,1595 @@
-from django.test import TestCase
+import asyncio
+import json
+import re
+import threading
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+import numpy as np
+from asgiref.sync import async_to_sync, sync_to_async
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, connections
+from django.db.migrations.executor import MigrationExecutor
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.renderers import JSONRenderer
+from rest_framework.test import APIClient
+
+from . import analytics, caching, counter_pool, eta, events, idempotency, metrics, notifications, positions, ratelimit, sharding, simulation, snapshots, transitions, views
+from .archive import archive_tokens
+from .coalescing import AsyncSingleFlight, SingleFlight
+from .models import ArchivedToken, Counter, DailyQueueStats, IdempotencyKey, Queue, QueueShard, QueueSnapshot, Token, TokenTransition
+from .eta import QueueEstimator
+from .management.commands.load_test import compare
+from .positions import QueuePositions
+from .pagination import encode_cursor
+from .rebalance import move_queue
+from .routers import read_only
+from .serializers import TOKEN_ROW, TokenSerializer
+from .views import get_next_token
+
+
+class QueueAPITestCase(TestCase):
+    """Drops the in-process position index, counter pool, ETA state, response cache and rate limits between tests."""
+
+    def setUp(self):
+        positions.clear()
+        counter_pool.clear()
+        eta.clear()
+        cache.clear()
+        caching.reset_stats()
+        ratelimit.clear()
+
+
+class JoinQueueTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+
+    def join(self, queue=None, **extra):
+        data = {"queue": (queue or self.queue).id, "user_name": "Asha", "phone_number": "9999999999"}
+        data.update(extra)
+        return self.client.post("/join/", data, format="json")
+
+    def test_token_numbers_are_sequential_per_queue(self):
+        other = Queue.objects.create(name="Pharmacy")
+        numbers = [self.join().data["token"]["token_number"] for _ in range(3)]
+        self.assertEqual(numbers, [1, 2, 3])
+        self.assertEqual(self.join(other).data["token"]["token_number"], 1)
+
+        self.queue.refresh_from_db()
+        self.assertEqual(self.queue.last_token_number, 3)
+
+    def test_allocation_does_not_scan_token_table(self):
+        self.join()
+        with CaptureQueriesContext(connection) as ctx:
+            self.join()
+        token_reads = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("SELECT") and "digital_queue_app_token" in q["sql"]]
+        self.assertFalse([sql for sql in token_reads if "ORDER BY" in sql])
+
+    def test_priority_must_be_a_queue_level(self):
+        queue = Queue.objects.create(name="Triage", priority_levels=[5, 10])
+        self.assertEqual(self.join(queue, priority=1).status_code, 400)
+        self.assertEqual(self.join(queue).data["token"]["priority"], 5)
+        self.assertEqual(self.join(queue, priority="x").data, {"error": "queue and priority must be integers"})
+
+    def test_create_queue_parses_priority_levels(self):
+        create = lambda data, format=None: self.client.post("/create-queue/", {"name": "Triage", **data}, format=format)
+        self.assertEqual(create({"priority_levels": [10, 1]}, "json").data["queue"]["priority_levels"], [1, 10])
+        # a form post repeats the field
+        self.assertEqual(create({"priority_levels": ["3", "1"]}).data["queue"]["priority_levels"], [1, 3])
+        for levels in ("10", [], ["x"]):
+            self.assertEqual(create({"priority_levels": levels}, "json").status_code, 400)
+
+
+class IdempotentJoinTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        self.kiosk = Queue.objects.create(name="Kiosk", one_token_per_phone=True)
+
+    def join(self, queue=None, key=None, **extra):
+        data = {"queue": (queue or self.queue).id, "user_name": "Asha", "phone_number": "9999999999"}
+        data.update(extra)
+        headers = {"Idempotency-Key": key} if key else None
+        return self.client.post("/join/", data, format="json", headers=headers)
+
+    def test_create_queue_parses_one_token_per_phone(self):
+        for value, expected in (("false", False), ("0", False), ("true", True)):
+            # a form post, as HTML forms send it
+            queue = self.client.post("/create-queue/", {"name": "Kiosk", "one_token_per_phone": value}).data["queue"]
+            self.assertIs(queue["one_token_per_phone"], expected)
+        self.assertEqual(self.client.post("/create-queue/", {"name": "Kiosk", "one_token_per_phone": "maybe"}).status_code, 400)
+
+    def test_retry_with_the_same_key_replays_the_token(self):
+        first = self.join(key="abc")
+        again = self.join(key="abc")
+        self.assertEqual((again.status_code, again["Idempotent-Replayed"]), (201, "true"))
+        self.assertFalse(first.has_header("Idempotent-Replayed"))
+        self.assertEqual(again.data["token"]["id"], first.data["token"]["id"])
+        self.assertEqual(Token.objects.count(), 1)
+        # stored hashed
+        self.assertEqual(IdempotencyKey.objects.get().key, idempotency.digest("abc"))
+
+        other = self.join(key="abc", user_name="Ravi")
+        self.assertEqual(other.status_code, 422)
+        self.assertEqual(self.join(key="def").data["token"]["token_number"], 2)
+
+    def test_expired_key_joins_again(self):
+        first = self.join(key="abc")
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(hours=25))
+        again = self.join(key="abc")
+        self.assertNotEqual(again.data["token"]["id"], first.data["token"]["id"])
+        self.assertEqual(IdempotencyKey.objects.get().token_id, again.data["token"]["id"])
+
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(hours=25))
+        self.assertEqual(idempotency.purge(), 1)
+
+    def test_one_active_token_per_phone(self):
+        first = self.join(self.kiosk)
+        duplicate = self.join(self.kiosk, user_name="Ravi")
+        self.assertEqual(duplicate.status_code, 409)
+        self.assertEqual(duplicate.data["token_id"], first.data["token"]["id"])
+        self.assertEqual(self.join(self.kiosk, phone_number="1").status_code, 201)
+
+        Token.objects.filter(id=first.data["token"]["id"]).update(status="COMPLETED")
+        self.assertEqual(self.join(self.kiosk).status_code, 201)
+        # other queues keep allowing it
+        self.assertEqual([self.join().status_code for _ in range(2)], [201, 201])
+
+    def test_duplicate_check_is_an_index_probe(self):
+        self.join(self.kiosk)
+        with CaptureQueriesContext(connection) as ctx:
+            self.join(self.kiosk)
+        token_reads = [q["sql"] for q in ctx.captured_queries if q["sql"].startswith("SELECT") and "digital_queue_app_token" in q["sql"]]
+        self.assertEqual(len(token_reads), 1)
+        plan = connection.cursor().execute("EXPLAIN QUERY PLAN " + token_reads[0]).fetchall()
+        self.assertIn("unique_active_phone_per_queue", str(plan))
+
+
+class DispatchTests(TestCase):
+    def setUp(self):
+        self.queue = Queue.objects.create(name="Billing")
+
+    def add(self, number, priority, status="WAITING", queue=None):
+        return Token.objects.create(queue=queue or self.queue, token_number=number, priority=priority, status=status)
+
+    def test_highest_priority_then_lowest_number(self):
+        self.add(1, 1)
+        self.add(2, 2)
+        self.add(3, 3, status="SKIPPED")
+        expected = self.add(4, 2)
+        self.add(5, 2)
+        Token.objects.filter(token_number=2).update(status="COMPLETED")
+        self.assertEqual(get_next_token(self.queue), expected)
+
+    def test_configured_priority_levels(self):
+        queue = Queue.objects.create(name="Triage", priority_levels=[1, 5])
+        self.add(1, 1, queue=queue)
+        urgent = self.add(2, 5, queue=queue)
+        self.assertEqual(get_next_token(queue), urgent)
+
+    def test_single_query_even_when_idle(self):
+        with self.assertNumQueries(1):
+            self.assertIsNone(get_next_token(self.queue))
+        self.add(1, 1)
+        with self.assertNumQueries(1):
+            self.assertIsNotNone(get_next_token(self.queue))
+
+
+class CallNextTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        self.counters = [Counter.objects.create(name=f"C{n}", queue=self.queue) for n in (1, 2)]
+        self.tokens = [Token.objects.create(queue=self.queue, token_number=n) for n in (1, 2, 3)]
+
+    def call_next(self):
+        return self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+
+    def complete(self, **data):
+        return self.client.post(f"/complete/{self.queue.id}/", data, format="json")
+
+    def test_each_call_claims_a_distinct_counter(self):
+        first, second = self.call_next().data["token"], self.call_next().data["token"]
+        self.assertEqual({first["counter"], second["counter"]}, {c.id for c in self.counters})
+        self.assertEqual(self.call_next().data["message"], "No free counters available")
+        self.assertEqual(Token.objects.filter(status="WAITING").count(), 1)
+
+    def test_no_waiting_tokens_leaves_counters_free(self):
+        Token.objects.update(status="COMPLETED")
+        self.assertEqual(self.call_next().data["message"], "No waiting tokens")
+        self.assertFalse(Counter.objects.filter(is_busy=True).exists())
+
+    def test_complete_by_counter(self):
+        self.call_next()
+        second = self.call_next().data["token"]
+        response = self.complete(counter_id=second["counter"])
+        self.assertEqual(response.data["token"]["id"], second["id"])
+        self.assertEqual(list(Counter.objects.filter(is_busy=False).values_list("id", flat=True)), [second["counter"]])
+
+    def test_complete_by_token(self):
+        first = self.call_next().data["token"]
+        self.call_next()
+        self.assertEqual(self.complete(token_id=first["id"]).data["token"]["id"], first["id"])
+        self.assertEqual(self.complete(token_id=first["id"]).status_code, 404)
+        self.assertEqual(self.complete(token_id="abc").status_code, 400)
+        self.assertEqual(self.complete(counter_id=[1]).status_code, 400)
+
+    def test_skipping_a_serving_token_frees_its_counter(self):
+        token = self.call_next().data["token"]
+        self.client.post(f"/skip/{token['id']}/")
+        self.assertFalse(Counter.objects.get(id=token["counter"]).is_busy)
+
+    def test_finished_tokens_cannot_be_skipped(self):
+        token = self.call_next().data["token"]
+        self.complete(token_id=token["id"])
+        response = self.client.post(f"/skip/{token['id']}/")
+        self.assertEqual((response.status_code, response.data["error"]), (409, "Token is COMPLETED"))
+        self.assertEqual(Token.objects.get(id=token["id"]).status, "COMPLETED")
+        self.assertEqual(
+            list(TokenTransition.objects.filter(token_id=token["id"]).values_list("event", flat=True)),
+            [TokenTransition.CALLED, TokenTransition.COMPLETED],
+        )
+        self.client.post(f"/skip/{self.tokens[1].id}/")
+        self.assertEqual(self.client.post(f"/skip/{self.tokens[1].id}/").status_code, 409)
+
+
+class QueuePositionsTests(TestCase):
+    def test_rank_follows_dispatch_order(self):
+        index = QueuePositions([(1, 1), (1, 4), (2, 2), (3, 5), (1, 6)])
+        self.assertEqual(index.rank(3, 5), (0, 4))
+        self.assertEqual(index.rank(2, 2), (1, 3))
+        self.assertEqual(index.rank(1, 4), (3, 1))
+        index.remove(3, 5)
+        index.add(2, 7)
+        self.assertEqual(index.rank(1, 4), (3, 1))
+        self.assertEqual(index.rank(2, 7), (1, 3))
+
+
+class MyTokenStatusTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", avg_handle_time=4)
+        Counter.objects.create(name="C1", queue=self.queue)
+
+    def join(self, priority=1):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post("/join/", {
+                "queue": self.queue.id, "user_name": "Asha", "phone_number": "1", "priority": priority
+            }, format="json")
+        return response.data["token"]
+
+    def status(self, token):
+        return self.client.get(f"/my-token/{token['id']}/").data
+
+    def test_positions_respect_priority_and_stay_current(self):
+        first, second, urgent = self.join(), self.join(), self.join(priority=3)
+        self.assertEqual(urgent["estimated_wait_time"], "1 min")
+        self.assertEqual((self.status(first)["people_ahead"], self.status(first)["people_behind"]), (1, 1))
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/skip/{first['id']}/")
+
+        with self.assertNumQueries(2):
+            data = self.status(second)
+        self.assertEqual((data["people_ahead"], data["people_behind"], data["estimated_wait_time"]), (0, 0, "0 mins"))
+
+    def test_index_is_loaded_from_the_token_table(self):
+        Token.objects.bulk_create(Token(queue=self.queue, token_number=n, priority=n % 2 + 1) for n in range(1, 7))
+        token = Token.objects.get(queue=self.queue, token_number=5)
+        self.assertEqual(positions.position(token), (2, 3))
+        with self.settings(QUEUE_POSITION_INDEX=False):
+            self.assertEqual(positions.position(token), (2, 3))
+
+    def test_index_is_reloaded_for_other_workers_changes(self):
+        token = Token.objects.create(queue=self.queue, token_number=1, priority=1)
+        self.assertEqual(positions.position(token), (0, 0))
+        # joined through another worker process, whose commits this one never sees
+        Token.objects.create(queue=self.queue, token_number=2, priority=3)
+        self.assertEqual(positions.position(token), (0, 0))
+        later = time.monotonic() + 11
+        with mock.patch("digital_queue_app.positions.time.monotonic", return_value=later):
+            self.assertIsNone(positions.cached_position(token))
+            self.assertEqual(positions.position(token), (1, 0))
+
+    def test_commits_during_a_load_are_kept(self):
+        token = Token.objects.create(queue=self.queue, token_number=1, priority=1)
+        joined = Token(queue=self.queue, token_number=2, priority=3)
+
+        def load(waiting):
+            # committed here after the read, so the read did not see it
+            positions._apply("add", joined)
+            return QueuePositions(waiting)
+
+        with mock.patch.object(positions, "QueuePositions", load):
+            self.assertEqual(positions.position(token), (1, 0))
+
+    def test_polls_are_cached_until_the_queue_changes(self):
+        token = self.join()
+        first = self.client.get(f"/my-token/{token['id']}/")
+        self.client.get(f"/serving/{self.queue.id}/")
+        with self.assertNumQueries(0):
+            again = self.client.get(f"/my-token/{token['id']}/", HTTP_IF_NONE_MATCH=first["ETag"])
+            cached = self.client.get(f"/my-token/{token['id']}/")
+        self.assertEqual(again.status_code, 304)
+        self.assertEqual(cached.data, first.data)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+        changed = self.client.get(f"/my-token/{token['id']}/", HTTP_IF_NONE_MATCH=first["ETag"])
+        self.assertEqual(changed.status_code, 200)
+        self.assertEqual(changed.data["status"], "SERVING")
+        self.assertEqual(self.client.get(f"/serving/{self.queue.id}/").data[0]["id"], token["id"])
+        self.assertEqual(caching.stats(), {"hits": 1, "misses": 4, "not_modified": 1, "coalesced": 0, "hit_ratio": 0.3333333333333333})
+
+    def test_other_queues_stay_cached(self):
+        other = Queue.objects.create(name="Pharmacy")
+        self.client.get(f"/serving/{other.id}/")
+        with self.captureOnCommitCallbacks(execute=True):
+            self.join()
+        with self.assertNumQueries(0):
+            self.client.get(f"/serving/{other.id}/")
+
+
+class EtaTests(QueueAPITestCase):
+    def test_estimator_blends_counter_rates(self):
+        estimator = QueueEstimator(300, counter_ids=[1, 2])
+        self.assertEqual(estimator.seconds_per_position(), 150)
+        estimator.record_service(1, 100)
+        self.assertEqual(estimator.service_seconds, 260)
+        self.assertAlmostEqual(estimator.seconds_per_position(), 1 / (1 / 100 + 1 / 260))
+        self.assertAlmostEqual(estimator.wait_seconds(3), 3 / (1 / 100 + 1 / 260))
+
+    def test_wait_tracks_counters_and_observed_service_times(self):
+        client = APIClient()
+        queue = Queue.objects.create(name="Billing", avg_handle_time=10, last_token_number=5)
+        Counter.objects.create(name="C1", queue=queue)
+        Token.objects.bulk_create(Token(queue=queue, token_number=n) for n in range(1, 6))
+        last = Token.objects.get(token_number=5)
+        self.assertEqual(client.get(f"/my-token/{last.id}/").data["estimated_wait_time"], "40 mins")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post("/create-counter/", {"name": "C2", "queue_id": queue.id}, format="json")
+        self.assertEqual(client.get(f"/my-token/{last.id}/").data["estimated_wait_time"], "20 mins")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post("/next/", {"queue_id": queue.id}, format="json")
+        Token.objects.filter(status="SERVING").update(called_at=timezone.now() - timedelta(minutes=2))
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f"/complete/{queue.id}/")
+
+        # C1 now averages 2 minutes a token, C2 still the queue's 8.4
+        data = client.get(f"/my-token/{last.id}/").data
+        self.assertEqual(data["people_ahead"], 3)
+        self.assertEqual(data["estimated_wait_time"], f"{round(3 / (1 / 120 + 1 / 504) / 60)} mins")
+
+    def test_only_open_counters_serve(self):
+        client = APIClient()
+        queue = Queue.objects.create(name="Billing", avg_handle_time=10)
+        counters = [Counter.objects.create(name=f"C{n}", queue=queue) for n in range(5)]
+        queue.last_token_number = 4
+        queue.save()
+        Token.objects.bulk_create(Token(queue=queue, token_number=n) for n in range(1, 5))
+        last = Token.objects.get(token_number=4)
+        self.assertEqual(client.get(f"/my-token/{last.id}/").data["estimated_wait_time"], "6 mins")
+
+        with self.captureOnCommitCallbacks(execute=True):
+            for counter, state in zip(counters[1:], ("CLOSED", "CLOSED", "ON_BREAK", "CLOSED")):
+                client.post(f"/counters/{counter.id}/state/", {"state": state}, format="json")
+        self.assertEqual(client.get(f"/my-token/{last.id}/").data["estimated_wait_time"], "30 mins")
+        with self.captureOnCommitCallbacks(execute=True):
+            client.post(f"/counters/{counters[3].id}/state/", {"state": "OPEN"}, format="json")
+        self.assertEqual(eta.wait_minutes(queue.id, 3), 15)
+        # and the same when loaded afresh
+        eta.clear()
+        self.assertEqual(eta.wait_minutes(queue.id, 3), 15)
+
+
+class EventStreamTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = Queue.objects.create(name="Billing")
+        Counter.objects.create(name="C1", queue=self.queue)
+        self.first = self.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"}).data["token"]
+        self.second = self.post("/join/", {"queue": self.queue.id, "user_name": "B", "phone_number": "2"}).data["token"]
+
+    def post(self, path, data=None):
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(path, data, format="json")
+
+    async def read(self, stream):
+        chunk = await asyncio.wait_for(anext(stream), 1)
+        event_type, data = chunk.decode().strip().split("\n")
+        return event_type.removeprefix("event: "), json.loads(data.removeprefix("data: "))
+
+    async def test_queue_stream_pushes_state_changes(self):
+        response = await self.async_client.get(f"/serving/{self.queue.id}/events/")
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        stream = aiter(response.streaming_content)
+        self.assertEqual(await self.read(stream), ("serving", []))
+
+        await sync_to_async(self.post)("/next/", {"queue_id": self.queue.id})
+        event_type, event = await self.read(stream)
+        self.assertEqual((event_type, event["token"], event["status"]), ("called", self.first["id"], "SERVING"))
+        await stream.aclose()
+
+    async def test_token_stream_pushes_position_then_call(self):
+        response = await self.async_client.get(f"/my-token/{self.second['id']}/events/")
+        stream = aiter(response.streaming_content)
+        event_type, status = await self.read(stream)
+        self.assertEqual((event_type, status["people_ahead"]), ("status", 1))
+
+        await sync_to_async(self.post)("/next/", {"queue_id": self.queue.id})
+        self.assertEqual(await self.read(stream), ("position", {
+            "people_ahead": 0, "people_behind": 0, "estimated_wait_time": "0 mins"
+        }))
+
+        await sync_to_async(self.post)(f"/complete/{self.queue.id}/")
+        await sync_to_async(self.post)("/next/", {"queue_id": self.queue.id})
+        event_type, status = await self.read(stream)
+        self.assertEqual((event_type, status["status"]), ("status", "SERVING"))
+        await stream.aclose()
+
+    async def test_token_streams_follow_positions_in_memory(self):
+        third = await sync_to_async(self.post)("/join/", {"queue": self.queue.id, "user_name": "C", "phone_number": "3"})
+        with mock.patch("digital_queue_app.stream_views.waiting_status", wraps=views.waiting_status) as from_db:
+            streams = []
+            for token in (self.second, third.data["token"]):
+                response = await self.async_client.get(f"/my-token/{token['id']}/events/")
+                streams.append(aiter(response.streaming_content))
+                await self.read(streams[-1])
+
+            await sync_to_async(self.post)("/next/", {"queue_id": self.queue.id})
+            self.assertEqual([(await self.read(stream))[1]["people_ahead"] for stream in streams], [0, 1])
+        # every subscriber read its new position from the loaded indexes
+        from_db.assert_not_called()
+        for stream in streams:
+            await stream.aclose()
+
+    async def test_broker_delivers_across_threads(self):
+        broker = events.InProcessBroker()
+        subscription = broker.subscribe("queue:1")
+        await sync_to_async(broker.publish, thread_sensitive=False)("queue:1", {"type": "called"})
+        self.assertEqual(await subscription.get(1), {"type": "called"})
+        subscription.close()
+        self.assertEqual(broker.subscriber_count(), 0)
+
+    async def test_unknown_queue(self):
+        response = await self.async_client.get("/serving/999/events/")
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(ROOT_URLCONF="digital_queue_project.asgi_urls")
+class AsyncViewTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = Queue.objects.create(name="Billing", avg_handle_time=4)
+        Counter.objects.create(name="C1", queue=self.queue)
+        client = APIClient()
+        with self.captureOnCommitCallbacks(execute=True), self.settings(ROOT_URLCONF="digital_queue_project.urls"):
+            self.tokens = [
+                client.post("/join/", {"queue": self.queue.id, "user_name": name, "phone_number": "1"}, format="json").data["token"]
+                for name in ("A", "B", "C")
+            ]
+            client.post("/next/", {"queue_id": self.queue.id}, format="json")
+
+    def sync_get(self, path):
+        with self.settings(ROOT_URLCONF="digital_queue_project.urls"):
+            return APIClient().get(path)
+
+    async def test_responses_match_the_sync_views(self):
+        paths = [
+            f"/my-token/{self.tokens[0]['id']}/", f"/my-token/{self.tokens[2]['id']}/",
+            f"/serving/{self.queue.id}/", "/queues/?limit=1", "/queues/?limit=x",
+            "/my-token/999/", "/join/",
+        ]
+        for path in paths:
+            expected = await sync_to_async(self.sync_get)(path)
+            await sync_to_async(cache.clear)()
+            response = await self.async_client.get(path)
+            self.assertEqual(response.status_code, expected.status_code, path)
+            self.assertEqual(response.content, expected.content, path)
+            # the cache was cleared in between, so the versions differ but not the presence
+            self.assertEqual(response.has_header("ETag"), expected.has_header("ETag"), path)
+            self.assertEqual(response["Content-Type"], expected["Content-Type"], path)
+
+    async def test_poll_revalidates_with_etag(self):
+        path = f"/my-token/{self.tokens[1]['id']}/"
+        first = await self.async_client.get(path)
+        again = await self.async_client.get(path, headers={"If-None-Match": first["ETag"]})
+        self.assertEqual((again.status_code, again.content), (304, b""))
+
+    async def test_database_work_is_metered(self):
+        await sync_to_async(cache.clear)()
+        metrics.reset()
+        await self.async_client.get(f"/serving/{self.queue.id}/")
+        # the read runs in a sync_to_async thread and is still counted
+        _, _, queries, query_seconds, _, _ = metrics._merged()
+        self.assertEqual((queries["current_serving"].count, queries["current_serving"].sum), (1, 1))
+        self.assertGreater(query_seconds["current_serving"], 0)
+
+    async def test_join(self):
+        response = await self.async_client.post(
+            "/join/", {"queue": self.queue.id, "user_name": "D", "phone_number": "4", "priority": 2},
+            content_type="application/json"
+        )
+        self.assertEqual(response.status_code, 201)
+        token = json.loads(response.content)["token"]
+        self.assertEqual((token["token_number"], token["priority"]), (4, 2))
+        status = json.loads((await self.async_client.get(f"/my-token/{token['id']}/")).content)
+        self.assertEqual((status["people_ahead"], status["people_behind"]), (0, 2))
+        self.assertEqual(await QueueSnapshot.objects.filter(queue=self.queue).values_list('waiting_count', flat=True).aget(), 3)
+
+        missing = await self.async_client.post("/join/", {"queue": self.queue.id}, content_type="application/json")
+        self.assertEqual(missing.status_code, 400)
+        unknown = await self.async_client.post(
+            "/join/", {"queue": 999, "user_name": "E", "phone_number": "5"}, content_type="application/json"
+        )
+        self.assertEqual(unknown.status_code, 404)
+        bad_priority = await self.async_client.post(
+            "/join/", {"queue": self.queue.id, "user_name": "E", "phone_number": "5", "priority": "x"}, content_type="application/json"
+        )
+        self.assertEqual(bad_priority.status_code, 400)
+        not_allowed = await self.async_client.put("/join/")
+        self.assertEqual((not_allowed.status_code, not_allowed["Allow"]), (405, "GET, POST, OPTIONS"))
+
+
+class CoalescingTests(QueueAPITestCase):
+    def test_concurrent_builds_of_a_key_run_once(self):
+        flights, started, release, builds = SingleFlight(), threading.Event(), threading.Event(), []
+
+        def build():
+            builds.append(1)
+            started.set()
+            release.wait()
+            return {"built": len(builds)}
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.do("k", build)))
+        leader.start()
+        started.wait()
+        followers = [threading.Thread(target=lambda: results.append(flights.do("k", build))) for _ in range(5)]
+        for thread in followers:
+            thread.start()
+        # followers are parked on the leader's flight before it finishes
+        while len(flights._flights["k"].done._cond._waiters) < 5:
+            pass
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+        self.assertEqual(len(builds), 1)
+        self.assertEqual(sorted(shared for _, shared in results), [False] + [True] * 5)
+        self.assertTrue(all(data == {"built": 1} for data, _ in results))
+        self.assertEqual(flights.do("k", lambda: "again"), ("again", False))
+
+    def test_errors_are_shared_too(self):
+        flights = AsyncSingleFlight()
+
+        async def build():
+            await asyncio.sleep(0)
+            raise Token.DoesNotExist
+
+        async def burst():
+            return await asyncio.gather(*(flights.do("k", build) for _ in range(3)), return_exceptions=True)
+
+        self.assertTrue(all(isinstance(e, Token.DoesNotExist) for e in async_to_sync(burst)()))
+
+    @override_settings(ROOT_URLCONF="digital_queue_project.asgi_urls")
+    def test_async_poll_burst_builds_once(self):
+        queue = Queue.objects.create(name="Billing")
+        Token.objects.create(queue=queue, token_number=1, status="SERVING")
+
+        async def burst():
+            return await asyncio.gather(*(self.async_client.get(f"/serving/{queue.id}/") for _ in range(20)))
+
+        with CaptureQueriesContext(connection) as queries:
+            responses = async_to_sync(burst)()
+        self.assertEqual({response.status_code for response in responses}, {200})
+        self.assertEqual(caching.stats()["coalesced"], 19)
+        self.assertEqual(len(queries), 1)
+
+
+@override_settings(QUEUE_RATE_LIMITS={"token": (0.5, 2), "ip": (100, 3)})
+class RateLimitTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        self.tokens = [Token.objects.create(queue=self.queue, token_number=n) for n in (1, 2)]
+
+    def test_token_bucket_with_retry_after(self):
+        path = f"/my-token/{self.tokens[0].id}/"
+        with mock.patch("digital_queue_app.ratelimit.time.monotonic", return_value=100.0) as clock:
+            self.assertEqual([self.client.get(path).status_code for _ in range(2)], [200, 200])
+            limited = self.client.get(path)
+            self.assertEqual((limited.status_code, limited["Retry-After"]), (429, "2"))
+            # a poll of another token only takes from the IP bucket, the rejected one took nothing
+            self.assertEqual(self.client.get(f"/my-token/{self.tokens[1].id}/").status_code, 200)
+            self.assertEqual(self.client.get(f"/serving/{self.queue.id}/").status_code, 429)
+            self.assertEqual(self.client.get(f"/serving/{self.queue.id}/", REMOTE_ADDR="10.0.0.2").status_code, 200)
+
+            clock.return_value = 102.0
+            self.assertEqual(self.client.get(path).status_code, 200)
+
+    @override_settings(ROOT_URLCONF="digital_queue_project.asgi_urls", QUEUE_CLIENT_IP_HEADER="X-Forwarded-For")
+    def test_async_views_answer_like_drf(self):
+        sync_response = None
+        for _ in range(3):
+            sync_response = self.client.get(f"/my-token/{self.tokens[0].id}/", HTTP_X_FORWARDED_FOR="10.0.0.3, 10.0.0.1")
+        ratelimit.clear()
+        for _ in range(3):
+            async_response = async_to_sync(self.async_client.get)(
+                f"/my-token/{self.tokens[0].id}/", headers={"X-Forwarded-For": "10.0.0.3"}
+            )
+        self.assertEqual((async_response.status_code, async_response.content), (429, sync_response.content))
+        self.assertEqual(async_response["Retry-After"], sync_response["Retry-After"])
+
+
+class BulkEndpointTests(TransactionTestCase):
+    # Real commits, so the ETAs in the bulk join response see the on_commit
+    # position updates exactly as they happen in production.
+
+    def setUp(self):
+        positions.clear()
+        counter_pool.clear()
+        eta.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", avg_handle_time=2)
+        self.other = Queue.objects.create(name="Pharmacy")
+        snapshots.created(self.queue)
+        snapshots.created(self.other)
+
+    def post(self, path, data):
+        return self.client.post(path, data, format="json")
+
+    def test_bulk_join_assigns_contiguous_blocks(self):
+        self.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"})
+        entry = {"queue": self.queue.id, "user_name": "B", "phone_number": "2"}
+        # queue lookup, BEGIN, sequence bump + read + INSERT + snapshot read and
+        # write per queue, one transition log INSERT, COMMIT, then loading the
+        # position index and ETA state of the second queue
+        with self.assertNumQueries(19):
+            response = self.post("/join/bulk/", {"tokens": [
+                entry, {"queue": self.other.id, "user_name": "C", "phone_number": "3"}, entry,
+                {"queue": 999, "user_name": "D", "phone_number": "4"}, {"queue": self.queue.id},
+            ]})
+        self.assertEqual(response.status_code, 201)
+        results = response.data["results"]
+        self.assertEqual([r["token"]["token_number"] for r in results[:3]], [2, 1, 3])
+        self.assertEqual([r["token"]["estimated_wait_time"] for r in results[:3]], ["2 mins", "1 min", "4 mins"])
+        self.assertEqual(results[3], {"error": "Queue not found"})
+        self.assertIn("error", results[4])
+        self.assertEqual(Token.objects.count(), 4)
+
+    def test_bulk_join_one_token_per_phone(self):
+        kiosk = Queue.objects.create(name="Kiosk", one_token_per_phone=True)
+        existing = self.post("/join/", {"queue": kiosk.id, "user_name": "A", "phone_number": "1"}).data["token"]
+        results = self.post("/join/bulk/", {"tokens": [
+            {"queue": kiosk.id, "user_name": name, "phone_number": phone}
+            for name, phone in (("A", "1"), ("B", "2"), ("B", "2"))
+        ] + [{"queue": self.queue.id, "user_name": "C", "phone_number": "3"}] * 2}).data["results"]
+        self.assertEqual(results[0]["token_id"], existing["id"])
+        self.assertEqual(results[1]["token"]["token_number"], 2)
+        self.assertEqual(results[2]["token_id"], results[1]["token"]["id"])
+        self.assertEqual([r["token"]["token_number"] for r in results[3:]], [1, 2])
+
+    def test_bulk_skip_and_complete(self):
+        Counter.objects.create(name="C1", queue=self.queue)
+        joined = self.post("/join/bulk/", {"tokens": [
+            {"queue": self.queue.id, "user_name": str(n), "phone_number": str(n)} for n in range(4)
+        ]}).data["results"]
+        ids = [r["token"]["id"] for r in joined]
+        self.post("/next/", {"queue_id": self.queue.id})
+
+        response = self.post("/complete/bulk/", {"token_ids": ids})
+        self.assertEqual([r.get("status") for r in response.data["results"]], ["COMPLETED", None, None, None])
+        self.assertFalse(Counter.objects.get().is_busy)
+
+        response = self.post("/skip/bulk/", {"token_ids": ids[1:3] + [999]})
+        self.assertEqual(response.data["message"], "2 tokens skipped")
+        self.assertEqual(self.client.get(f"/my-token/{ids[3]}/").data["people_ahead"], 0)
+        self.assertEqual(self.post("/skip/bulk/", {"token_ids": "all"}).status_code, 400)
+
+    def test_bulk_skip_of_serving_tokens_is_one_update(self):
+        Counter.objects.bulk_create(Counter(name=f"C{n}", queue=self.queue) for n in range(5))
+        ids = [r["token"]["id"] for r in self.post("/join/bulk/", {"tokens": [
+            {"queue": self.queue.id, "user_name": str(n), "phone_number": str(n)} for n in range(5)
+        ]}).data["results"]]
+        for _ in ids:
+            self.post("/next/", {"queue_id": self.queue.id})
+        # BEGIN, locking read, token and counter UPDATEs, snapshot read and
+        # write, transition log INSERT, COMMIT; nothing per token
+        with self.assertNumQueries(8):
+            self.assertEqual(self.post("/skip/bulk/", {"token_ids": ids}).data["message"], "5 tokens skipped")
+
+
+class CounterPoolTests(TransactionTestCase):
+    # Real commits, so the pool sees every claim and release as in production.
+    counters = 50
+
+    def setUp(self):
+        positions.clear()
+        counter_pool.clear()
+        eta.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", last_token_number=500)
+        self.counter_ids = [Counter.objects.create(name=f"C{n}", queue=self.queue).id for n in range(self.counters)]
+        Token.objects.bulk_create(Token(queue=self.queue, token_number=n) for n in range(1, 501))
+
+    def call_next(self, **data):
+        return self.client.post("/next/", {"queue_id": self.queue.id, **data}, format="json")
+
+    def set_state(self, counter_id, state):
+        return self.client.post(f"/counters/{counter_id}/state/", {"state": state}, format="json")
+
+    def test_every_counter_is_called_once_before_any_twice(self):
+        called = [self.call_next().data["token"] for _ in range(self.counters)]
+        self.assertEqual(sorted(token["counter"] for token in called), self.counter_ids)
+        self.assertEqual(self.call_next().data["message"], "No free counters available")
+
+    def test_work_is_spread_over_all_counters(self):
+        # one token at a time: the old lowest-free-id lookup sent every one to the first counter
+        for _ in range(self.counters * 4):
+            token = self.call_next().data["token"]
+            self.client.post(f"/complete/{self.queue.id}/", {"token_id": token["id"]}, format="json")
+        served = Token.objects.filter(status="COMPLETED").values_list("counter_id", flat=True)
+        self.assertEqual(sorted(served), sorted(self.counter_ids * 4))
+
+    def test_call_next_for_a_counter(self):
+        mine = self.counter_ids[17]
+        token = self.call_next(counter_id=mine).data["token"]
+        self.assertEqual((token["counter"], token["token_number"]), (mine, 1))
+        self.assertEqual(self.call_next(counter_id=mine).data["error"], "Counter is busy")
+
+        other = Queue.objects.create(name="Pharmacy")
+        response = self.client.post("/next/", {"queue_id": other.id, "counter_id": mine}, format="json")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(Token.objects.filter(status="SERVING").count(), 1)
+
+    def test_counters_on_break_or_closed_are_skipped(self):
+        for counter_id in self.counter_ids[:48]:
+            self.set_state(counter_id, "ON_BREAK")
+        self.set_state(self.counter_ids[48], "CLOSED")
+        self.assertEqual(self.set_state(self.counter_ids[0], "LUNCH").status_code, 400)
+
+        self.assertEqual(self.call_next().data["token"]["counter"], self.counter_ids[49])
+        self.assertEqual(self.call_next().data["message"], "No free counters available")
+        self.assertEqual(self.call_next(counter_id=self.counter_ids[0]).data["error"], "Counter is ON_BREAK")
+
+        self.set_state(self.counter_ids[0], "OPEN")
+        self.assertEqual(self.call_next().data["token"]["counter"], self.counter_ids[0])
+        self.assertEqual(counter_pool.summary(self.queue.id), {
+            "states": {"OPEN": 2, "ON_BREAK": 47, "CLOSED": 1}, "busy": 2, "free": 0,
+        })
+
+    def test_stale_pool_falls_back_to_the_database(self):
+        self.call_next()
+        # every counter but the last was taken by another worker process
+        Counter.objects.exclude(id=self.counter_ids[-1]).update(is_busy=True)
+        self.assertEqual(self.call_next().data["token"]["counter"], self.counter_ids[-1])
+        self.assertEqual(self.call_next().data["message"], "No free counters available")
+
+
+class MetricsTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        metrics.reset()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        self.counter = Counter.objects.create(name="C1", queue=self.queue)
+
+    def scrape(self):
+        response = self.client.get("/metrics")
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        return response.content.decode().splitlines()
+
+    def test_requests_transitions_and_queue_gauges(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            for _ in range(3):
+                self.client.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"}, format="json")
+            self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+        lines = self.scrape()
+
+        self.assertIn('queue_http_requests_total{view="join_queue",method="POST",status="201"} 3', lines)
+        self.assertIn('queue_http_request_duration_seconds_count{view="call_next",method="POST"} 1', lines)
+        self.assertIn('queue_db_queries_per_request_count{view="join_queue"} 3', lines)
+        self.assertIn('queue_token_transitions_total{event="joined"} 3', lines)
+        self.assertIn('queue_token_transitions_total{event="called"} 1', lines)
+        self.assertIn(f'queue_waiting_tokens{{queue="{self.queue.id}",priority="1"}} 2', lines)
+        self.assertIn(f'queue_counters{{queue="{self.queue.id}",state="OPEN",busy="true"}} 1', lines)
+        self.assertTrue(any(line.startswith(f'queue_actual_wait_seconds{{queue="{self.queue.id}",quantile="0.95"}}') for line in lines))
+
+    def test_slow_query_log_is_opt_in(self):
+        token = Token.objects.create(queue=self.queue, token_number=1)
+        with override_settings(QUEUE_SLOW_QUERY_THRESHOLD=0), self.assertLogs("digital_queue_app.slow_requests") as logs:
+            APIClient().get(f"/my-token/{token.id}/")
+        self.assertIn(f"GET /my-token/{token.id}/ ran", logs.output[0])
+
+
+class LoadTestCompareTests(TestCase):
+    def report(self, p95_ms, queries=2.0, errors=0):
+        endpoint = {"requests": 100, "errors": errors, "throughput_rps": 50.0, "p50_ms": 4.0,
+                    "p95_ms": p95_ms, "queries_per_request": queries}
+        return {"endpoints": {"join": endpoint}}
+
+    def test_flags_only_regressions_beyond_the_allowance(self):
+        baseline = self.report(10.0)
+        self.assertEqual(compare(self.report(12.0), baseline, 0.25), [])
+        self.assertEqual(compare(self.report(13.0), baseline, 0.25), ["join p95_ms: 10.0 -> 13.0"])
+        self.assertEqual(compare(self.report(10.0, queries=3.0), baseline, 0.25), ["join queries_per_request: 2.0 -> 3.0"])
+        self.assertEqual(compare(self.report(10.0, errors=5), baseline, 0.25), ["join errors: 0/100 -> 5/100"])
+
+
+class AnalyticsTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", last_token_number=4)
+        self.c1 = Counter.objects.create(name="C1", queue=self.queue)
+        self.c2 = Counter.objects.create(name="C2", queue=self.queue)
+        self.day = timezone.localdate() - timedelta(days=2)
+        at = lambda hour, minute: analytics.day_bounds(self.day)[0] + timedelta(hours=hour, minutes=minute)
+        Token.objects.bulk_create([
+            Token(queue=self.queue, token_number=1, status="COMPLETED", counter=self.c1,
+                  created_at=at(9, 0), called_at=at(9, 10), completed_at=at(9, 15)),
+            Token(queue=self.queue, token_number=3, status="SKIPPED", created_at=at(10, 0)),
+            Token(queue=self.queue, token_number=4, status="SKIPPED", counter=self.c1, created_at=at(10, 5), called_at=at(10, 20)),
+        ])
+        ArchivedToken.objects.create(
+            token_id=2, queue=self.queue, token_number=2, priority=1, status="COMPLETED", counter_id=self.c2.id,
+            created_at=at(9, 30), called_at=at(9, 50), completed_at=at(10, 10), user_name="B", phone_number="2",
+        )
+
+    def test_report_of_live_and_archived_tokens(self):
+        report = analytics.report(self.queue.id, self.day - timedelta(days=1), self.day)
+        self.assertEqual((report["joined"], report["completed"], report["skipped"], report["skip_rate"]), (4, 2, 2, 0.5))
+        self.assertEqual([day["joined"] for day in report["by_day"]], [0, 4])
+        self.assertEqual(
+            [(row["hour"], row["joined"], row["completed"]) for row in report["by_hour"] if row["joined"] or row["completed"]],
+            [(9, 2, 1), (10, 2, 1)]
+        )
+        wait = report["wait_minutes"]
+        self.assertEqual((wait["count"], wait["mean"], wait["p50"]), (3, 15.0, 15.5))
+        self.assertEqual((report["service_minutes"]["count"], report["service_minutes"]["mean"]), (2, 12.5))
+        # busy time against the hour from the first call to the last completion
+        self.assertEqual(
+            [(c["id"], c["served"], c["utilization"]) for c in report["counters"]],
+            [(self.c1.id, 1, 0.0833), (self.c2.id, 1, 0.3333)]
+        )
+
+    def test_days_are_cached(self):
+        analytics.report(self.queue.id, self.day, self.day)
+        with self.assertNumQueries(0):
+            analytics.report(self.queue.id, self.day, self.day)
+
+    def test_endpoint(self):
+        response = self.client.get(f"/analytics/{self.queue.id}/", {"from": self.day.isoformat(), "to": self.day.isoformat()})
+        self.assertEqual((response.status_code, response.data["joined"]), (200, 4))
+        self.assertEqual(len(self.client.get(f"/analytics/{self.queue.id}/").data["by_day"]), 7)
+        self.assertEqual(self.client.get(f"/analytics/{self.queue.id}/", {"from": "yesterday"}).status_code, 400)
+        self.assertEqual(self.client.get(f"/analytics/{self.queue.id}/", {"from": "2025-01-01", "to": "2026-06-01"}).status_code, 400)
+        self.assertEqual(self.client.get("/analytics/999/").status_code, 404)
+
+
+class SimulationTests(QueueAPITestCase):
+    def model(self, per_hour=6.0, service=600.0):
+        return simulation.QueueModel([per_hour] * 24, {1: 85, 2: 12, 3: 3}, [service])
+
+    def test_day_follows_the_dispatch_policy(self):
+        model = self.model()
+        arrived, priorities, waits, busy, _ = simulation.simulate_day(model, 1, np.random.default_rng(1))
+        started = arrived + waits
+        for token in range(arrived.size):
+            # nobody who was already waiting with a better dispatch key started later
+            waiting = (arrived <= started[token]) & (started > started[token])
+            better = (-priorities < -priorities[token]) | ((priorities == priorities[token]) & (np.arange(arrived.size) < token))
+            self.assertFalse((waiting & better).any())
+        self.assertEqual(busy, 600.0 * arrived.size)
+
+    def test_more_counters_wait_less_and_runs_repeat(self):
+        model = self.model()
+        one = simulation.simulate(model, 1, 20, workers=1)
+        two = simulation.simulate(model, 2, 20, workers=1)
+        self.assertGreater(one["wait_minutes"]["all"]["p90"], two["wait_minutes"]["all"]["p90"])
+        self.assertGreater(one["wait_minutes"][1]["p50"], one["wait_minutes"][3]["p50"])
+        self.assertGreater(one["utilization"], two["utilization"])
+        # the days are split into seeded tasks, so a process pool gives the same result
+        self.assertEqual(simulation.simulate(model, 2, 120, workers=2), simulation.simulate(model, 2, 120, workers=1))
+
+    def test_fit_from_history(self):
+        queue = Queue.objects.create(name="Billing", priority_levels=[1, 2])
+        start = analytics.day_bounds(timezone.localdate() - timedelta(days=1))[0]
+        Token.objects.bulk_create([
+            Token(queue=queue, token_number=n, priority=1 + n % 2, status="COMPLETED", created_at=start + timedelta(hours=9),
+                  called_at=start + timedelta(hours=10), completed_at=start + timedelta(hours=10, minutes=n))
+            for n in range(1, 5)
+        ])
+        model = simulation.fit(queue, days=2)
+        self.assertEqual(model.hourly_arrivals[9], 2.0)
+        self.assertEqual(model.priority_mix, {1: 2.0, 2: 2.0})
+        self.assertEqual(sorted(model.service_seconds), [60, 120, 180, 240])
+
+
+class DashboardTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = self.post("/create-queue/", {"name": "Billing"}).data["queue"]["id"]
+        self.counters = [
+            self.post("/create-counter/", {"name": f"C{n}", "queue_id": self.queue}).data["counter"]["id"]
+            for n in range(3)
+        ]
+
+    def post(self, path, data=None):
+        return self.client.post(path, data or {}, format="json")
+
+    def join(self, priority=1):
+        return self.post("/join/", {"queue": self.queue, "user_name": "A", "phone_number": "1", "priority": priority}).data["token"]
+
+    def assertSnapshotCurrent(self):
+        snapshot = QueueSnapshot.objects.get(queue_id=self.queue)
+        expected = json.loads(json.dumps(snapshots.build(snapshot.queue), cls=DjangoJSONEncoder))
+        self.assertEqual({field: getattr(snapshot, field) for field in expected}, expected)
+        return snapshot
+
+    def test_snapshot_follows_every_transition(self):
+        tokens = [self.join(priority) for priority in (1, 1, 3, 2, 1, 1, 1, 1)]
+        snapshot = self.assertSnapshotCurrent()
+        self.assertEqual(snapshot.waiting_count, 8)
+        self.assertEqual([t["id"] for t in snapshot.next_tokens], [tokens[i]["id"] for i in (2, 3, 0, 1, 4)])
+
+        called = self.post("/next/", {"queue_id": self.queue}).data["token"]
+        self.post("/next/", {"queue_id": self.queue})
+        self.assertSnapshotCurrent()
+        self.post(f"/skip/{tokens[1]['id']}/")
+        self.post(f"/skip/{called['id']}/")
+        self.assertSnapshotCurrent()
+        self.post(f"/complete/{self.queue}/", {})
+        self.assertSnapshotCurrent()
+
+        entry = {"queue": self.queue, "user_name": "B", "phone_number": "2", "priority": 2}
+        self.post("/join/bulk/", {"tokens": [entry] * 3})
+        self.assertSnapshotCurrent()
+        self.post("/next/", {"queue_id": self.queue})
+        self.post("/skip/bulk/", {"token_ids": [tokens[4]["id"], tokens[5]["id"]]})
+        serving = Token.objects.filter(queue_id=self.queue, status="SERVING").values_list("id", flat=True)
+        self.post("/complete/bulk/", {"token_ids": list(serving)})
+        self.assertSnapshotCurrent()
+
+        self.post(f"/counters/{self.counters[1]}/state/", {"state": "ON_BREAK"})
+        self.post("/create-counter/", {"name": "C3", "queue_id": self.queue})
+        snapshot = self.assertSnapshotCurrent()
+        self.assertEqual([c["state"] for c in snapshot.counters], ["OPEN", "ON_BREAK", "OPEN", "OPEN"])
+
+    def test_dashboard_is_a_single_read(self):
+        other = self.post("/create-queue/", {"name": "Pharmacy"}).data["queue"]["id"]
+        for _ in range(20):
+            self.join()
+            self.post("/join/", {"queue": other, "user_name": "A", "phone_number": "1"})
+        self.post("/next/", {"queue_id": self.queue})
+
+        with self.assertNumQueries(1):
+            queues = self.client.get("/dashboard/").data["queues"]
+        self.assertEqual([(q["name"], q["waiting_count"]) for q in queues], [("Billing", 19), ("Pharmacy", 20)])
+        self.assertEqual(sum(bool(c["serving"]) for c in queues[0]["counters"]), 1)
+        self.assertEqual(len(queues[0]["next_tokens"]), snapshots.NEXT_TOKENS)
+
+        with self.assertNumQueries(1):
+            self.assertEqual(self.client.get(f"/dashboard/{other}/").data["waiting_count"], 20)
+        self.assertEqual(self.client.get("/dashboard/999/").status_code, 404)
+
+    def test_missing_snapshot_is_rebuilt(self):
+        self.join()
+        QueueSnapshot.objects.all().delete()
+        self.join()
+        self.assertEqual(self.assertSnapshotCurrent().waiting_count, 2)
+
+
+class ListEndpointTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", last_token_number=25)
+        other = Queue.objects.create(name="Pharmacy", last_token_number=5)
+        same_moment = timezone.now()
+        Token.objects.bulk_create(
+            [Token(queue=self.queue, token_number=n, priority=n % 3 + 1, created_at=same_moment) for n in range(1, 26)]
+            + [Token(queue=other, token_number=n, status="COMPLETED") for n in range(1, 6)]
+        )
+
+    def test_cursor_pages_cover_every_token_once(self):
+        seen, url = [], "/tokens/?limit=7"
+        while url:
+            page = self.client.get(url).data
+            seen += [token["id"] for token in page["results"]]
+            url = page["next"]
+        self.assertEqual(sorted(seen), list(Token.objects.order_by("id").values_list("id", flat=True)))
+        self.assertEqual(len(seen), len(set(seen)))
+
+    def test_filters(self):
+        page = self.client.get("/tokens/", {"queue": self.queue.id, "priority": 3, "status": "WAITING"}).data
+        self.assertEqual([t["token_number"] for t in page["results"]], list(range(2, 26, 3)))
+        later = (timezone.now() + timedelta(days=1)).isoformat()
+        self.assertEqual(self.client.get("/tokens/", {"created_after": later}).data["results"], [])
+        self.assertEqual(self.client.get("/tokens/", {"status": "LOST"}).status_code, 400)
+        self.assertEqual(self.client.get("/tokens/", {"cursor": "nonsense"}).status_code, 400)
+        # tampered cursors: decodable, but not a datetime and an id
+        for values in (["x", "y"], [{"a": 1}, 2], [timezone.now().isoformat(), "1"], ["2026-13-01T00:00:00", 1]):
+            self.assertEqual(self.client.get("/tokens/", {"cursor": encode_cursor(values)}).status_code, 400)
+        self.assertEqual(self.client.get("/queues/", {"cursor": encode_cursor([True])}).status_code, 400)
+
+    def test_ndjson_export_matches_pages(self):
+        response = self.client.get("/tokens/", {"export": "ndjson", "queue": self.queue.id})
+        self.assertEqual(response["Content-Type"], "application/x-ndjson")
+        rows = [json.loads(line) for line in b"".join(response.streaming_content).splitlines()]
+        page = self.client.get("/tokens/", {"queue": self.queue.id, "limit": 1000}).data["results"]
+        self.assertEqual(rows, json.loads(json.dumps(page)))
+
+    def test_queue_and_counter_pages(self):
+        Counter.objects.create(name="C1", queue=self.queue)
+        self.assertEqual(len(self.client.get("/queues/", {"limit": 1}).data["results"]), 1)
+        self.assertIsNotNone(self.client.get("/queues/", {"limit": 1}).data["next"])
+        self.assertEqual(len(self.client.get("/counters/", {"queue": self.queue.id}).data["results"]), 1)
+
+
+class RowSerializerTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.queue = Queue.objects.create(name="Billing")
+        counter = Counter.objects.create(name="C1", queue=self.queue)
+        called_at = timezone.now().replace(microsecond=123456)
+        Token.objects.bulk_create([
+            Token(queue=self.queue, token_number=1, user_name="Åsa", phone_number="1"),
+            Token(queue=self.queue, token_number=2, status="SERVING", counter=counter, called_at=called_at),
+            Token(queue=self.queue, token_number=3, status="COMPLETED", priority=3, called_at=called_at.replace(microsecond=0)),
+        ])
+
+    def assertSameBytes(self, data, expected):
+        self.assertEqual(JSONRenderer().render(data), JSONRenderer().render(expected))
+
+    def test_rows_render_like_the_model_serializer(self):
+        tokens = Token.objects.order_by("id")
+        for zone in ("UTC", "Asia/Kolkata"):
+            with timezone.override(zone):
+                self.assertSameBytes(TOKEN_ROW.data(TOKEN_ROW.rows(tokens)), TokenSerializer(tokens, many=True).data)
+
+                serving = TokenSerializer(tokens.filter(status="SERVING"), many=True).data
+                for token in serving:
+                    token.pop("queue")
+                    token.pop("status")
+                self.assertSameBytes(views.current_serving_data(self.queue.id), serving)
+
+    def test_token_status(self):
+        token = Token.objects.get(token_number=2)
+        data = views.my_token_status_data(token.id)
+        self.assertEqual(list(data), [
+            "id", "token_number", "created_at", "user_name", "phone_number", "queue", "priority", "status",
+            "avg_handle_time", "called_at"
+        ])
+        self.assertEqual((data["queue"], data["avg_handle_time"], data["called_at"]), (self.queue.id, "5 mins", token.called_at))
+
+
+class ArchiveTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", last_token_number=6)
+        self.old = timezone.now() - timedelta(days=2)
+        self.tokens = Token.objects.bulk_create([
+            Token(queue=self.queue, token_number=1, status="COMPLETED", created_at=self.old,
+                  called_at=self.old + timedelta(minutes=10), completed_at=self.old + timedelta(minutes=14)),
+            Token(queue=self.queue, token_number=2, status="COMPLETED", created_at=self.old,
+                  called_at=self.old + timedelta(minutes=20), completed_at=self.old + timedelta(minutes=26)),
+            Token(queue=self.queue, token_number=3, status="SKIPPED", created_at=self.old),
+            Token(queue=self.queue, token_number=4, status="WAITING", created_at=self.old),
+            Token(queue=self.queue, token_number=5, status="COMPLETED"),
+            Token(queue=self.queue, token_number=6, status="WAITING"),
+        ])
+
+    def test_moves_old_finished_tokens_and_rolls_up_daily_stats(self):
+        cutoff = timezone.now() - timedelta(days=1)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEqual(archive_tokens(cutoff, batch_size=2), 3)
+
+        self.assertEqual(sorted(Token.objects.values_list("token_number", flat=True)), [4, 5, 6])
+        self.assertEqual(sorted(ArchivedToken.objects.values_list("token_number", flat=True)), [1, 2, 3])
+        stats = DailyQueueStats.objects.get(queue=self.queue, date=timezone.localdate(self.old))
+        self.assertEqual((stats.completed, stats.skipped, stats.called, stats.served), (2, 1, 2, 2))
+        self.assertEqual(stats.total_wait_seconds, 30 * 60)
+        self.assertEqual(stats.total_service_seconds, 10 * 60)
+
+        # nothing left to archive, and the sequence carries on after archived numbers
+        self.assertEqual(archive_tokens(cutoff), 0)
+        response = self.client.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"}, format="json")
+        self.assertEqual(response.data["token"]["token_number"], 7)
+
+    def test_status_of_archived_token_is_not_found(self):
+        token_id = self.tokens[0].id
+        self.assertEqual(self.client.get(f"/my-token/{token_id}/").status_code, 200)
+        with self.captureOnCommitCallbacks(execute=True):
+            archive_tokens(timezone.now() - timedelta(days=1))
+        self.assertEqual(self.client.get(f"/my-token/{token_id}/").status_code, 404)
+
+
+class TransitionLogTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        self.counter = Counter.objects.create(name="C1", queue=self.queue)
+
+    def post(self, path, data=None):
+        return self.client.post(path, data or {}, format="json")
+
+    def run_queue(self):
+        ids = [
+            self.post("/join/", {"queue": self.queue.id, "user_name": name, "phone_number": name}).data["token"]["id"]
+            for name in ("A", "B")
+        ]
+        ids += [r["token"]["id"] for r in self.post("/join/bulk/", {"tokens": [
+            {"queue": self.queue.id, "user_name": name, "phone_number": name} for name in ("C", "D")
+        ]}).data["results"]]
+        self.post("/next/", {"queue_id": self.queue.id})
+        self.post(f"/complete/{self.queue.id}/")
+        self.post(f"/skip/{ids[1]}/")
+        self.post("/next/", {"queue_id": self.queue.id})
+        return ids
+
+    def test_every_transition_is_logged_in_order(self):
+        ids = self.run_queue()
+        log = list(TokenTransition.objects.order_by("id").values_list("token_id", "event", "counter_id"))
+        J, C, S, D = TokenTransition.JOINED, TokenTransition.CALLED, TokenTransition.SKIPPED, TokenTransition.COMPLETED
+        self.assertEqual(log, [
+            (ids[0], J, None), (ids[1], J, None), (ids[2], J, None), (ids[3], J, None),
+            (ids[0], C, self.counter.id), (ids[0], D, self.counter.id), (ids[1], S, None), (ids[2], C, self.counter.id),
+        ])
+        # a refused change logs nothing
+        self.post(f"/skip/{ids[0] + 999}/")
+        self.assertEqual(TokenTransition.objects.count(), 8)
+        with self.settings(QUEUE_TRANSITION_LOG=False):
+            self.post("/join/", {"queue": self.queue.id, "user_name": "E", "phone_number": "E"})
+        self.assertEqual(TokenTransition.objects.count(), 8)
+
+    def test_replay_rebuilds_queue_state(self):
+        ids = self.run_queue()
+        states, _ = transitions.replay()
+        summary = states[self.queue.id].summary()
+        self.assertEqual(summary["waiting"], 1)
+        self.assertEqual(summary["serving"], {self.counter.id: ids[2]})
+        self.assertEqual(summary["next_tokens"], [ids[3]])
+        self.assertEqual(
+            [summary[name] for name in ("last_token_number", "joined", "called", "completed", "skipped")], [4, 4, 2, 1, 1]
+        )
+
+    def test_check_and_repair_against_the_log(self):
+        ids = self.run_queue()
+        # a bad deploy brings back a skipped token and drops a waiting one
+        Token.objects.filter(id=ids[1]).update(status="WAITING")
+        Token.objects.filter(id=ids[3]).update(status="COMPLETED")
+        found = transitions.drift()
+        self.assertEqual({token_id: entry[1:3] for token_id, entry in found.items()}, {
+            ids[1]: ("WAITING", "SKIPPED"), ids[3]: ("COMPLETED", "WAITING"),
+        })
+
+        self.assertEqual(transitions.repair(found), 2)
+        self.assertEqual(Token.objects.get(id=ids[1]).status, "SKIPPED")
+        self.assertEqual(Token.objects.get(id=ids[3]).status, "WAITING")
+        self.assertEqual(QueueSnapshot.objects.get(queue=self.queue).waiting_count, 1)
+        self.assertEqual(transitions.drift(), {})
+
+
+@override_settings(
+    QUEUE_NOTIFICATION_TRANSPORT="digital_queue_app.notifications.FakeTransport",
+    QUEUE_NOTIFICATION_WORKERS=0,
+    QUEUE_NOTIFY_PEOPLE_AHEAD=(3, 1),
+)
+class NotificationTests(QueueAPITestCase):
+    def setUp(self):
+        super().setUp()
+        notifications.reset()
+        self.addCleanup(notifications.reset)
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        Counter.objects.create(name="C1", queue=self.queue)
+        self.ids = [
+            self.client.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": f"555{n}"}, format="json").data["token"]["id"]
+            for n in range(1, 7)
+        ]
+
+    def sent(self):
+        transport = notifications.get_dispatcher().transport
+        sent, transport.sent = transport.sent, []
+        return [(n.phone_number, n.kind, n.text) for n in sent]
+
+    def call_next(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/complete/{self.queue.id}/", {}, format="json")
+            self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+
+    def test_thresholds_are_texted_once_and_the_called_token_is_told(self):
+        self.call_next()
+        self.assertEqual(self.sent(), [
+            ("5551", "serving", "Token 1: it's your turn, please go to the counter."),
+            ("5552", "approaching", "Token 2: you are next, please make your way back."),
+            ("5553", "approaching", "Token 3: you are 1 away, please make your way back."),
+            ("5554", "approaching", "Token 4: you are 2 away, please make your way back."),
+            ("5555", "approaching", "Token 5: you are 3 away, please make your way back."),
+        ])
+        # 3 and 5 already heard about the threshold they are still under
+        self.call_next()
+        self.assertEqual([(phone, kind) for phone, kind, _ in self.sent()], [
+            ("5552", "serving"), ("5554", "approaching"), ("5556", "approaching"),
+        ])
+
+    def test_skip_moves_the_queue_up_and_status_tells_clients(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f"/skip/{self.ids[0]}/", format="json")
+        self.assertEqual([phone for phone, _, _ in self.sent()], ["5552", "5553", "5554", "5555"])
+        status = self.client.get(f"/my-token/{self.ids[5]}/").data
+        self.assertEqual(status["notify_at_people_ahead"], [1, 3])
+
+        with self.settings(QUEUE_NOTIFICATION_TRANSPORT=None):
+            self.call_next()
+            self.assertNotIn("notify_at_people_ahead", self.client.get(f"/my-token/{self.ids[4]}/").data)
+        self.assertEqual(self.sent(), [])
+
+    def test_worker_pool_batches_and_retries(self):
+        metrics.reset()
+        overrides = {"QUEUE_NOTIFICATION_WORKERS": 2, "QUEUE_NOTIFICATION_BATCH": 10, "QUEUE_NOTIFICATION_BACKOFF_SECONDS": 0}
+        with self.settings(**overrides), self.assertLogs("digital_queue_app.notifications", "WARNING"):
+            notifications.reset()
+            dispatcher = notifications.get_dispatcher()
+            dispatcher.transport.fail = 2
+            dispatcher.submit([notifications.Notification(str(n), "hi", n, "serving") for n in range(25)])
+            dispatcher.flush()
+        self.assertEqual(sorted(n.token_id for n in dispatcher.transport.sent), list(range(25)))
+        self.assertTrue(all(size <= 10 for size in dispatcher.transport.batches))
+        # two failed sends, retried, and at least three that went through
+        self.assertGreaterEqual(len(dispatcher.transport.batches), 5)
+
+        # given up on after the retries
+        dispatcher = notifications.Dispatcher(notifications.FakeTransport(), 0)
+        dispatcher.transport.fail = 5
+        with self.settings(QUEUE_NOTIFICATION_RETRIES=1, QUEUE_NOTIFICATION_BACKOFF_SECONDS=0), self.assertLogs("digital_queue_app.notifications", "ERROR"):
+            dispatcher.send([notifications.Notification("1", "hi", 1, "serving")])
+        lines = self.client.get("/metrics").content.decode().splitlines()
+        self.assertIn('queue_notifications_total{outcome="sent"} 25', lines)
+        self.assertIn('queue_notifications_total{outcome="failed"} 1', lines)
+
+
+@override_settings(QUEUE_READ_REPLICA="replica")
+class ReadReplicaTests(TransactionTestCase):
+    """The stand-in replica alias is a second connection to the test database."""
+
+    databases = {"default", "replica"}
+
+    def setUp(self):
+        positions.clear()
+        eta.clear()
+        cache.clear()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing")
+        Counter.objects.create(name="C1", queue=self.queue)
+
+    def queries(self, request):
+        with CaptureQueriesContext(connections["default"]) as primary, CaptureQueriesContext(connections["replica"]) as replica:
+            response = request()
+        return response, len(primary), len(replica)
+
+    def test_read_only_views_read_from_the_replica(self):
+        join = lambda: self.client.post("/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"}, format="json")
+        response, _, replica = self.queries(join)
+        self.assertEqual((response.status_code, replica), (201, 0))
+        token_id = response.data["token"]["id"]
+
+        for path in (f"/my-token/{token_id}/", f"/serving/{self.queue.id}/", "/tokens/", "/queues/", "/counters/"):
+            response, primary, replica = self.queries(lambda: self.client.get(path))
+            self.assertEqual(response.status_code, 200, path)
+            self.assertEqual(primary, 0, path)
+            self.assertGreater(replica, 0, path)
+
+    def test_writes_go_to_default(self):
+        queue = read_only(lambda: Queue.objects.get(id=self.queue.id))()
+        self.assertEqual(queue._state.db, "replica")
+        queue.name = "Pharmacy"
+        _, primary, replica = self.queries(queue.save)
+        self.assertEqual((primary, replica), (1, 0))
+        with self.settings(QUEUE_READ_REPLICA=None):
+            self.assertEqual(read_only(lambda: Queue.objects.get(id=self.queue.id))()._state.db, "default")
+
+    def test_async_views_read_from_the_replica(self):
+        with self.settings(ROOT_URLCONF="digital_queue_project.asgi_urls"):
+            response, primary, replica = self.queries(lambda: async_to_sync(self.async_client.get)(f"/serving/{self.queue.id}/"))
+        self.assertEqual((response.status_code, primary), (200, 0))
+        self.assertGreater(replica, 0)
+
+
+@override_settings(QUEUE_SHARDS=["default", "shard1"])
+class ShardingTests(TransactionTestCase):
+    """shard1 is a second SQLite test database."""
+
+    databases = {"default", "shard1"}
+
+    def setUp(self):
+        sharding.reserve_id_range("shard1")
+        positions.clear()
+        counter_pool.clear()
+        eta.clear()
+        cache.clear()
+        self.client = APIClient()
+        # the first queue goes to default, the next to shard1 (fewest queues)
+        self.home, self.remote = [self.post("/create-queue/", {"name": name}).data["queue"]["id"] for name in ("Billing", "Pharmacy")]
+
+    def post(self, path, data=None):
+        return self.client.post(path, data or {}, format="json")
+
+    def join(self, queue_id, name):
+        return self.post("/join/", {"queue": queue_id, "user_name": name, "phone_number": name}).data["token"]["id"]
+
+    def test_queue_placement_and_id_ranges(self):
+        self.assertLess(self.home, sharding.ID_SPAN)
+        self.assertGreaterEqual(self.remote, sharding.ID_SPAN)
+        self.assertEqual(sharding.shard_for_queue(self.remote), "shard1")
+        self.assertTrue(Queue.objects.using("shard1").filter(id=self.remote).exists())
+        self.assertFalse(Queue.objects.filter(id=self.remote).exists())
+        self.assertTrue(QueueSnapshot.objects.using("shard1").filter(queue_id=self.remote).exists())
+
+    def test_views_route_to_the_queue_shard(self):
+        counter = self.post("/create-counter/", {"name": "C1", "queue_id": self.remote}).data["counter"]["id"]
+        first, second = self.join(self.remote, "A"), self.join(self.remote, "B")
+        self.assertEqual(Token.objects.using("shard1").filter(queue_id=self.remote).count(), 2)
+        self.assertEqual(self.client.get(f"/my-token/{second}/").data["people_ahead"], 1)
+
+        called = self.post("/next/", {"queue_id": self.remote}).data["token"]
+        self.assertEqual((called["id"], called["counter"]), (first, counter))
+        self.assertEqual([t["id"] for t in self.client.get(f"/serving/{self.remote}/").data], [first])
+        self.assertEqual(self.client.get(f"/my-token/{second}/").data["people_ahead"], 0)
+        self.assertEqual(self.post(f"/complete/{self.remote}/").status_code, 200)
+        self.assertEqual(self.post(f"/skip/{second}/").status_code, 200)
+        self.assertEqual(self.post(f"/counters/{counter}/state/", {"state": "CLOSED"}).status_code, 200)
+        self.assertEqual(self.client.get(f"/dashboard/{self.remote}/").data["counters"][0]["state"], "CLOSED")
+        self.assertFalse(Token.objects.exists())
+
+    def test_lists_and_dashboard_merge_shards(self):
+        tokens = [self.join(queue, name) for queue, name in ((self.remote, "A"), (self.home, "B"), (self.remote, "C"))]
+        self.assertEqual([q["id"] for q in self.client.get("/queues/").data["results"]], [self.home, self.remote])
+        self.assertEqual([q["queue"] for q in self.client.get("/dashboard/").data["queues"]], [self.home, self.remote])
+
+        page = self.client.get("/tokens/", {"limit": 2})
+        self.assertEqual([t["id"] for t in page.data["results"]], tokens[:2])
+        self.assertEqual([t["id"] for t in self.client.get(page.data["next"]).data["results"]], tokens[2:])
+        self.assertEqual([t["id"] for t in self.client.get("/tokens/", {"queue": self.remote}).data["results"]], tokens[::2])
+        export = self.client.get("/tokens/", {"export": "ndjson"})
+        self.assertEqual([json.loads(line)["id"] for line in b"".join(export.streaming_content).splitlines()], tokens)
+
+    def test_bulk_endpoints_span_shards(self):
+        response = self.post("/join/bulk/", {"tokens": [
+            {"queue": queue, "user_name": "A", "phone_number": "1"} for queue in (self.remote, self.home, self.remote)
+        ]})
+        ids = [r["token"]["id"] for r in response.data["results"]]
+        self.assertEqual([r["token"]["token_number"] for r in response.data["results"]], [1, 1, 2])
+        response = self.post("/skip/bulk/", {"token_ids": ids})
+        self.assertEqual(response.data["message"], "3 tokens skipped")
+        self.assertEqual(Token.objects.using("shard1").filter(status="SKIPPED").count(), 2)
+
+    def test_move_queue(self):
+        counter = self.post("/create-counter/", {"name": "C1", "queue_id": self.home}).data["counter"]["id"]
+        done, serving, waiting = (self.join(self.home, name) for name in "ABC")
+        self.post("/next/", {"queue_id": self.home})
+        self.post(f"/complete/{self.home}/")
+        self.post("/next/", {"queue_id": self.home})
+
+        moved = move_queue(self.home, "shard1", batch_size=1)
+        self.assertEqual((moved["source"], moved["tokens"]), ("default", 3))
+        self.assertFalse(Queue.objects.filter(id=self.home).exists())
+        self.assertFalse(Token.objects.exists())
+        self.assertEqual(QueueShard.objects.get(queue_id=self.home).shard, "shard1")
+
+        self.assertEqual(self.client.get(f"/my-token/{waiting}/").data["people_ahead"], 0)
+        self.assertEqual(self.client.get(f"/my-token/{done}/").data["status"], "COMPLETED")
+        self.assertEqual([t["id"] for t in self.client.get(f"/serving/{self.home}/").data], [serving])
+        self.assertEqual(self.post(f"/complete/{self.home}/").data["token"]["counter"], counter)
+        self.assertEqual(self.join(self.home, "D") // sharding.ID_SPAN, 1)
+
+        move_queue(self.home, "default")
+        self.assertFalse(QueueShard.objects.exists())
+        self.assertEqual(Token.objects.filter(queue_id=self.home).count(), 4)
+        self.assertEqual(self.post("/next/", {"queue_id": self.home}).data["token"]["id"], waiting)
+
+
+class ConcurrentCallNextTests(TransactionTestCase):
+    workers = 32
+
+    def test_no_double_assignment(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("threads cannot share an in-memory SQLite test database")
+
+        counter_pool.clear()
+        queue = Queue.objects.create(name="Billing", last_token_number=self.workers * 2)
+        for n in range(self.workers // 2):
+            Counter.objects.create(name=f"C{n}", queue=queue)
+        Token.objects.bulk_create(Token(queue=queue, token_number=n) for n in range(1, self.workers * 2 + 1))
+
+        results, errors = [], []
+        start = threading.Barrier(self.workers)
+
+        def worker():
+            client = APIClient()
+            try:
+                start.wait()
+                response = client.post("/next/", {"queue_id": queue.id}, format="json")
+                results.append(response.data)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        called = [r["token"] for r in results if "token" in r]
+        self.assertEqual(len(called), self.workers // 2)
+        self.assertEqual(len({t["id"] for t in called}), len(called))
+        self.assertEqual(len({t["counter"] for t in called}), len(called))
+
+        serving = Token.objects.filter(queue=queue, status="SERVING")
+        self.assertEqual(serving.count(), self.workers // 2)
+        self.assertEqual(serving.values("counter").distinct().count(), self.workers // 2)
+        self.assertEqual(Counter.objects.filter(queue=queue, is_busy=False).count(), 0)
+
+
+class ConcurrentJoinTests(TransactionTestCase):
+    workers = 16
+    joins_per_worker = 10
+
+    def test_concurrent_joins_get_unique_numbers(self):
+        if connection.vendor == "sqlite" and connection.is_in_memory_db():
+            self.skipTest("threads cannot share an in-memory SQLite test database")
+
+        queue = Queue.objects.create(name="Billing")
+        errors = []
+        start = threading.Barrier(self.workers)
+
+        def worker():
+            client = APIClient()
+            try:
+                start.wait()
+                for _ in range(self.joins_per_worker):
+                    response = client.post("/join/", {
+                        "queue": queue.id, "user_name": "Asha", "phone_number": "9999999999"
+                    }, format="json")
+                    if response.status_code != 201:
+                        errors.append(response.status_code)
+            except Exception as exc:
+                errors.append(exc)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        total = self.workers * self.joins_per_worker
+        numbers = sorted(Token.objects.filter(queue=queue).values_list("token_number", flat=True))
+        self.assertEqual(numbers, list(range(1, total + 1)))
+
+
+class TokenNumberMigrationTests(TransactionTestCase):
+    before = [("digital_queue_app", "0002_token_phone_number_token_user_name")]
+    after = [("digital_queue_app", "0003_queue_last_token_number_token_unique_token_number_per_queue")]
+
+    def tearDown(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(executor.loader.graph.leaf_nodes())
+        super().tearDown()
+
+    def test_duplicate_numbers_from_the_race_are_renumbered(self):
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.before)
+        old = executor.loader.project_state(self.before).apps
+        queue = old.get_model("digital_queue_app", "Queue").objects.create(name="Billing")
+        OldToken = old.get_model("digital_queue_app", "Token")
+        ids = [OldToken.objects.create(queue=queue, token_number=number).id for number in (1, 2, 2, 3, 3, 3)]
+
+        executor = MigrationExecutor(connection)
+        executor.migrate(self.after)
+        new = executor.loader.project_state(self.after).apps
+        numbers = dict(new.get_model("digital_queue_app", "Token").objects.values_list("id", "token_number"))
+        self.assertEqual([numbers[token_id] for token_id in ids], [1, 2, 4, 3, 5, 6])
+        self.assertEqual(new.get_model("digital_queue_app", "Queue").objects.get(id=queue.id).last_token_number, 6)
+
+
+class HotPathQueryPlanTests(QueueAPITestCase):
+    """EXPLAIN every Token query issued by the hot views and reject full scans.
+
+    Probing only the bare queue FK index walks the queue's whole history, so it
+    counts as a scan too, as does sorting the result in a temp b-tree.
+    """
+
+    full_scan = {
+        "sqlite": re.compile(
+            r"\bSCAN digital_queue_app_token\b"
+            r"|USING INDEX digital_queue_app_token_queue_id_\w+ \(queue_id=\?\)$"
+            r"|USE TEMP B-TREE FOR ORDER BY",
+            re.MULTILINE,
+        ),
+        "postgresql": re.compile(r"Seq Scan on digital_queue_app_token\b|Index Scan using digital_queue_app_token_queue_id_"),
+    }
+
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.queue = Queue.objects.create(name="Billing", last_token_number=40)
+        other = Queue.objects.create(name="Pharmacy", last_token_number=40)
+        Counter.objects.create(name="C1", queue=self.queue)
+        Counter.objects.create(name="C2", queue=self.queue)
+        statuses = ["WAITING", "COMPLETED", "SKIPPED", "WAITING"]
+        Token.objects.bulk_create(
+            Token(queue=queue, token_number=n, priority=n % 3 + 1, status=statuses[n % 4])
+            for queue in (self.queue, other)
+            for n in range(1, 41)
+        )
+        self.waiting = Token.objects.filter(queue=self.queue, status="WAITING").order_by("token_number").last()
+
+    def assertNoFullScan(self, queries):
+        if connection.vendor not in self.full_scan:
+            self.skipTest(f"no plan checks for {connection.vendor}")
+        token_queries = [
+            q["sql"] for q in queries
+            if "digital_queue_app_token" in q["sql"] and q["sql"].startswith(("SELECT", "UPDATE"))
+        ]
+        self.assertTrue(token_queries)
+        explain = "EXPLAIN QUERY PLAN " if connection.vendor == "sqlite" else "EXPLAIN "
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            for sql in token_queries:
+                cursor.execute(explain + sql)
+                plan = "\n".join(" ".join(str(col) for col in row) for row in cursor.fetchall())
+                self.assertIsNone(self.full_scan[connection.vendor].search(plan), f"{sql}\n{plan}")
+
+    def assertViewIndexed(self, method, path, data=None):
+        with CaptureQueriesContext(connection) as ctx:
+            response = getattr(self.client, method)(path, data, format="json")
+        self.assertLess(response.status_code, 400)
+        self.assertNoFullScan(ctx.captured_queries)
+
+    def test_list_tokens(self):
+        self.assertViewIndexed("get", f"/tokens/?queue={self.queue.id}&limit=5")
+
+    def test_join_queue(self):
+        self.assertViewIndexed("post", "/join/", {"queue": self.queue.id, "user_name": "A", "phone_number": "1"})
+
+    def test_my_token_status(self):
+        self.assertViewIndexed("get", f"/my-token/{self.waiting.id}/")
+
+    def test_call_next(self):
+        self.assertViewIndexed("post", "/next/", {"queue_id": self.queue.id})
+
+    def test_current_serving(self):
+        self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+        self.assertViewIndexed("get", f"/serving/{self.queue.id}/")
+
+    def test_complete_token(self):
+        self.client.post("/next/", {"queue_id": self.queue.id}, format="json")
+        self.assertViewIndexed("post", f"/complete/{self.queue.id}/")
@@ -0,0 +1,216 @@
+"""
+Append-only log of token state changes.
+
+A Token row only keeps its current status, so what happened to it on the way
+(when it was skipped, who was serving when) is lost. Every join, call, skip
+and completion therefore also appends a compact TokenTransition row, inside
+the transaction that makes the change: the log commits or rolls back with
+it, and a bulk join or transition is one multi-row INSERT. Rows live on the
+queue's shard and stay when archive_tokens moves the token out.
+
+replay() reads the log back in one streaming pass, in log order per queue,
+and folds it into each queue's state (who is waiting, who is being served at
+which counter) and statistics, without reading the Token table. The
+replay_transitions command prints that and can check or repair the Token
+rows against it, e.g. after a bad deploy. Tokens that joined before the log
+existed are not in it and are left alone.
+
+QUEUE_TRANSITION_LOG = False stops writing the log.
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import caching, sharding, snapshots
+from .batching import chunks
+from .models import Counter, Queue, Token, TokenTransition
+
+
+EVENTS = {
+    "joined": TokenTransition.JOINED,
+    "called": TokenTransition.CALLED,
+    "skipped": TokenTransition.SKIPPED,
+    "completed": TokenTransition.COMPLETED,
+}
+# the token's own timestamp of the change, where it has one
+EVENT_TIMES = {"joined": "created_at", "called": "called_at", "completed": "completed_at"}
+STATUSES = {
+    TokenTransition.JOINED: "WAITING",
+    TokenTransition.CALLED: "SERVING",
+    TokenTransition.SKIPPED: "SKIPPED",
+    TokenTransition.COMPLETED: "COMPLETED",
+}
+REPLAY_CHUNK = 10000
+
+
+def enabled():
+    return getattr(settings, "QUEUE_TRANSITION_LOG", True)
+
+
+def record(tokens, event_type):
+    """Append one row per token, already changed in this transaction, with a single INSERT."""
+    if not enabled() or not tokens:
+        return
+    event = EVENTS[event_type]
+    field = EVENT_TIMES.get(event_type)
+    now = timezone.now()
+    TokenTransition.objects.bulk_create([
+        TokenTransition(
+            queue_id=token.queue_id,
+            token_id=token.id,
+            token_number=token.token_number,
+            priority=token.priority,
+            event=event,
+            counter_id=token.counter_id,
+            at=(getattr(token, field) if field else None) or now,
+        )
+        for token in tokens
+    ])
+
+
+class QueueState:
+    """One queue as its log says it is, with totals like DailyQueueStats."""
+
+    def __init__(self, queue_id):
+        self.queue_id = queue_id
+        self.waiting = {}  # token id -> (priority, token_number, joined at)
+        self.serving = {}  # token id -> (counter id, token_number, called at)
+        self.last_token_number = 0
+        self.joined = self.called = self.completed = self.skipped = 0
+        self.total_wait_seconds = 0.0
+        self.total_service_seconds = 0.0
+        self.transitions = 0
+
+    def apply(self, token_id, token_number, priority, event, counter_id, at):
+        self.transitions += 1
+        if event == TokenTransition.JOINED:
+            self.joined += 1
+            self.last_token_number = max(self.last_token_number, token_number)
+            self.waiting[token_id] = (priority, token_number, at)
+        elif event == TokenTransition.CALLED:
+            waiting = self.waiting.pop(token_id, None)
+            self.called += 1
+            if waiting:
+                self.total_wait_seconds += (at - waiting[2]).total_seconds()
+            self.serving[token_id] = (counter_id, token_number, at)
+        else:
+            self.waiting.pop(token_id, None)
+            serving = self.serving.pop(token_id, None)
+            if event == TokenTransition.SKIPPED:
+                self.skipped += 1
+            else:
+                self.completed += 1
+                if serving:
+                    self.total_service_seconds += (at - serving[2]).total_seconds()
+
+    def next_tokens(self, limit):
+        waiting = sorted(self.waiting.items(), key=lambda item: (-item[1][0], item[1][1]))
+        return [token_id for token_id, _ in waiting[:limit]]
+
+    def summary(self, next_tokens=5):
+        return {
+            "queue": self.queue_id,
+            "transitions": self.transitions,
+            "last_token_number": self.last_token_number,
+            "waiting": len(self.waiting),
+            "serving": {counter_id: token_id for token_id, (counter_id, _, _) in self.serving.items()},
+            "next_tokens": self.next_tokens(next_tokens),
+            "joined": self.joined,
+            "called": self.called,
+            "completed": self.completed,
+            "skipped": self.skipped,
+            "avg_wait_seconds": round(self.total_wait_seconds / self.called, 1) if self.called else None,
+            "avg_service_seconds": round(self.total_service_seconds / self.completed, 1) if self.completed else None,
+        }
+
+
+def replay(queue_ids=None, watch=(), chunk_size=REPLAY_CHUNK):
+    """
+    Fold the log of queue_ids (every queue when None) into a QueueState per
+    queue, streaming it from each shard. Returns (states, last), where last
+    maps each token id in watch that the log has seen to its last
+    (event, counter id, at).
+    """
+    watch = set(watch)
+    states = {}
+    last = {}
+    for alias in sharding.shards():
+        rows = TokenTransition.objects.using(alias).order_by('queue_id', 'id')
+        if queue_ids is not None:
+            rows = rows.filter(queue_id__in=list(queue_ids))
+        for queue_id, token_id, token_number, priority, event, counter_id, at in rows.values_list(
+            'queue_id', 'token_id', 'token_number', 'priority', 'event', 'counter_id', 'at'
+        ).iterator(chunk_size=chunk_size):
+            state = states.get(queue_id)
+            if state is None:
+                state = states[queue_id] = QueueState(queue_id)
+            state.apply(token_id, token_number, priority, event, counter_id, at)
+            if token_id in watch:
+                last[token_id] = (event, counter_id, at)
+    return states, last
+
+
+def drift(queue_ids=None):
+    """
+    Tokens whose status in the Token table differs from the log, as
+    {token id: (queue id, status in Token or None if gone, status per log, last log entry)}.
+    Only tokens that are WAITING or SERVING on one side can differ; the rest are final on both.
+    """
+    active = {}
+    for alias in sharding.shards():
+        rows = Token.objects.using(alias).filter(status__in=("WAITING", "SERVING"))
+        if queue_ids is not None:
+            rows = rows.filter(queue_id__in=list(queue_ids))
+        active.update((token_id, (queue_id, status)) for token_id, queue_id, status in rows.values_list('id', 'queue_id', 'status'))
+    states, last = replay(queue_ids, watch=active)
+
+    found = {}
+    for token_id, (event, counter_id, at) in last.items():
+        queue_id, status = active[token_id]
+        if STATUSES[event] != status:
+            found[token_id] = (queue_id, status, STATUSES[event], (event, counter_id, at))
+
+    # active per the log but not in the Token table
+    for state in states.values():
+        expected = {token_id: (TokenTransition.JOINED, None, at) for token_id, (_, _, at) in state.waiting.items()}
+        expected.update(
+            (token_id, (TokenTransition.CALLED, counter_id, at)) for token_id, (counter_id, _, at) in state.serving.items()
+        )
+        missing = sorted(token_id for token_id in expected if token_id not in active)
+        statuses = {}
+        for ids in chunks(missing):
+            statuses.update(
+                Token.objects.using(sharding.shard_for_queue(state.queue_id))
+                .filter(id__in=ids).values_list('id', 'status')
+            )
+        for token_id in missing:
+            entry = expected[token_id]
+            found[token_id] = (state.queue_id, statuses.get(token_id), STATUSES[entry[0]], entry)
+    return found
+
+
+def repair(found):
+    """Set the drifted tokens to what the log says, then rebuild their queues' snapshot and counter flags."""
+    by_queue = {}
+    for token_id, (queue_id, status, logged, entry) in found.items():
+        if status is not None:
+            by_queue.setdefault(queue_id, []).append((token_id, logged, entry))
+
+    for queue_id, tokens in by_queue.items():
+        with sharding.using(sharding.shard_for_queue(queue_id)), transaction.atomic(using=sharding.db()):
+            queue = Queue.objects.select_for_update().get(id=queue_id)
+            for token_id, logged, (_, counter_id, at) in tokens:
+                changes = {"status": logged}
+                if logged == "WAITING":
+                    changes.update(counter_id=None, called_at=None, completed_at=None)
+                elif logged == "SERVING":
+                    changes.update(counter_id=counter_id, called_at=at, completed_at=None)
+                elif logged == "COMPLETED":
+                    changes["completed_at"] = at
+                Token.objects.filter(id=token_id).update(**changes)
+            busy = Token.objects.filter(queue=queue, status="SERVING", counter__isnull=False).values('counter_id')
+            Counter.objects.filter(queue=queue).exclude(id__in=busy).update(is_busy=False)
+            Counter.objects.filter(queue=queue, id__in=busy).update(is_busy=True)
+            snapshots.rebuild(queue)
+            transaction.on_commit(lambda queue_id=queue_id: caching.invalidate(queue_id), using=sharding.db())
+    return sum(len(tokens) for tokens in by_queue.values())
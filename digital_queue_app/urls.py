@@ -1,25 +1,41 @@
 from django.urls import path
 from .views import (
     create_queue, create_counter,
-    join_queue, 
+    join_queue, bulk_join_queue,
     call_next, skip_token, complete_token,
+    bulk_skip_tokens, bulk_complete_tokens,
     current_serving,
     my_token_status,
-    list_counters,list_queues,list_tokens
+    list_counters,list_queues,list_tokens,
+    set_counter_state,
+    dashboard, queue_dashboard,
+    queue_analytics
 )
+from .stream_views import queue_events, token_events
+from .metrics import metrics_view
 
 urlpatterns = [
     path("create-queue/", create_queue),
     path("create-counter/", create_counter),
     path("join/", join_queue),
+    path("join/bulk/", bulk_join_queue),
     path("next/", call_next),
     path("skip/<int:token_id>/", skip_token),
     path('complete/<int:queue_id>/', complete_token),
+    path("skip/bulk/", bulk_skip_tokens),
+    path("complete/bulk/", bulk_complete_tokens),
     path("serving/<int:queue_id>/", current_serving),
     path("my-token/<int:token_id>/", my_token_status),
+    path("dashboard/", dashboard),
+    path("dashboard/<int:queue_id>/", queue_dashboard),
+    path("analytics/<int:queue_id>/", queue_analytics),
+    path("serving/<int:queue_id>/events/", queue_events),
+    path("my-token/<int:token_id>/events/", token_events),
     path("queues/", list_queues),
     path("counters/", list_counters),
+    path("counters/<int:counter_id>/state/", set_counter_state),
     path("tokens/", list_tokens),
+    path("metrics", metrics_view),
 
 ]
 
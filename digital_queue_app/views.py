@@ -1,62 +1,177 @@
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
+from rest_framework.fields import BooleanField
 from rest_framework.response import Response
-from .models import Queue, Counter, Token
-from .serializers import QueueSerializer, CounterSerializer, TokenSerializer
+from .models import Queue, Counter, QueueSnapshot, Token, default_priority_levels
+from .serializers import QueueSerializer, CounterSerializer, TokenSerializer, SERVING_ROW, TOKEN_ROW, TOKEN_STATUS_ROW
+from .pagination import keyset_page, ndjson_export
+from . import analytics, caching, counter_pool, eta, events, idempotency, metrics, notifications, positions, ratelimit, routers, sharding, snapshots, transitions
+from .routers import read_only
+from contextlib import nullcontext
+from datetime import datetime, time
+from django.db import IntegrityError, transaction
+from django.db.models import F
 from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
 
 
 # ---------------- Helpers ----------------
 def calculate_wait_time(queue, token):
-    before_count = Token.objects.filter(
+    people_ahead, _ = positions.position(token)
+    return eta.wait_minutes(queue.id, people_ahead)
+
+def allocate_token_number(queue, count=1):
+    # One atomic increment of the per-queue sequence; the row lock taken by the
+    # UPDATE is held until commit, so concurrent joins never see the same value.
+    # Returns the first number of a contiguous block of `count`.
+    with transaction.atomic(using=sharding.db(), savepoint=False):
+        Queue.objects.filter(id=queue.id).update(last_token_number=F('last_token_number') + count)
+        queue.last_token_number = Queue.objects.values_list('last_token_number', flat=True).get(id=queue.id)
+    return queue.last_token_number - count + 1
+
+def get_next_token(queue, locked=False):
+    tokens = Token.objects.filter(
         queue=queue,
         status="WAITING",
-        token_number__lt=token.token_number
-    ).count()
-    return before_count * queue.avg_handle_time
-
-def get_next_token(queue):
-    for p in [3,2,1]:  
-        token = Token.objects.filter(queue=queue, status="WAITING", priority=p).order_by('token_number').first()
-        if token:
-            return token
+        priority__in=queue.priority_levels
+    ).order_by('-priority', 'token_number')
+    if locked:
+        tokens = tokens.select_for_update(skip_locked=True)
+    return tokens.first()
+
+def token_changed(token, event_type):
+    tokens_changed([token], event_type)
+
+def tokens_changed(tokens, event_type, log=True):
+    # one transition log INSERT for the batch, in the caller's transaction
+    if log:
+        transitions.record(tokens, event_type)
+    for token in tokens:
+        caching.invalidate(token.queue_id)
+        events.token_event(token, event_type)
+        metrics.transition(event_type)
+    notifications.tokens_changed(tokens, event_type)
+
+# Claims below must run inside transaction.atomic(). select_for_update(skip_locked)
+# keeps parallel terminals off each other's rows where the backend supports it,
+# and the conditional UPDATE is the actual guard everywhere else (e.g. SQLite).
+CLAIM_ATTEMPTS = 5
+
+def claim_counter_id(queue, counter_id):
+    if not Counter.objects.filter(id=counter_id, queue=queue, state="OPEN", is_busy=False).update(is_busy=True):
+        return None
+    # only the id is needed to assign the token, so the row is not read back
+    counter = Counter(id=counter_id, queue=queue, state="OPEN", is_busy=True)
+    counter_pool.counter_claimed(counter)
+    return counter
+
+def claim_counter(queue):
+    if not counter_pool.enabled():
+        return scan_for_counter(queue)
+
+    # the longest idle counter first; a stale pool is reloaded once
+    for fresh in (False, True):
+        if fresh:
+            counter_pool.reload(queue.id)
+        for counter_id in counter_pool.candidates(queue.id, CLAIM_ATTEMPTS):
+            counter = claim_counter_id(queue, counter_id)
+            if counter:
+                return counter
+            counter_pool.counter_unavailable(queue.id, counter_id)
     return None
 
-def assign_to_counter(token):
-    counter = Counter.objects.filter(queue=token.queue, is_busy=False).first()
-    if not counter:
-        return None
+def scan_for_counter(queue):
+    free = Counter.objects.select_for_update(skip_locked=True).filter(queue=queue, state="OPEN", is_busy=False).order_by('id')
+    for _ in range(CLAIM_ATTEMPTS):
+        counter = free.first()
+        if not counter:
+            return None
+        if Counter.objects.filter(id=counter.id, state="OPEN", is_busy=False).update(is_busy=True):
+            counter.is_busy = True
+            counter_pool.counter_claimed(counter)
+            return counter
+    return None
 
-    token.status = "SERVING"
-    token.counter = counter
-    token.called_at = timezone.now()
-    token.save()
+def claim_next_token(queue, counter):
+    for _ in range(CLAIM_ATTEMPTS):
+        token = get_next_token(queue, locked=True)
+        if not token:
+            return None
+        called_at = timezone.now()
+        if Token.objects.filter(id=token.id, status="WAITING").update(status="SERVING", counter=counter, called_at=called_at):
+            positions.token_left(token)
+            token.status = "SERVING"
+            token.counter = counter
+            token.called_at = called_at
+            snapshots.apply(queue.id, left=[token], called=[token])
+            token_changed(token, "called")
+            return token
+    return None
 
-    counter.is_busy = True
-    counter.save()
+def release_counter(token):
+    if token.counter_id:
+        Counter.objects.filter(id=token.counter_id).update(is_busy=False)
+        counter_pool.counter_released(token.queue_id, token.counter_id)
 
-    return token
+def counter_unavailable_response(queue, counter_id):
+    counter = Counter.objects.filter(id=counter_id, queue=queue).values('state', 'is_busy').first()
+    if not counter:
+        return Response({"error": "Counter not found in this queue"}, status=404)
+    if counter["state"] != "OPEN":
+        return Response({"error": f"Counter is {counter['state']}"}, status=409)
+    return Response({"error": "Counter is busy"}, status=409)
 
 
 # Create Queue
 @api_view(['GET', 'POST'])
+@sharding.routed
 def create_queue(request):
     if request.method == 'GET':
         return Response({
             "message": "Send the following fields using POST to create a queue.",
             "required_fields": {
                 "name": "string (Queue Name)",
-                "avg_handle_time": "optional integer (Average handling time in minutes, default=5)"
+                "avg_handle_time": "optional integer (Average handling time in minutes, default=5)",
+                "priority_levels": "optional list of integers (higher is served first, default=[1, 2, 3])",
+                "one_token_per_phone": "optional boolean (a phone number may hold one waiting or serving token, default=false)"
             }
         })
 
     if request.method == 'POST':
         name = request.data.get("name")
         avg_handle_time = int(request.data.get("avg_handle_time", 5))
+        priority_levels = request.data.get("priority_levels", default_priority_levels())
+        if hasattr(request.data, "getlist") and "priority_levels" in request.data:
+            # a form post repeats the field once per level
+            priority_levels = request.data.getlist("priority_levels")
 
         if not name:
             return Response({"error": "Queue name is required"}, status=400)
 
-        queue = Queue.objects.create(name=name, avg_handle_time=avg_handle_time)
+        try:
+            # form posts send "false" / "0", which bool() would take as true
+            one_token_per_phone = BooleanField().to_internal_value(request.data.get("one_token_per_phone", False))
+        except ValidationError:
+            return Response({"error": "one_token_per_phone must be a boolean"}, status=400)
+
+        try:
+            # a string would otherwise be read one digit at a time
+            if not isinstance(priority_levels, (list, tuple)):
+                raise TypeError
+            priority_levels = sorted({int(p) for p in priority_levels})
+        except (TypeError, ValueError):
+            return Response({"error": "priority_levels must be a list of integers"}, status=400)
+        if not priority_levels:
+            return Response({"error": "priority_levels must not be empty"}, status=400)
+
+        with sharding.using(sharding.shard_for_new_queue()), transaction.atomic(using=sharding.db()):
+            queue = Queue.objects.create(
+                name=name,
+                avg_handle_time=avg_handle_time,
+                priority_levels=priority_levels,
+                one_token_per_phone=one_token_per_phone
+            )
+            snapshots.created(queue)
 
         queue_data = QueueSerializer(queue).data
         queue_data['avg_handle_time'] = f"{queue.avg_handle_time} mins"
@@ -66,6 +181,7 @@ def create_queue(request):
 
 # Create Counter
 @api_view(['GET', 'POST'])
+@sharding.routed
 def create_counter(request):
     if request.method == 'GET':
         return Response({
@@ -88,11 +204,18 @@ def create_counter(request):
         except Queue.DoesNotExist:
             return Response({"error": "Queue not found"}, status=404)
 
-        counter = Counter.objects.create(name=name, queue=queue)
+        with transaction.atomic(using=sharding.db()):
+            counter = Counter.objects.create(name=name, queue=queue)
+            snapshots.counter_saved(counter)
+            # cached ETAs depend on the queue's counters
+            caching.invalidate(queue.id)
+        counter_pool.counter_saved(counter)
+        eta.counter_saved(counter)
         return Response({"message": "Counter created", "counter": CounterSerializer(counter).data})
     
     
 @api_view(['GET', 'POST'])
+@sharding.routed
 def join_queue(request):
     if request.method == 'GET':
         return Response({
@@ -109,87 +232,303 @@ def join_queue(request):
         queue_id = request.data.get("queue")
         user_name = request.data.get("user_name")
         phone_number = request.data.get("phone_number")
-        priority = int(request.data.get("priority", 1))
+        priority = request.data.get("priority")
 
         if not queue_id or not user_name or not phone_number:
             return Response({"error": "queue, user_name and phone_number are required"}, status=400)
+        try:
+            queue_id = int(queue_id)
+            priority = int(priority) if priority is not None else None
+        except (TypeError, ValueError):
+            return Response({"error": "queue and priority must be integers"}, status=400)
 
         try:
             queue = Queue.objects.get(id=queue_id)
         except Queue.DoesNotExist:
             return Response({"error": "Queue not found"}, status=404)
 
-        last_token = Token.objects.filter(queue=queue).order_by('-token_number').first()
-        next_number = last_token.token_number + 1 if last_token else 1
+        if priority is None:
+            priority = min(queue.priority_levels)
+        if priority not in queue.priority_levels:
+            return Response({"error": f"priority must be one of {queue.priority_levels}"}, status=400)
 
-        # --- Create token ---
+        try:
+            token, replayed = join_token(queue, user_name, phone_number, priority, request.headers.get("Idempotency-Key"))
+        except (idempotency.KeyReused, ActiveTokenExists) as e:
+            return Response(*join_conflict(e))
+        return Response({
+            "message": "Token created successfully",
+            "token": joined_token_data(queue, token)
+        }, status=201, headers=REPLAYED_HEADERS if replayed else None)
+
+
+REPLAYED_HEADERS = {"Idempotent-Replayed": "true"}
+
+class ActiveTokenExists(Exception):
+    """The queue allows one active token per phone number and the phone has one."""
+    def __init__(self, token_id):
+        super().__init__(token_id)
+        self.token_id = token_id
+
+def join_conflict(e):
+    """(data, status) of the response to a refused join."""
+    if isinstance(e, ActiveTokenExists):
+        return {"error": "This phone number already has an active token in this queue", "token_id": e.token_id}, 409
+    return {"error": "Idempotency-Key was already used for a different join"}, 422
+
+def join_token(queue, user_name, phone_number, priority, idempotency_key=None):
+    """
+    Create a token, or with an Idempotency-Key return the one an earlier join
+    with that key created. Returns (token, replayed).
+    """
+    key = None
+    if idempotency_key:
+        key = (idempotency.digest(idempotency_key), idempotency.fingerprint(queue.id, user_name, phone_number, priority))
+        token = idempotency.lookup(*key)
+        if token is not None:
+            return token, True
+    try:
+        return create_token(queue, user_name, phone_number, priority, key), False
+    except IntegrityError:
+        # a concurrent join with the same key won, or the phone already has an active token
+        token = idempotency.lookup(*key) if key else None
+        if token is not None:
+            return token, True
+        active = active_phone_tokens(queue, [phone_number]).values_list('id', flat=True).first()
+        if active is None:
+            raise
+        raise ActiveTokenExists(active)
+
+def active_phone_tokens(queue, phone_numbers):
+    """The active tokens of phone_numbers in a one-token-per-phone queue, found through its partial unique index."""
+    return Token.objects.filter(
+        queue=queue, phone_number__in=phone_numbers, dedupe_phone=True, status__in=('WAITING', 'SERVING')
+    )
+
+def create_token(queue, user_name, phone_number, priority, idempotency_key=None):
+    with transaction.atomic(using=sharding.db()):
         token = Token.objects.create(
             queue=queue,
-            token_number=next_number,
+            token_number=allocate_token_number(queue),
             user_name=user_name,
             phone_number=phone_number,
-            priority=priority
+            priority=priority,
+            dedupe_phone=queue.one_token_per_phone
         )
+        if idempotency_key:
+            idempotency.remember(*idempotency_key, token)
+        positions.token_joined(token)
+        snapshots.apply(queue.id, joined=[token])
+        token_changed(token, "joined")
+    return token
 
-        people_ahead = Token.objects.filter(
-            queue=queue,
-            status="WAITING",
-            token_number__lt=token.token_number
-        ).count()
-        estimated_wait_time = people_ahead * queue.avg_handle_time
-        estimated_wait_time_str = f"{estimated_wait_time} mins" if estimated_wait_time > 1 else "1 min"
-
-        data = TokenSerializer(token).data
-        data['estimated_wait_time'] = estimated_wait_time_str
-        data.pop('called_at', None)  
-        data.pop('status', None)    
-        data.pop('counter', None)    
+def joined_token_data(queue, token):
+    return joined_token_payload(token, calculate_wait_time(queue, token))
 
-        return Response({
-            "message": "Token created successfully",
-            "token": data
-        }, status=201)
+def joined_token_payload(token, estimated_wait_time):
+    estimated_wait_time_str = f"{estimated_wait_time} mins" if estimated_wait_time > 1 else "1 min"
+
+    data = TokenSerializer(token).data
+    data['estimated_wait_time'] = estimated_wait_time_str
+    data.pop('called_at', None)  
+    data.pop('status', None)    
+    data.pop('counter', None)    
+    return data
+
+
+BULK_LIMIT = 1000
+RACED_JOIN = {"error": "A concurrent join took one of this queue's phone numbers, retry"}
+
+@api_view(['POST'])
+@sharding.routed
+def bulk_join_queue(request):
+    entries = request.data.get("tokens")
+    if not isinstance(entries, list) or not entries:
+        return Response({"error": "tokens must be a non-empty list"}, status=400)
+    if len(entries) > BULK_LIMIT:
+        return Response({"error": f"at most {BULK_LIMIT} tokens per request"}, status=400)
+
+    results = [None] * len(entries)
+    parsed = []
+    for index, entry in enumerate(entries):
+        entry = entry if isinstance(entry, dict) else {}
+        try:
+            queue_id = int(entry.get("queue"))
+            priority = entry.get("priority")
+            priority = int(priority) if priority is not None else None
+        except (TypeError, ValueError):
+            results[index] = {"error": "queue and priority must be integers"}
+            continue
+        if not entry.get("user_name") or not entry.get("phone_number"):
+            results[index] = {"error": "queue, user_name and phone_number are required"}
+            continue
+        parsed.append((index, queue_id, priority, entry))
+
+    shards = sharding.group({queue_id for _, queue_id, _, _ in parsed}, sharding.shard_for_queue)
+    queues = {}
+    for alias, queue_ids in shards.items():
+        with sharding.using(alias):
+            queues.update(Queue.objects.in_bulk(queue_ids))
+    pending = {}
+    for index, queue_id, priority, entry in parsed:
+        queue = queues.get(queue_id)
+        if not queue:
+            results[index] = {"error": "Queue not found"}
+            continue
+        priority = priority if priority is not None else min(queue.priority_levels)
+        if priority not in queue.priority_levels:
+            results[index] = {"error": f"priority must be one of {queue.priority_levels}"}
+            continue
+        pending.setdefault(queue_id, []).append((index, Token(
+            queue=queue,
+            user_name=entry["user_name"],
+            phone_number=entry["phone_number"],
+            priority=priority,
+            dedupe_phone=queue.one_token_per_phone
+        )))
+
+    # one-token-per-phone queues: one index probe per queue for the phones
+    # already active, and only the first entry of a phone within the batch
+    duplicates = []
+    for alias, queue_ids in shards.items():
+        with sharding.using(alias):
+            for queue_id in queue_ids:
+                if queue_id not in pending or not queues[queue_id].one_token_per_phone:
+                    continue
+                items = pending[queue_id]
+                active = dict(
+                    active_phone_tokens(queues[queue_id], {token.phone_number for _, token in items})
+                    .values_list('phone_number', 'id')
+                )
+                first_of = {}
+                kept = []
+                for index, token in items:
+                    if token.phone_number in active:
+                        results[index] = join_conflict(ActiveTokenExists(active[token.phone_number]))[0]
+                    elif token.phone_number in first_of:
+                        duplicates.append((index, first_of[token.phone_number]))
+                    else:
+                        first_of[token.phone_number] = token
+                        kept.append((index, token))
+                pending[queue_id] = kept
+
+    # one sequence bump and one multi-row INSERT per queue, one transaction
+    # per shard (queues on different shards are not committed atomically)
+    for alias, queue_ids in shards.items():
+        with sharding.using(alias), transaction.atomic(using=alias):
+            joined = []
+            for queue_id in queue_ids:
+                items = pending.get(queue_id, [])
+                if not items:
+                    continue
+                # a savepoint where a concurrent join can still take a phone
+                try:
+                    with transaction.atomic(using=alias) if queues[queue_id].one_token_per_phone else nullcontext():
+                        first = allocate_token_number(queues[queue_id], len(items))
+                        for offset, (_, token) in enumerate(items):
+                            token.token_number = first + offset
+                        Token.objects.bulk_create([token for _, token in items])
+                        snapshots.apply(queue_id, joined=[token for _, token in items])
+                        for _, token in items:
+                            positions.token_joined(token)
+                        tokens_changed([token for _, token in items], "joined", log=False)
+                except IntegrityError:
+                    for index, token in items:
+                        token.pk = None
+                        results[index] = RACED_JOIN
+                    pending[queue_id] = []
+                    continue
+                joined += [token for _, token in items]
+            # the shard's whole batch in one log INSERT
+            transitions.record(joined, "joined")
+
+    for alias, queue_ids in shards.items():
+        with sharding.using(alias):
+            for queue_id in queue_ids:
+                for index, token in pending.get(queue_id, []):
+                    results[index] = {"token": joined_token_data(queues[queue_id], token)}
+    for index, token in duplicates:
+        results[index] = join_conflict(ActiveTokenExists(token.id))[0] if token.pk else RACED_JOIN
+
+    created = sum(len(items) for items in pending.values())
+    return Response({
+        "message": f"{created} tokens created",
+        "results": results
+    }, status=201 if created else 400)
 
 
 @api_view(['GET', 'POST'])
+@sharding.routed
 def call_next(request):
     if request.method == 'GET':
         return Response({
             "message": "Send the following JSON using POST to call the next token.",
             "example_json": {
-                "queue_id": 1
+                "queue_id": 1,
+                "counter_id": "optional, call the next token to this counter"
             }
         })
 
     queue_id = request.data.get("queue_id")
+    counter_id = request.data.get("counter_id")
     try:
         queue = Queue.objects.get(id=queue_id)
     except Queue.DoesNotExist:
         return Response({"error": "Queue not found"}, status=404)
+    try:
+        counter_id = int(counter_id) if counter_id is not None else None
+    except (TypeError, ValueError):
+        return Response({"error": "counter_id must be an integer"}, status=400)
+
+    with transaction.atomic(using=sharding.db()):
+        if counter_id is not None:
+            counter = claim_counter_id(queue, counter_id)
+            if not counter:
+                return counter_unavailable_response(queue, counter_id)
+        else:
+            counter = claim_counter(queue)
+        token = claim_next_token(queue, counter) if counter else get_next_token(queue)
+        if not token:
+            # hand the claimed counter back
+            transaction.set_rollback(True, using=sharding.db())
+            return Response({"message": "No waiting tokens"})
 
-    token = get_next_token(queue)
-    if not token:
-        return Response({"message": "No waiting tokens"})
-
-    assigned = assign_to_counter(token)
-    if not assigned:
+    if not counter:
         return Response({"message": "No free counters available"})
 
     return Response({
         "message": "Next token called",
-        "token": TokenSerializer(assigned).data
+        "token": TokenSerializer(token).data
     })
 
 
 @api_view(['POST'])
+@sharding.routed
 def skip_token(request, token_id):
-    try:
-        token = Token.objects.get(id=token_id)
-    except Token.DoesNotExist:
-        return Response({"error": "Token not found"}, status=404)
-
-    token.status = "SKIPPED"
-    token.save()
+    with transaction.atomic(using=sharding.db()):
+        try:
+            token = Token.objects.select_for_update().get(id=token_id)
+        except Token.DoesNotExist:
+            return Response({"error": "Token not found"}, status=404)
+        # only a WAITING or SERVING token can be skipped, as with bulk skip
+        if token.status not in ("WAITING", "SERVING"):
+            return Response({"error": f"Token is {token.status}"}, status=409)
+
+        # a no-show at the counter frees the counter it was called to
+        if token.status == "SERVING":
+            release_counter(token)
+        elif token.status == "WAITING":
+            positions.token_left(token)
+        previous = token.status
+
+        token.status = "SKIPPED"
+        token.save()
+        snapshots.apply(
+            token.queue_id,
+            left=[token] if previous == "WAITING" else [],
+            finished=[token] if previous == "SERVING" else []
+        )
+        token_changed(token, "skipped")
 
     token_data = TokenSerializer(token).data
     token_data.pop('status', None)
@@ -202,20 +541,34 @@ def skip_token(request, token_id):
 
 
 @api_view(['POST'])
+@sharding.routed
 def complete_token(request, queue_id):
-    token = Token.objects.filter(queue_id=queue_id, status="SERVING").first()
-
-    if not token:
-        return Response({"error": "No SERVING token found in this queue"}, status=404)
-
-    counter = token.counter
-
-    token.status = "COMPLETED"
-    token.save()
-
-    if counter:
-        counter.is_busy = False
-        counter.save()
+    counter_id = request.data.get("counter_id")
+    token_id = request.data.get("token_id")
+    try:
+        counter_id = int(counter_id) if counter_id else None
+        token_id = int(token_id) if token_id else None
+    except (TypeError, ValueError):
+        return Response({"error": "token_id and counter_id must be integers"}, status=400)
+
+    serving = Token.objects.filter(queue_id=queue_id, status="SERVING")
+    if token_id:
+        serving = serving.filter(id=token_id)
+    elif counter_id:
+        serving = serving.filter(counter_id=counter_id)
+
+    with transaction.atomic(using=sharding.db()):
+        token = serving.select_for_update().order_by('token_number').first()
+        completed_at = timezone.now()
+        if not token or not Token.objects.filter(id=token.id, status="SERVING").update(status="COMPLETED", completed_at=completed_at):
+            return Response({"error": "No SERVING token found in this queue"}, status=404)
+
+        token.status = "COMPLETED"
+        token.completed_at = completed_at
+        release_counter(token)
+        snapshots.apply(token.queue_id, finished=[token])
+        token_changed(token, "completed")
+        eta.token_completed(token)
 
     token_data = TokenSerializer(token).data
     token_data.pop('status', None)
@@ -226,83 +579,299 @@ def complete_token(request, queue_id):
     })
 
 
-@api_view(['GET'])
-def current_serving(request, queue_id):
-    serving_tokens = Token.objects.filter(queue_id=queue_id, status="SERVING")
-    serializer = TokenSerializer(serving_tokens, many=True)
-    data = serializer.data
+def bulk_transition(token_ids, from_statuses, to_status, event_type):
+    # one transaction per shard the tokens live on
+    tokens = []
+    for alias, shard_token_ids in sharding.group(token_ids, sharding.shard_for_token).items():
+        with sharding.using(alias):
+            tokens += shard_transition(shard_token_ids, from_statuses, to_status, event_type)
+    return tokens
+
+def shard_transition(token_ids, from_statuses, to_status, event_type):
+    # One locking read and one UPDATE for the whole batch; counters of tokens
+    # that were being served are released with a single UPDATE as well.
+    with transaction.atomic(using=sharding.db()):
+        tokens = list(
+            Token.objects.select_for_update()
+            .filter(id__in=token_ids, status__in=from_statuses)
+            .only('id', 'queue_id', 'priority', 'token_number', 'status', 'counter_id', 'called_at', 'completed_at')
+        )
+        if not tokens:
+            return []
+
+        changes = {"status": to_status}
+        if to_status == "COMPLETED":
+            changes["completed_at"] = timezone.now()
+        Token.objects.filter(id__in=[token.id for token in tokens]).update(**changes)
+        released = [token for token in tokens if token.status == "SERVING" and token.counter_id]
+        Counter.objects.filter(id__in=[token.counter_id for token in released]).update(is_busy=False)
+
+        for token in released:
+            counter_pool.counter_released(token.queue_id, token.counter_id)
+        for queue_id in {token.queue_id for token in tokens}:
+            snapshots.apply(
+                queue_id,
+                left=[token for token in tokens if token.queue_id == queue_id and token.status == "WAITING"],
+                finished=[token for token in tokens if token.queue_id == queue_id and token.status == "SERVING"]
+            )
+        for token in tokens:
+            if token.status == "WAITING":
+                positions.token_left(token)
+            for field, value in changes.items():
+                setattr(token, field, value)
+            if to_status == "COMPLETED":
+                eta.token_completed(token)
+        tokens_changed(tokens, event_type)
+    return tokens
+
+def bulk_transition_response(request, from_statuses, to_status, event_type, message):
+    token_ids = request.data.get("token_ids")
+    if not isinstance(token_ids, list) or not token_ids:
+        return Response({"error": "token_ids must be a non-empty list"}, status=400)
+    if len(token_ids) > BULK_LIMIT:
+        return Response({"error": f"at most {BULK_LIMIT} tokens per request"}, status=400)
+    try:
+        token_ids = [int(token_id) for token_id in token_ids]
+    except (TypeError, ValueError):
+        return Response({"error": "token_ids must be integers"}, status=400)
+
+    changed = {token.id for token in bulk_transition(token_ids, from_statuses, to_status, event_type)}
+    results = [
+        {"id": token_id, "status": to_status} if token_id in changed
+        else {"id": token_id, "error": f"Token not found or not {' / '.join(from_statuses)}"}
+        for token_id in token_ids
+    ]
+    return Response({"message": f"{len(changed)} {message}", "results": results})
+
 
-    for token in data:
-        token.pop('queue', None)
-        token.pop('status', None)
+@api_view(['POST'])
+@sharding.routed
+def bulk_skip_tokens(request):
+    return bulk_transition_response(request, ("WAITING", "SERVING"), "SKIPPED", "skipped", "tokens skipped")
+
+
+@api_view(['POST'])
+@sharding.routed
+def bulk_complete_tokens(request):
+    return bulk_transition_response(request, ("SERVING",), "COMPLETED", "completed", "tokens completed")
 
-    return Response(data)
+
+def serving_rows(queue_id):
+    return SERVING_ROW.rows(Token.objects.filter(queue_id=queue_id, status="SERVING"))
+
+def current_serving_data(queue_id):
+    return SERVING_ROW.data(serving_rows(queue_id))
+
+def token_status_row(token_id):
+    return TOKEN_STATUS_ROW.rows(Token.objects.filter(id=token_id))
+
+def my_token_status_data(token_id):
+    try:
+        token = token_status_row(token_id).get()
+    except Token.DoesNotExist:
+        if not routers.using_replica():
+            raise
+        # joined after the replica last caught up
+        with routers.primary():
+            token = token_status_row(token_id).get()
+    return token_status_data(token, waiting_status(token) if token.status == "WAITING" else None)
+
+def token_status_data(token, waiting=None):
+    """token is a token_status_row() row."""
+    response = TOKEN_STATUS_ROW.to_representation(token)
+    response["avg_handle_time"] = f"{token.queue__avg_handle_time} mins"
+
+    if token.status == "WAITING":
+        response.update(waiting)
+        if notifications.enabled():
+            # the client can stop polling until the texts arrive
+            response["notify_at_people_ahead"] = notifications.thresholds()
+    else:
+        response["called_at"] = token.called_at
+
+    return response
+
+def waiting_status(token):
+    people_ahead, people_behind = positions.position(token)
+    return waiting_fields(people_ahead, people_behind, eta.wait_minutes(token.queue_id, people_ahead))
+
+def waiting_fields(people_ahead, people_behind, total_minutes):
+    if total_minutes == 0:
+        estimated_wait_time = "0 mins"
+    elif total_minutes == 1:
+        estimated_wait_time = "1 min"
+    else:
+        estimated_wait_time = f"{total_minutes} mins"
+
+    return {
+        "people_ahead": people_ahead,
+        "people_behind": people_behind,
+        "estimated_wait_time": estimated_wait_time
+    }
+
+
+@api_view(['GET'])
+@ratelimit.limited("queue", "ip")
+@sharding.routed
+@read_only
+def current_serving(request, queue_id):
+    return caching.cached_response(request, f"serving-{queue_id}", queue_id, lambda: current_serving_data(queue_id))
 
 
 @api_view(['GET'])
+@ratelimit.limited("token", "ip")
+@sharding.routed
+@read_only
 def my_token_status(request, token_id):
+    queue_id = caching.token_queue_id(token_id)
+    if queue_id is None:
+        return Response({"error": "Token not found"}, status=404)
+
     try:
-        token = Token.objects.get(id=token_id)
+        return caching.cached_response(request, f"my-token-{token_id}", queue_id, lambda: my_token_status_data(token_id))
     except Token.DoesNotExist:
+        # archived since this process cached its queue
         return Response({"error": "Token not found"}, status=404)
 
-    response = {
-        "id": token.id,
-        "token_number": token.token_number,
-        "created_at": token.created_at,
-        "user_name": token.user_name,
-        "phone_number": token.phone_number,
-        "queue": token.queue.id,
-        "priority": token.priority,
-        "status": token.status,
-        "avg_handle_time": f"{token.queue.avg_handle_time} mins"
-    }
 
-    if token.status == "WAITING":
-        people_ahead = Token.objects.filter(
-            queue=token.queue,
-            status="WAITING",
-            token_number__lt=token.token_number
-        ).count()
-
-        people_behind = Token.objects.filter(
-            queue=token.queue,
-            status="WAITING",
-            token_number__gt=token.token_number
-        ).count()
-
-        total_minutes = people_ahead * token.queue.avg_handle_time
-        if total_minutes == 0:
-            estimated_wait_time = "0 mins"
-        elif total_minutes == 1:
-            estimated_wait_time = "1 min"
-        else:
-            estimated_wait_time = f"{total_minutes} mins"
+# Waiting-room screens: one read of the precomputed snapshots (see snapshots.py)
+@api_view(['GET'])
+@sharding.routed
+def dashboard(request):
+    snapshots_by_queue = sharding.gather(QueueSnapshot.objects.order_by('queue_id'), ('queue_id',))
+    return Response({"queues": [snapshots.data(snapshot) for snapshot in snapshots_by_queue]})
 
-        response.update({
-            "people_ahead": people_ahead,
-            "people_behind": people_behind,
-            "estimated_wait_time": estimated_wait_time
-        })
-    else:
-        response["called_at"] = token.called_at
+@api_view(['GET'])
+@sharding.routed
+def queue_dashboard(request, queue_id):
+    snapshot = QueueSnapshot.objects.filter(queue_id=queue_id).first()
+    if not snapshot:
+        return Response({"error": "Queue not found"}, status=404)
+    return Response(snapshots.data(snapshot))
 
-    return Response(response)
 
+# Historical reports per queue, built per day and cached (see analytics.py)
 @api_view(['GET'])
+@sharding.routed
+@read_only
+def queue_analytics(request, queue_id):
+    try:
+        start, end = analytics.date_range(request.query_params.get("from"), request.query_params.get("to"))
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+    if not Queue.objects.filter(id=queue_id).exists():
+        return Response({"error": "Queue not found"}, status=404)
+    return Response(analytics.report(queue_id, start, end))
+
+
+TOKEN_EXPORT_FIELDS = (
+    'id', 'token_number', 'user_name', 'phone_number', 'queue_id',
+    'priority', 'status', 'counter_id', 'created_at', 'called_at'
+)
+
+def int_param(params, name):
+    value = params.get(name)
+    if value in (None, ""):
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        raise ValueError(f"{name} must be an integer")
+
+def datetime_param(params, name):
+    value = params.get(name)
+    if not value:
+        return None
+    parsed = parse_datetime(value) or (parse_date(value) and datetime.combine(parse_date(value), time.min))
+    if not parsed:
+        raise ValueError(f"{name} must be an ISO 8601 date or datetime")
+    return parsed if timezone.is_aware(parsed) else timezone.make_aware(parsed)
+
+def filter_tokens(params):
+    tokens = Token.objects.all()
+
+    queue_id = int_param(params, "queue")
+    if queue_id is not None:
+        tokens = tokens.filter(queue_id=queue_id)
+
+    status = params.get("status")
+    if status:
+        if status not in dict(Token.STATUS_CHOICES):
+            raise ValueError(f"status must be one of {', '.join(dict(Token.STATUS_CHOICES))}")
+        tokens = tokens.filter(status=status)
+
+    priority = int_param(params, "priority")
+    if priority is not None:
+        tokens = tokens.filter(priority=priority)
+
+    created_after = datetime_param(params, "created_after")
+    if created_after:
+        tokens = tokens.filter(created_at__gte=created_after)
+
+    created_before = datetime_param(params, "created_before")
+    if created_before:
+        tokens = tokens.filter(created_at__lt=created_before)
+
+    return tokens
+
+
+@api_view(['GET'])
+@sharding.routed
+@read_only
 def list_queues(request):
-    queues = Queue.objects.all()
-    serializer = QueueSerializer(queues, many=True)
-    return Response(serializer.data)
+    try:
+        return keyset_page(request, Queue.objects.all(), ('id',), lambda rows: QueueSerializer(rows, many=True).data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
 
 @api_view(['GET'])
+@sharding.routed
+@read_only
 def list_counters(request):
-    counters = Counter.objects.all()
-    serializer = CounterSerializer(counters, many=True)
-    return Response(serializer.data)
+    try:
+        counters = Counter.objects.all()
+        queue_id = int_param(request.query_params, "queue")
+        if queue_id is not None:
+            counters = counters.filter(queue_id=queue_id)
+        return keyset_page(request, counters, ('id',), lambda rows: CounterSerializer(rows, many=True).data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
+
+@api_view(['POST'])
+@sharding.routed
+def set_counter_state(request, counter_id):
+    state = request.data.get("state")
+    if state not in dict(Counter.STATE_CHOICES):
+        return Response({"error": f"state must be one of {[s for s, _ in Counter.STATE_CHOICES]}"}, status=400)
+
+    with transaction.atomic(using=sharding.db()):
+        try:
+            counter = Counter.objects.select_for_update().get(id=counter_id)
+        except Counter.DoesNotExist:
+            return Response({"error": "Counter not found"}, status=404)
+        # a busy counter keeps its token; it just is not handed another one
+        counter.state = state
+        counter.save(update_fields=['state'])
+        snapshots.counter_saved(counter)
+        counter_pool.counter_saved(counter)
+        eta.counter_saved(counter)
+        caching.invalidate(counter.queue_id)
+
+    return Response({"message": "Counter updated", "counter": CounterSerializer(counter).data})
 
 @api_view(['GET'])
+@sharding.routed
+@read_only
 def list_tokens(request):
-    tokens = Token.objects.all()
-    serializer = TokenSerializer(tokens, many=True)
-    return Response(serializer.data)
+    try:
+        tokens = filter_tokens(request.query_params)
+        if request.query_params.get("export") == "ndjson":
+            return ndjson_export(
+                tokens,
+                ('created_at', 'id'),
+                TOKEN_EXPORT_FIELDS,
+                rename={"queue_id": "queue", "counter_id": "counter"}
+            )
+        return keyset_page(request, TOKEN_ROW.rows(tokens), ('created_at', 'id'), TOKEN_ROW.data)
+    except ValueError as e:
+        return Response({"error": str(e)}, status=400)
@@ -2,6 +2,8 @@
 ASGI config for digital_queue_project project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
+Requests are routed with settings.ASGI_ROOT_URLCONF, so the hot read endpoints
+and join are served by the async views in digital_queue_app.async_views.
 
 For more information on this file, see
 https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
@@ -9,8 +11,20 @@ https://docs.djangoproject.com/en/6.0/howto/deployment/asgi/
 
 import os
 
-from django.core.asgi import get_asgi_application
+import django
+from django.conf import settings
+from django.core.handlers.asgi import ASGIHandler
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'digital_queue_project.settings')
 
-application = get_asgi_application()
+
+class QueueASGIHandler(ASGIHandler):
+    def create_request(self, scope, body_file):
+        request, error_response = super().create_request(scope, body_file)
+        if request is not None:
+            request.urlconf = settings.ASGI_ROOT_URLCONF
+        return request, error_response
+
+
+django.setup(set_prefix=False)
+application = QueueASGIHandler()
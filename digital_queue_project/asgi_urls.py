@@ -0,0 +1,10 @@
+"""
+URL configuration for the ASGI deployment (see asgi.py).
+
+Same routes as urls.py, with the async views of digital_queue_app in front.
+"""
+from django.urls import path,include
+
+urlpatterns = [
+    path('',include('digital_queue_app.async_urls')),
+]
@@ -10,6 +10,7 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/6.0/ref/settings/
 """
 
+import os
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -42,6 +43,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'digital_queue_app.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -70,17 +72,159 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'digital_queue_project.wsgi.application'
 
+ASGI_APPLICATION = 'digital_queue_project.asgi.application'
+
+# asgi.py serves this URLconf instead, which puts the async views in front
+ASGI_ROOT_URLCONF = 'digital_queue_project.asgi_urls'
+
 
 # Database
 # https://docs.djangoproject.com/en/6.0/ref/settings/#databases
 
-DATABASES = {
+# SQLite by default. QUEUE_DB_ENGINE=postgresql reads the connection from the
+# QUEUE_DB_* environment variables; QUEUE_DB_POOL_MAX_SIZE turns on Django's
+# psycopg pool (needs psycopg[pool]) instead of persistent connections.
+# QUEUE_DB_SHARDS=N adds the databases shard1 .. shardN that queues are spread
+# across (see digital_queue_app/sharding.py); each must be migrated with
+# `migrate --database shardN` while listed, so it gets its own id range.
+
+QUEUE_DB_ENGINE = os.environ.get('QUEUE_DB_ENGINE', 'sqlite')
+QUEUE_DB_SHARDS = int(os.environ.get('QUEUE_DB_SHARDS', 0))
+
+if QUEUE_DB_ENGINE == 'postgresql':
+    pool_size = int(os.environ.get('QUEUE_DB_POOL_MAX_SIZE', 0))
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.environ.get('QUEUE_DB_NAME', 'digital_queue'),
+            'USER': os.environ.get('QUEUE_DB_USER', ''),
+            'PASSWORD': os.environ.get('QUEUE_DB_PASSWORD', ''),
+            'HOST': os.environ.get('QUEUE_DB_HOST', 'localhost'),
+            'PORT': os.environ.get('QUEUE_DB_PORT', '5432'),
+            # a pooled connection goes back to the pool after every request
+            'CONN_MAX_AGE': 0 if pool_size else int(os.environ.get('QUEUE_DB_CONN_MAX_AGE', 60)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {'pool': {'min_size': 2, 'max_size': pool_size}} if pool_size else {},
+        }
+    }
+    if os.environ.get('QUEUE_DB_REPLICA_HOST'):
+        DATABASES['replica'] = {
+            **DATABASES['default'],
+            'HOST': os.environ['QUEUE_DB_REPLICA_HOST'],
+            'PORT': os.environ.get('QUEUE_DB_REPLICA_PORT', DATABASES['default']['PORT']),
+            'TEST': {'MIRROR': 'default'},
+        }
+    for n in range(1, QUEUE_DB_SHARDS + 1):
+        DATABASES[f'shard{n}'] = {
+            **DATABASES['default'],
+            'NAME': f"{DATABASES['default']['NAME']}_shard{n}",
+            'HOST': os.environ.get(f'QUEUE_DB_SHARD{n}_HOST', DATABASES['default']['HOST']),
+        }
+else:
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+            'OPTIONS': {
+                # readers no longer block the writer (WAL, switched on by
+                # migration 0014); writers queue for the lock for up to
+                # `timeout` seconds instead of failing with "database is
+                # locked", and take it when the transaction begins so two of
+                # them never deadlock upgrading a read lock
+                'init_command': 'PRAGMA synchronous=NORMAL',
+                'transaction_mode': 'IMMEDIATE',
+                'timeout': 20,
+            },
+        }
+    }
+    # a file, not SQLite's in-memory default, so the concurrency tests' threads
+    # share the test database
+    DATABASES['default']['TEST'] = {'NAME': BASE_DIR / 'test_db.sqlite3'}
+    # stand-in replica: a second connection to the same database, so the
+    # replica routing can be run (and tested) locally
+    DATABASES['replica'] = {**DATABASES['default'], 'TEST': {'MIRROR': 'default'}}
+    # shard files, only when asked for, so other commands do not create them
+    for n in range(1, QUEUE_DB_SHARDS + 1):
+        DATABASES[f'shard{n}'] = {**DATABASES['default'], 'NAME': BASE_DIR / f'db_shard{n}.sqlite3', 'TEST': {}}
+    # otherwise shard1 is an in-memory stand-in, outside QUEUE_SHARDS, that
+    # sharding can be tested against under any test runner
+    if not QUEUE_DB_SHARDS:
+        DATABASES['shard1'] = {**DATABASES['default'], 'NAME': ':memory:', 'TEST': {}}
+
+DATABASE_ROUTERS = ['digital_queue_app.sharding.ShardRouter', 'digital_queue_app.routers.ReadReplicaRouter']
+
+# Databases holding queues, default first. A queue's shard is cached for
+# QUEUE_SHARD_CACHE_TIMEOUT seconds, so other processes route to a moved
+# queue's new shard at most that long after the move.
+QUEUE_SHARDS = ['default'] + [f'shard{n}' for n in range(1, QUEUE_DB_SHARDS + 1)]
+QUEUE_SHARD_CACHE_TIMEOUT = 60
+
+# Alias the read-only views (lists, current_serving, my_token_status) read
+# from; None keeps them on default. Responses cached from a replica, which may
+# lag the commit that invalidated the cache, expire after
+# QUEUE_REPLICA_CACHE_TIMEOUT seconds instead of QUEUE_RESPONSE_CACHE_TIMEOUT.
+QUEUE_READ_REPLICA = os.environ.get('QUEUE_READ_REPLICA', 'replica' if 'QUEUE_DB_REPLICA_HOST' in os.environ else None)
+QUEUE_REPLICA_CACHE_TIMEOUT = 5
+
+
+# Cache
+# https://docs.djangoproject.com/en/6.0/topics/cache/
+# current_serving and my_token_status responses are cached here. Use a shared
+# backend (file based, memcached, redis) when running several worker processes.
+
+CACHES = {
     'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {'MAX_ENTRIES': 100000},
     }
 }
 
+QUEUE_RESPONSE_CACHE = 'default'
+QUEUE_RESPONSE_CACHE_TIMEOUT = 300
+
+# Concurrent polls missing the same cached response share one build
+# (digital_queue_app/coalescing.py).
+QUEUE_REQUEST_COALESCING = True
+
+# Token buckets for my-token/ and serving/ polls, as (requests per second,
+# burst) per polled token, polled queue and client IP; None is unlimited.
+# The per-IP limit is opt-in: behind a proxy or a venue's NAT every client
+# shares one address, so set QUEUE_CLIENT_IP_HEADER (e.g. 'X-Forwarded-For')
+# before giving 'ip' a limit such as (20, 100).
+QUEUE_RATE_LIMITS = {
+    'token': (1, 10),
+    'queue': None,
+    'ip': None,
+}
+QUEUE_CLIENT_IP_HEADER = None
+
+# How long a join's Idempotency-Key is replayed (digital_queue_app/idempotency.py);
+# archive_tokens deletes the expired ones.
+QUEUE_IDEMPOTENCY_KEY_HOURS = 24
+
+# Append every join, call, skip and completion to the TokenTransition log, in
+# the same transaction (digital_queue_app/transitions.py).
+QUEUE_TRANSITION_LOG = True
+
+# How long a past day's analytics (digital_queue_app/analytics.py) stay cached;
+# today's follow QUEUE_RESPONSE_CACHE_TIMEOUT.
+QUEUE_ANALYTICS_CACHE_TIMEOUT = 86400
+
+# Text customers when their people ahead first drop to each of
+# QUEUE_NOTIFY_PEOPLE_AHEAD and when they are called (digital_queue_app/notifications.py).
+# The transport is a dotted path to a Transport subclass, e.g.
+# 'digital_queue_app.notifications.LogTransport'; None turns it off. Sends are
+# batched in QUEUE_NOTIFICATION_WORKERS threads (0 sends inline on commit) and
+# retried QUEUE_NOTIFICATION_RETRIES times, backing off from
+# QUEUE_NOTIFICATION_BACKOFF_SECONDS.
+QUEUE_NOTIFICATION_TRANSPORT = os.environ.get('QUEUE_NOTIFICATION_TRANSPORT') or None
+QUEUE_NOTIFY_PEOPLE_AHEAD = (5, 1)
+QUEUE_NOTIFICATION_WORKERS = 2
+QUEUE_NOTIFICATION_BATCH = 100
+QUEUE_NOTIFICATION_BATCH_WAIT = 0.05
+QUEUE_NOTIFICATION_RETRIES = 3
+QUEUE_NOTIFICATION_BACKOFF_SECONDS = 0.5
+
 
 # Password validation
 # https://docs.djangoproject.com/en/6.0/ref/settings/#auth-password-validators
@@ -117,3 +261,43 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/6.0/howto/static-files/
 
 STATIC_URL = 'static/'
+
+
+# Queue positions
+# people_ahead / people_behind come from an in-process index of each queue's
+# waiting set, reloaded every QUEUE_POSITION_REFRESH_SECONDS to pick up other
+# worker processes' changes. Turn it off to count in the database instead.
+
+QUEUE_POSITION_INDEX = True
+QUEUE_POSITION_REFRESH_SECONDS = 10
+
+# Free counters are likewise tracked in memory per queue. Other processes'
+# changes are picked up by retrying against the database, so this is safe
+# with several workers, just less evenly balanced.
+
+QUEUE_COUNTER_POOL = True
+
+# How often each process reloads its service-time averages from the Token table.
+
+QUEUE_ETA_REFRESH_SECONDS = 300
+
+# Finished tokens older than this are moved to ArchivedToken by the
+# archive_tokens command, which should be scheduled (cron or similar).
+
+QUEUE_ARCHIVE_AFTER_HOURS = 24
+
+
+# Queue events
+# Broker behind the serving/<id>/events/ and my-token/<id>/events/ streams.
+# The in-process broker only reaches subscribers of the same worker process.
+
+QUEUE_EVENT_BROKER = 'digital_queue_app.events.InProcessBroker'
+
+
+# Metrics
+# Served in Prometheus text format at /metrics. Actual wait quantiles cover
+# tokens that joined within the window. Set the threshold to a number of
+# queries to log requests that run more than that many.
+
+QUEUE_METRICS_WAIT_WINDOW_SECONDS = 3600
+QUEUE_SLOW_QUERY_THRESHOLD = None